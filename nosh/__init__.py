@@ -1,5 +1,8 @@
 
-from nosh.shell import (mv, rm, cp, pwd, ls, mkdir, touch)
+from nosh.shell import (mv, rm, cp, sync, dedupe, checksum, pwd, ls,
+                        ls_entries, find, mkdir, touch)
 from nosh.dirutils import current_directory, temp_directory
-from nosh.archives import (tar, untar, lstar, zip)
+from nosh.archives import (tar, untar, lstar, zip, unzip)
+from nosh.batch import plan
 from nosh.utils import (expand_path)
+from nosh.instrumentation import instrument
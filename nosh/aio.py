@@ -0,0 +1,154 @@
+'''Asyncio versions of the nosh commands.
+
+Each coroutine here runs the matching command from nosh.shell or
+nosh.archives in a shared thread pool executor, so file operations
+don't block the event loop:
+
+    import nosh.aio
+    await nosh.aio.cp('*.txt', 'backup', recursive=True)
+
+The commands run with a copy of the calling task's context, so they
+see the readable and writable paths set with nosh.state in that task.
+
+If the awaiting task is cancelled, the command stops at the next file
+boundary (the file being copied, deleted or archived when the task is
+cancelled is still finished).
+
+The number of calls of each command running at once is bounded, see
+set_concurrency. Calls beyond the limit wait without occupying an
+executor thread.
+'''
+
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from nosh import shell
+from nosh import archives
+from nosh.utils import cancel_on
+
+DEFAULT_CONCURRENCY = 8
+'''The default number of calls of each command that may run at once.'''
+
+FIND_BATCH_SIZE = 1000
+'''The number of results find collects in a thread before handing them
+back to the event loop.'''
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+_CONCURRENCY = {}
+_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def set_executor(executor):
+    '''Set the concurrent.futures.Executor that commands run in. It
+    should be a thread pool, as commands run with the calling task's
+    context. None restores the default, a ThreadPoolExecutor created on
+    first use.'''
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        _EXECUTOR = executor
+
+
+def get_executor():
+    '''Return the executor that commands run in.'''
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(thread_name_prefix='nosh-aio')
+        return _EXECUTOR
+
+
+def set_concurrency(command, limit):
+    '''Set the number of calls of ``command`` (e.g. 'cp') that may run at
+    once. None restores DEFAULT_CONCURRENCY. Takes effect for event loops
+    that haven't yet run the command.'''
+    if limit is not None and limit < 1:
+        raise ValueError('limit must be at least 1, got {}'.format(limit))
+    _CONCURRENCY[command] = limit
+
+
+def _semaphore(command):
+    # asyncio semaphores belong to a single event loop
+    loop = asyncio.get_running_loop()
+    semaphores = _SEMAPHORES.setdefault(loop, {})
+    if command not in semaphores:
+        limit = _CONCURRENCY.get(command)
+        semaphores[command] = asyncio.Semaphore(
+            DEFAULT_CONCURRENCY if limit is None else limit)
+    return semaphores[command]
+
+
+def _call(event, func, args, kwargs):
+    with cancel_on(event):
+        return func(*args, **kwargs)
+
+
+async def run(command, func, *args, **kwargs):
+    '''Run ``func(*args, **kwargs)`` in the executor, counting towards
+    the concurrency limit of ``command``, and return its result.'''
+    loop = asyncio.get_running_loop()
+    event = threading.Event()
+    context = contextvars.copy_context()
+    async with _semaphore(command):
+        try:
+            return await loop.run_in_executor(
+                get_executor(),
+                partial(context.run, _call, event, func, args, kwargs))
+        except asyncio.CancelledError:
+            event.set()
+            raise
+
+
+def _mirror(func):
+    @wraps(func)
+    async def coroutine(*args, **kwargs):
+        return await run(func.__name__, func, *args, **kwargs)
+    coroutine.__doc__ = 'Coroutine version of nosh.{}.{}.\n\n{}'.format(
+        func.__module__.split('.')[-1], func.__name__, func.__doc__ or '')
+    return coroutine
+
+
+mv = _mirror(shell.mv)
+rm = _mirror(shell.rm)
+cp = _mirror(shell.cp)
+sync = _mirror(shell.sync)
+dedupe = _mirror(shell.dedupe)
+checksum = _mirror(shell.checksum)
+ls = _mirror(shell.ls)
+ls_entries = _mirror(shell.ls_entries)
+mkdir = _mirror(shell.mkdir)
+touch = _mirror(shell.touch)
+
+tar = _mirror(archives.tar)
+untar = _mirror(archives.untar)
+lstar = _mirror(archives.lstar)
+zip = _mirror(archives.zip)
+unzip = _mirror(archives.unzip)
+
+
+def _next_batch(results):
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) >= FIND_BATCH_SIZE:
+            break
+    return batch
+
+
+async def find(*args, **kwargs):
+    '''Async generator version of nosh.shell.find.
+
+    Results are collected in the executor in batches of up to
+    FIND_BATCH_SIZE, so the event loop isn't woken for every result.
+    '''
+    results = await run('find', shell.find, *args, **kwargs)
+    while True:
+        batch = await run('find', _next_batch, results)
+        if not batch:
+            return
+        for result in batch:
+            yield result
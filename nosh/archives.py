@@ -6,17 +6,394 @@ of using tar for both creating and unpacking tarballs nosh provides
 
 '''
 
+import os
 from os import path
+import posixpath
+import sys
+import threading
+import zlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from nosh.utils import (require_args, expand_paths,
-                        maybe_exception)
+                        maybe_exception, check_cancelled, supports_dry_run,
+                        supports_progress, supports_throttle)
 
 import tarfile
 import zipfile
 
+from nosh import compression
+from nosh import estimate
+from nosh import findutils
+from nosh import progress
+from nosh import throttle
+from nosh import tarindex
+from nosh import treeutils
+from nosh import vfs
 
+PARALLEL_WRITE_MAX = 16 * 1024 * 1024
+PARALLEL_READ_SIZE = 1024 * 1024
+PARALLEL_ZIP_MAX = 16 * 1024 * 1024
+
+
+@contextmanager
+def _open_tar_for_writing(target, compress, level=None, threads=1,
+                          append=False):
+    codec = compression.get_codec(compress)
+
+    if append:
+        if codec is not None:
+            raise ValueError(
+                ('Appending to compressed ({}) tarfiles not '
+                 'supported').format(compress))
+        with tarfile.open(target, mode='a') as tarh:
+            yield tarh
+        return
+
+    if codec is None:
+        with tarfile.open(target, mode='w') as tarh:
+            yield tarh
+    elif codec.tarfile_name is not None and threads == 1:
+        kwargs = {codec.tarfile_level_kwarg: codec.check_level(level)}
+        with tarfile.open(target, mode='w:{}'.format(codec.tarfile_name),
+                          **kwargs) as tarh:
+            yield tarh
+    else:
+        with open(target, 'wb') as fileh:
+            writer = codec.open_writer(fileh, level=level, threads=threads)
+            try:
+                with tarfile.open(mode='w|', fileobj=writer) as tarh:
+                    yield tarh
+            finally:
+                writer.close()
+
+
+def _read_codec(tar_path, compress='auto'):
+    if compress in (None, 'auto'):
+        return compression.detect_codec(tar_path)
+    return compression.get_codec(compress)
+
+
+def _seekable(codec):
+    # tarfile can only seek within uncompressed data, or data of codecs
+    # it opens itself
+    return codec is None or codec.tarfile_name is not None
+
+
+@contextmanager
+def _open_tar_for_reading(tar_path, codec):
+    if codec is None:
+        with tarfile.open(tar_path, mode='r:') as tarh:
+            yield tarh
+    elif codec.tarfile_name is not None:
+        with tarfile.open(tar_path, mode='r:{}'.format(
+                codec.tarfile_name)) as tarh:
+            yield tarh
+    else:
+        with open(tar_path, 'rb') as fileh:
+            reader = codec.open_reader(fileh)
+            try:
+                with tarfile.open(mode='r|', fileobj=reader) as tarh:
+                    yield tarh
+            finally:
+                reader.close()
+
+
+@contextmanager
+def _open_fd(filen):
+    if filen is None:
+        yield None
+        return
+    fd = os.open(filen, os.O_RDONLY)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _iter_members(tarh):
+    '''Yield the members of ``tarh`` as their headers are read, without
+    keeping them all in tarh.members as iterating a TarFile does.'''
+    while True:
+        info = tarh.next()
+        if info is None:
+            return
+        del tarh.members[:]
+        yield info
+
+
+def _matches_path(regex, name):
+    # Like tar, a pattern matching a directory matches everything in it
+    while name:
+        if regex.match(name):
+            return True
+        parent = posixpath.dirname(name)
+        if parent == name:
+            return False
+        name = parent
+    return False
+
+
+class _Selection(object):
+    '''Decides which tarball members untar extracts, and when it has
+    found them all.'''
+
+    def __init__(self, members=None, include=None, exclude=None):
+        if isinstance(include, str):
+            include = [include]
+        self.members = None if members is None else set(members)
+        self.include = findutils.compile_patterns(include)
+        self.exclude = findutils.compile_patterns(exclude)
+
+        # The names that must all be found before reading can stop, or
+        # None if the whole tarball must be read. Only exact member
+        # names are counted: a directory can't be known to be complete.
+        self.remaining = None
+        if self.members is not None and self.include is None:
+            self.remaining = set(self.members)
+
+    def wants(self, info):
+        if self.exclude is not None and _matches_path(self.exclude, info.name):
+            return False
+        if self.members is None and self.include is None:
+            return True
+        if self.members is not None and info.name in self.members:
+            return True
+        return (self.include is not None and
+                _matches_path(self.include, info.name))
+
+    def found(self, info):
+        '''Record that ``info`` was extracted, returning True if
+        nothing else remains to be found.'''
+        if self.remaining is None:
+            return False
+        self.remaining.discard(info.name)
+        return not self.remaining
+
+    def check_found(self, names, tar_path):
+        '''Raise KeyError if any requested members are not in
+        ``names``.'''
+        if self.members is None:
+            return
+        missing = sorted(self.members.difference(names))
+        if missing:
+            raise KeyError('{} not found in {}'.format(missing, tar_path))
+
+
+def _set_attrs(tarh, info, filen):
+    tarh.chown(info, filen, False)
+    tarh.utime(info, filen)
+    tarh.chmod(info, filen)
+
+
+def _check_link_target(info, target):
+    if info.islnk() and not path.lexists(path.join(target, info.linkname)):
+        # Finding the target in the tarball would mean keeping every
+        # member read so far; like tar, give up instead
+        raise tarfile.ExtractError(
+            'Cannot hard link {} to {}, which was not extracted'.format(
+                info.name, info.linkname))
+
+
+def _set_directory_attrs(tarh, directories, target):
+    # Deepest first, so setting a parent's mtime is the last change to it
+    directories.sort(key=lambda info: info.name, reverse=True)
+    for info in directories:
+        _set_attrs(tarh, info, path.join(target, info.name))
+
+
+def _counting():
+    # Whether members must be counted, see _member_done
+    return progress.active() or throttle.get_throttle() is not None
+
+
+def _member_done(info):
+    # Count a tar member for the progress and throttle, as
+    # estimate.measure counts them
+    files = 0 if info.isdir() else 1
+    nbytes = info.size if info.isreg() else 0
+    progress.advance(files, nbytes)
+    throttle.wait(files, nbytes)
+
+
+def _counted(infos):
+    '''Yield each of ``infos``, counting it with _member_done once the
+    next is wanted.'''
+    for info in infos:
+        yield info
+        _member_done(info)
+
+
+def _extract(tarh, infos, target, workers=1, tar_fd=None):
+    '''Extract each of ``infos`` as it is yielded, setting the
+    attributes of directories last as extractall does, so extracting
+    their contents doesn't change their mtime.
+
+    With more than one worker, regular files are written in parallel by
+    _extract_parallel.
+    '''
+    if _counting():
+        infos = _counted(infos)
+    if workers > 1:
+        return _extract_parallel(tarh, infos, target, workers, tar_fd)
+
+    directories = []
+    for info in infos:
+        check_cancelled()
+        if info.isdir():
+            directories.append(info)
+        else:
+            _check_link_target(info, target)
+        tarh.extract(info, target, set_attrs=not info.isdir())
+
+    _set_directory_attrs(tarh, directories, target)
+
+
+def _write_member(job):
+    tarh, info, filen, data, tar_fd = job
+    with open(filen, 'wb') as fileh:
+        if data is not None:
+            fileh.write(data)
+        else:
+            offset = info.offset_data
+            end = offset + info.size
+            while offset < end:
+                chunk = os.pread(tar_fd, min(PARALLEL_READ_SIZE, end - offset),
+                                 offset)
+                if not chunk:
+                    raise tarfile.ReadError(
+                        'unexpected end of data reading {}'.format(info.name))
+                fileh.write(chunk)
+                offset += len(chunk)
+    _set_attrs(tarh, info, filen)
+
+
+def _extract_parallel(tarh, infos, target, workers, tar_fd=None):
+    '''Extract ``infos``, writing regular files in ``workers`` threads.
+
+    If ``tar_fd`` is given, it is a file descriptor of the uncompressed
+    tarball and each worker reads its member's data with os.pread, so
+    reads are parallel too. Otherwise the data can only be read in
+    order, so is read in this thread and handed to the workers to write,
+    except for files over PARALLEL_WRITE_MAX which are extracted
+    directly.
+
+    Directories, including each file's parent, are created in this
+    thread before any of their files are queued, so workers never race
+    to create them. Links are made last, once their targets exist.
+    '''
+    directories = []
+    links = []
+    made_dirs = set()
+
+    def jobs():
+        for info in infos:
+            if info.isdir():
+                tarh.extract(info, target, set_attrs=False)
+                directories.append(info)
+                made_dirs.add(path.join(target, info.name))
+                continue
+            if info.issym() or info.islnk():
+                links.append(info)
+                continue
+            if not info.isreg() or info.issparse():
+                tarh.extract(info, target)
+                continue
+
+            filen = path.join(target, info.name)
+            parent = path.dirname(filen)
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+
+            if tar_fd is not None:
+                yield tarh, info, filen, None, tar_fd
+            elif info.size > PARALLEL_WRITE_MAX:
+                tarh.extract(info, target)
+            else:
+                yield tarh, info, filen, tarh.extractfile(info).read(), None
+
+    for _ in treeutils.map_bounded(_write_member, jobs(), workers):
+        pass
+
+    for info in links:
+        check_cancelled()
+        _check_link_target(info, target)
+        tarh.extract(info, target)
+
+    _set_directory_attrs(tarh, directories, target)
+
+
+def _extract_indexed(tarh, tar_path, selection, target, workers=1,
+                     tar_fd=None):
+    entries = tarindex.load_index(tar_path)
+    if entries is None:
+        infos = tarh.getmembers()
+        tarindex.write_index(tar_path, infos)
+    else:
+        infos = [tarindex.entry_to_tarinfo(entry) for entry in entries]
+    selection.check_found((info.name for info in infos), tar_path)
+
+    # In offset order, so compressed tarballs only ever seek forwards
+    wanted = sorted((info for info in infos if selection.wants(info)),
+                    key=lambda info: info.offset)
+    _extract(tarh, wanted, target, workers, tar_fd)
+
+
+def _extract_scanning(tarh, tar_path, selection, target, workers=1,
+                      tar_fd=None):
+    extracted = set()
+
+    def wanted():
+        for info in _iter_members(tarh):
+            if selection.wants(info):
+                yield info
+                extracted.add(info.name)
+                if selection.found(info):
+                    return
+
+    _extract(tarh, wanted(), target, workers, tar_fd)
+    selection.check_found(extracted, tar_path)
+
+
+def _estimate_tar(*args, compress='gz', append=False, threads=1,
+                  level=None, index=False):
+    sources = args[:-1]
+    target = args[-1]
+    codec = compression.get_codec(compress)
+
+    problems = []
+    if not append and path.exists(target):
+        problems.append('Cannot create tar at target {}, file already '
+                        'exists'.format(target))
+    if append and not path.exists(target):
+        problems.append('Cannot append to archive {}, it does not '
+                        'exist'.format(target))
+
+    operations = []
+    for source in sources:
+        if not path.lexists(source):
+            problems.append('{} does not exist'.format(source))
+            continue
+        size = estimate.measure(source)
+        seconds = (estimate.cost('archive', size.files + size.directories,
+                                 size.bytes) +
+                   estimate.compression_cost(codec and codec.name,
+                                             size.bytes, threads))
+        operations.append(estimate.operation('archive', source, target,
+                                             size, seconds))
+    return estimate.report('tar', operations, problems)
+
+
+@vfs.local_only
 @require_args(min=2)
 @expand_paths(abspath=False)
-def tar(*args, compress='gz', append=False):
+@supports_throttle
+@supports_progress()
+@supports_dry_run(_estimate_tar)
+def tar(*args, compress='gz', append=False, threads=1, level=None,
+        index=False):
     '''Create or append to tarballs.
 
     Parameters
@@ -24,24 +401,45 @@ def tar(*args, compress='gz', append=False):
     *args : strings
         The files and directories to place in the tarball. The final argument
         should be the tarball name.
-    compress : str or False
-        Whether to compress the tarball. May be 'gzip', 'bz2' or False.
-        Defaults to 'gzip'.
+    compress : str or None
+        The codec to compress the tarball with, or None for no
+        compression. May be 'gz', 'bz2', 'xz', or any other codec in
+        nosh.compression.CODECS (e.g. 'zst' and 'lz4', if their modules
+        are installed). Defaults to 'gz'.
     append : bool
         Whether to append to the tarball. Will raise an exception if the
         path does not exist. Defaults to False.
-
-    TODO
-    ----
-    compress should be more flexible, to work with tarballs with different
-    compression types.
+    threads : int
+        The number of threads to compress with. If more than 1, the data
+        is compressed in independent blocks in parallel (see
+        nosh.compression); the result is still an ordinary compressed
+        file. Defaults to 1.
+    level : int or None
+        The compression level, whose range depends on the codec (e.g.
+        0-9 for gz and xz). Lower is faster, higher compresses more.
+        Defaults to None, the codec's default level.
+    index : bool
+        If True, also write a sidecar index of the tarball's members (see
+        nosh.tarindex), for fast listing and extraction with lstar and
+        untar. Defaults to False.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
     '''
     sources = args[:-1]
     target = args[-1]
 
-    if compress not in [None, 'gz', 'bz2']:
-        raise ValueError(
-            'compress must be one of {}'.format([None, 'gz', 'bz2']))
+    codec = compression.get_codec(compress)
+    if codec is not None:
+        codec.check_level(level)
 
     if not append and path.exists(target):
             raise FileExistsError(
@@ -52,24 +450,94 @@ def tar(*args, compress='gz', append=False):
         raise FileNotFoundError(
             'Cannot append to archive {}, it does not exist'.format(target))
 
-    if append:
-        if compress is not None:
-            raise ValueError(
-                ('Appending to compressed ({}) tarfiles not '
-                 'supported').format(compress))
-        tarh = tarfile.open(target, mode='a')
-    else:
-        if compress is None:
-            compress = '*'
-        tarh = tarfile.open(target, mode='w:{}'.format(compress))
+    with _open_tar_for_writing(target, compress, level=level,
+                               threads=threads, append=append) as tarh:
+        # tarfile copies each TarInfo as it writes it, so the index is
+        # built from the originals passed through the filter
+        members = list(tarh.members)
+        added = []
+
+        def member_added(tarinfo):
+            if index:
+                added.append((tarinfo, tarh.offset))
+            _member_done(tarinfo)
+            return tarinfo
 
-    with tarh:
         for source in sources:
-            tarh.add(source)
+            check_cancelled()
+            tarh.add(source, filter=member_added
+                     if index or _counting() else None)
+        tarindex.set_offsets(added, tarh.offset)
+        members.extend(tarinfo for tarinfo, _ in added)
 
+    if index:
+        tarindex.write_index(target, members)
 
+
+def _estimate_untar(tar_path, target='.', compress='auto', members=None,
+                    include=None, exclude=None, index=False, workers=None):
+    if not path.exists(tar_path):
+        return estimate.report('untar', [], [
+            'Tarfile {} does not exist'.format(tar_path)])
+    problems = []
+    if not path.isdir(target):
+        problems.append('Cannot extract to {}, path does not '
+                        'exist'.format(target))
+
+    # Without an index the members' headers must be read, which means
+    # decompressing the whole tarball (but not writing anything)
+    codec = _read_codec(tar_path, compress)
+    entries = tarindex.load_index(tar_path)
+    if entries is not None:
+        infos = (tarindex.entry_to_tarinfo(entry) for entry in entries)
+    else:
+        infos = _lstar(tar_path, compress)
+
+    selection = _Selection(members, include, exclude)
+    files = directories = nbytes = total_bytes = 0
+    names = set()
+    for info in infos:
+        total_bytes += info.size
+        if not selection.wants(info):
+            continue
+        names.add(info.name)
+        if info.isdir():
+            directories += 1
+        else:
+            files += 1
+            nbytes += info.size
+    try:
+        selection.check_found(names, tar_path)
+    except KeyError as error:
+        problems.append(error.args[0])
+
+    if not (index and _seekable(codec)):
+        # Scanning decompresses everything before the last member wanted
+        nbytes_read = total_bytes
+    else:
+        nbytes_read = nbytes
+    size = estimate.Size(files, directories, nbytes)
+    seconds = (estimate.cost('extract', files + directories, nbytes) +
+               estimate.compression_cost(codec and codec.name, nbytes_read,
+                                         decompress=True))
+    return estimate.report('untar', [estimate.operation(
+        'extract', tar_path, target, size, seconds)], problems)
+
+
+def _has_index(tar_path, *args, **kwargs):
+    # Without an index the dry run would decompress the whole tarball
+    # once more before extracting it, so progress goes without totals
+    return (path.exists(tar_path) and
+            tarindex.load_index(tar_path) is not None)
+
+
+@vfs.local_only
 @expand_paths('target', do_glob=False)
-def untar(tar_path, target='.', compress='auto'):
+@supports_throttle
+@supports_progress(plan_if=_has_index)
+@supports_dry_run(_estimate_untar)
+def untar(tar_path, target='.', compress='auto', members=None, include=None,
+          exclude=None, index=False, workers=None):
     '''Extract the given tarball.
 
     Parameters
@@ -79,15 +547,50 @@ def untar(tar_path, target='.', compress='auto'):
     target : str
         The directory to extract to. Defaults to '.', the current dir.
     compress : str
-        Whether the tarfile is compressed. Defaults to auto, which will
-        automatically work with gzip or bz2. You can also specify these
-        explicitly, but probably don't want to. Other compression formats
-        are not supported.
-
-    TODO
-    ----
-    include and exclude arguments
+        The codec the tarfile is compressed with. Defaults to auto,
+        which detects the codec from the first bytes of the file. You
+        can also specify any codec in nosh.compression.CODECS
+        explicitly, but probably don't want to.
+    members : list of str or None
+        The names of the members to extract. Reading stops as soon as
+        they have all been found. Raises KeyError if any are not in the
+        tarball. Defaults to None, extracting everything.
+    include : str or list of str or None
+        Glob patterns of members to extract, in addition to any
+        ``members``. As with tar, a pattern matching a directory
+        includes everything in it. Defaults to None.
+    exclude : str or list of str or None
+        Glob patterns of members not to extract, taking precedence over
+        ``members`` and ``include``. Defaults to None.
+    index : bool
+        If True and members are being selected, use the tarball's
+        sidecar index (see nosh.tarindex) to seek straight to each
+        member, building and saving the index first if there is no up
+        to date one. Defaults to False.
+    workers : int or None
+        The number of threads writing extracted files. From an
+        uncompressed tarball the workers read the files' data in
+        parallel too; otherwise it is decompressed in order and only the
+        writes are parallel. Defaults to None, meaning
+        nosh.treeutils.DEFAULT_WORKERS.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. The totals are only known
+        if the tarball has an up to date sidecar index. Defaults to
+        None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    Members are selected and extracted in a single pass as the tarball
+    is read, without holding the list of all its members in memory.
     '''
+    workers = treeutils.get_workers(workers)
 
     if not path.exists(tar_path):
         raise FileNotFoundError('Tarfile {} does not exist'.format(tar_path))
@@ -96,15 +599,28 @@ def untar(tar_path, target='.', compress='auto'):
         raise FileNotFoundError(
             'Cannot extract to {}, path does not exist'.format(target))
 
-    if compress in (None, 'auto'):
-        compress = '*'
+    selection = _Selection(members, include, exclude)
+    selecting = not (members is None and include is None and
+                     exclude is None)
 
-    with tarfile.open(tar_path, 'r:{}'.format(compress)) as tarh:
-        tarh.extractall(target)
+    codec = _read_codec(tar_path, compress)
+    with _open_tar_for_reading(tar_path, codec) as tarh, \
+            _open_fd(tar_path if codec is None and workers > 1
+                     else None) as tar_fd:
+        if not selecting and workers == 1:
+            tarh.extractall(target, members=_counted(tarh)
+                            if _counting() else None)
+        elif index and _seekable(codec):
+            _extract_indexed(tarh, tar_path, selection, target, workers,
+                             tar_fd)
+        else:
+            _extract_scanning(tarh, tar_path, selection, target, workers,
+                              tar_fd)
 
 
+@vfs.local_only
 @expand_paths()
-def lstar(tar_path, compress='auto'):
+def lstar(tar_path, compress='auto', index=False, stream=False):
     '''Get the contents of the given tarball.
 
     Parameters
@@ -112,38 +628,426 @@ def lstar(tar_path, compress='auto'):
     tar_path : str
         The path to the tarfile.
     compress : str
-        Whether the tarfile is compressed. Defaults to auto, which will
-        automatically work with gzip or bz2. You can also specify these
-        explicitly, but probably don't want to. Other compression formats
-        are not supported.
+        The codec the tarfile is compressed with. Defaults to auto,
+        which detects the codec from the first bytes of the file. You
+        can also specify any codec in nosh.compression.CODECS
+        explicitly, but probably don't want to.
+    index : bool
+        If True, answer from the tarball's sidecar index (see
+        nosh.tarindex) without reading the tarball, or if there is no
+        up to date index, write one after reading it (unless
+        streaming). Defaults to False.
+    stream : bool
+        If True, return a generator yielding each member as it is read
+        instead of a list, so the members of huge tarballs needn't all
+        be held in memory. Defaults to False.
     '''
-    if compress not in ('auto', 'gz', 'bz2'):
-        raise ValueError(
-            'compress must be one of {}'.format('auto', 'gz', 'bz2'))
+    if compress != 'auto':
+        compression.get_codec(compress)
 
     if not path.exists(tar_path):
         raise FileNotFoundError(
             'tarfile at {} does not exist'.format(tar_path))
 
-    if compress == 'auto':
-        compress = '*'
+    if index:
+        entries = tarindex.load_index(tar_path)
+        if entries is not None:
+            infos = (tarindex.entry_to_tarinfo(entry) for entry in entries)
+            return infos if stream else list(infos)
+
+    if stream:
+        return _lstar(tar_path, compress)
 
-    with tarfile.open(tar_path, mode='r:{}'.format(compress)) as tarh:
+    with _open_tar_for_reading(tar_path, _read_codec(tar_path, compress)) as tarh:
         members = tarh.getmembers()
 
+    if index:
+        tarindex.write_index(tar_path, members)
+
     return members
 
 
+def _lstar(tar_path, compress):
+    with _open_tar_for_reading(tar_path, _read_codec(tar_path, compress)) as tarh:
+        yield from _iter_members(tarh)
+
+
+ZIP_METHODS = {None: zipfile.ZIP_STORED,
+               'store': zipfile.ZIP_STORED,
+               'deflate': zipfile.ZIP_DEFLATED,
+               'bz2': zipfile.ZIP_BZIP2,
+               'xz': zipfile.ZIP_LZMA}
+'''The ``compress`` arguments zip accepts, and their zipfile methods.'''
+
+def _iter_zip_sources(sources, recursive):
+    matcher = findutils.Matcher()
+    for source in sources:
+        if recursive and path.isdir(source) and not path.islink(source):
+            for entry in findutils.walk([source], matcher):
+                yield entry.path
+        else:
+            yield source
+
+
+# ZipFile has no public way to add data that is already compressed, so
+# to compress members in parallel _precompress and _write_precompressed
+# use zipfile internals, and nothing else does. They were checked
+# against the zipfile module of CPython 3.7 to 3.13. On other versions,
+# or if any of the internals are missing, the workers only read the
+# members, and ZipFile.writestr compresses them as they are written.
+PRECOMPRESS_VERSIONS = ((3, 7), (3, 13))
+'''The first and last Python versions whose zipfile internals
+_write_precompressed was checked against.'''
+
+_ZIPFILE_INTERNALS = ('_writecheck', '_writing', '_didModify', '_lock',
+                      'fp', 'NameToInfo', 'start_dir')
+
+
+def _can_precompress(ziph):
+    first, last = PRECOMPRESS_VERSIONS
+    return (first <= sys.version_info[:2] <= last and
+            hasattr(zipfile, '_get_compressor') and
+            all(hasattr(ziph, name) for name in _ZIPFILE_INTERNALS))
+
+
+def _precompress(zinfo, data, method, level):
+    '''Fill in the sizes and CRC of ``zinfo`` and return ``data``
+    compressed as ZipFile.write would compress it.'''
+    zinfo.compress_type = method
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    compressor = zipfile._get_compressor(method, level)
+    if compressor is not None:
+        data = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(data)
+    return data
+
+
+def _write_precompressed(ziph, zinfo, data):
+    '''Add a member compressed by _precompress to the open ZipFile
+    ``ziph``.
+
+    This does what ZipFile.write does after compressing. Since the sizes
+    and CRC are known before the local header is written, no data
+    descriptor is needed even when writing to an unseekable stream.
+    '''
+    with ziph._lock:
+        if ziph._writing:
+            raise ValueError("Can't write to ZIP archive while an open "
+                             "writing handle exists")
+        ziph._writecheck(zinfo)
+        ziph._didModify = True
+        zinfo.header_offset = ziph.fp.tell()
+        ziph.fp.write(zinfo.FileHeader())
+        ziph.fp.write(data)
+        ziph.filelist.append(zinfo)
+        ziph.NameToInfo[zinfo.filename] = zinfo
+        ziph.start_dir = ziph.fp.tell()
+
+
+def _read_member(job):
+    '''Return the ZipInfo and data of the file ``filen``, and whether
+    the data has been compressed with _precompress. The data is None if
+    the file should be written by ZipFile.write instead.'''
+    filen, method, level, precompress = job
+    zinfo = zipfile.ZipInfo.from_file(filen)
+    if zinfo.is_dir() or zinfo.file_size > PARALLEL_ZIP_MAX:
+        return filen, zinfo, None, False
+
+    with open(filen, 'rb') as fileh:
+        data = fileh.read()
+    if precompress:
+        data = _precompress(zinfo, data, method, level)
+    return filen, zinfo, data, precompress
+
+
+def _iter_ordered(func, items, workers):
+    '''Yield ``func(item)`` for each of ``items`` in order, calling it
+    in ``workers`` threads with a bounded number of calls in flight.'''
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            check_cancelled()
+            pending.append(executor.submit(
+                contextvars.copy_context().run, func, item))
+            while len(pending) > workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _estimate_zip(*args, compress='deflate', level=None, recursive=False,
+                  workers=None):
+    sources = args[:-1]
+    target = args[-1]
+    if compress not in ZIP_METHODS:
+        raise ValueError('compress must be one of {}, got {}'.format(
+            list(ZIP_METHODS), compress))
+    workers = treeutils.get_workers(workers)
+
+    problems = []
+    if isinstance(target, str) and path.exists(target):
+        problems.append('Cannot zip to {}, file exists'.format(target))
+
+    operations = []
+    for source in sources:
+        if not path.lexists(source):
+            problems.append('{} does not exist'.format(source))
+            continue
+        size = estimate.measure(source, recursive=recursive)
+        seconds = (estimate.cost('archive', size.files + size.directories,
+                                 size.bytes) +
+                   estimate.compression_cost(compress, size.bytes, workers))
+        operations.append(estimate.operation('archive', source, target,
+                                             size, seconds))
+    return estimate.report('zip', operations, problems)
+
+
+@vfs.local_only
 @require_args(min=2)
 @expand_paths(abspath=False)
-def zip(*args):
+@supports_throttle
+@supports_progress()
+@supports_dry_run(_estimate_zip)
+def zip(*args, compress='deflate', level=None, recursive=False,
+        workers=None):
+    '''Create a zip file.
+
+    Parameters
+    ----------
+    *args : str
+        The files to zip, followed by the path of the zip file to
+        create. The last argument may instead be a writable file object
+        (e.g. a socket file or HTTP response), which the zip file is
+        streamed to; it needn't be seekable.
+    compress : str or None
+        The compression method, one of the keys of ZIP_METHODS. Defaults
+        to 'deflate'. None stores the files uncompressed.
+    level : int or None
+        The compression level, 0-9 for deflate and 1-9 for bz2 (xz
+        ignores it). Defaults to None, the method's default level.
+    recursive : bool
+        Whether to zip the contents of directories as well as the
+        directories themselves. Defaults to False.
+    workers : int or None
+        The number of threads compressing files. Each member of a zip
+        file is compressed independently, so files are compressed in
+        parallel and written in order as they finish. Files over
+        PARALLEL_ZIP_MAX are compressed in this thread as they are
+        written, so memory use is bounded per member. On Python versions
+        outside PRECOMPRESS_VERSIONS files are only read in parallel, and
+        compressed in this thread. Defaults to None, meaning
+        nosh.treeutils.DEFAULT_WORKERS.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+    '''
     sources = args[:-1]
     target = args[-1]
 
-    if path.exists(target):
+    if compress not in ZIP_METHODS:
+        raise ValueError('compress must be one of {}, got {}'.format(
+            list(ZIP_METHODS), compress))
+    method = ZIP_METHODS[compress]
+    workers = treeutils.get_workers(workers)
+
+    if isinstance(target, str) and path.exists(target):
         raise FileExistsError('Cannot zip to {}, file exists'.format(target))
 
-    with zipfile.ZipFile(target, 'w') as ziph:
-        for source in sources:
-            ziph.write(source)
-        
+    filens = _iter_zip_sources(sources, recursive)
+    with zipfile.ZipFile(target, 'w', compression=method,
+                         compresslevel=level) as ziph:
+        if workers == 1:
+            for filen in filens:
+                check_cancelled()
+                ziph.write(filen)
+                _zip_member_done(ziph.infolist()[-1])
+            return
+
+        precompress = _can_precompress(ziph)
+        jobs = ((filen, method, level, precompress) for filen in filens)
+        for filen, zinfo, data, compressed in _iter_ordered(
+                _read_member, jobs, workers):
+            if data is None:
+                ziph.write(filen)
+            elif compressed:
+                _write_precompressed(ziph, zinfo, data)
+            else:
+                ziph.writestr(zinfo, data, compress_type=method,
+                              compresslevel=level)
+            _zip_member_done(ziph.infolist()[-1])
+
+
+def _zip_member_done(info):
+    files = 0 if info.is_dir() else 1
+    progress.advance(files, info.file_size)
+    throttle.wait(files, info.file_size)
+
+
+def _zip_member_path(target, name):
+    # As ZipFile.extract does, drop empty, '.' and '..' components so
+    # members can't be written outside target
+    parts = [part for part in name.split('/')
+             if part not in ('', path.curdir, path.pardir)]
+    return path.join(target, *parts)
+
+
+def _zip_mode(info):
+    if info.create_system != 3:  # only unix zips record permissions
+        return 0
+    # As tarfile's data filter, never apply setuid, setgid or sticky bits
+    return (info.external_attr >> 16) & 0o777
+
+
+class _ZipReaders(object):
+    '''Opens one ZipFile per thread, so workers never share a file
+    position.'''
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        ziph = getattr(self.local, 'ziph', None)
+        if ziph is None:
+            ziph = self.local.ziph = zipfile.ZipFile(self.zip_path)
+            with self.lock:
+                self.opened.append(ziph)
+        return ziph
+
+    def close(self):
+        for ziph in self.opened:
+            ziph.close()
+
+
+def _estimate_unzip(zip_path, target='.', members=None, workers=None):
+    if not path.exists(zip_path):
+        return estimate.report('unzip', [], [
+            'Zip file {} does not exist'.format(zip_path)])
+    problems = []
+    if not path.isdir(target):
+        problems.append('Cannot extract to {}, path does not '
+                        'exist'.format(target))
+
+    # Only the central directory at the end of the file is read
+    with zipfile.ZipFile(zip_path) as ziph:
+        if members is None:
+            infos = ziph.infolist()
+        else:
+            infos = []
+            for name in members:
+                try:
+                    infos.append(ziph.getinfo(name))
+                except KeyError as error:
+                    problems.append(error.args[0])
+
+    methods = {method: name for name, method in ZIP_METHODS.items()
+               if name is not None}
+    workers = treeutils.get_workers(workers)
+    directories = sum(1 for info in infos if info.is_dir())
+    files = len(infos) - directories
+    nbytes = sum(info.file_size for info in infos)
+    seconds = estimate.cost('extract', len(infos), nbytes)
+    for info in infos:
+        seconds += estimate.compression_cost(
+            methods.get(info.compress_type, 'deflate'), info.file_size,
+            workers, decompress=True)
+    size = estimate.Size(files, directories, nbytes)
+    return estimate.report('unzip', [estimate.operation(
+        'extract', zip_path, target, size, seconds)], problems)
+
+
+@vfs.local_only
+@expand_paths('target', do_glob=False)
+@supports_throttle
+@supports_progress()
+@supports_dry_run(_estimate_unzip)
+def unzip(zip_path, target='.', members=None, workers=None):
+    '''Extract the given zip file.
+
+    Parameters
+    ----------
+    zip_path : str
+        The path to the zip file to be extracted.
+    target : str
+        The directory to extract to. Defaults to '.', the current dir.
+    members : list of str or None
+        The names of the members to extract. Raises KeyError if any are
+        not in the zip file. Defaults to None, extracting everything.
+    workers : int or None
+        The number of threads extracting members. Each member of a zip
+        file is compressed independently, so they are decompressed as
+        well as written in parallel. Defaults to None, meaning
+        nosh.treeutils.DEFAULT_WORKERS.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    All the directories are created before any files are extracted, and
+    the permissions recorded by unix zip tools are applied.
+    '''
+    workers = treeutils.get_workers(workers)
+
+    if not path.exists(zip_path):
+        raise FileNotFoundError('Zip file {} does not exist'.format(zip_path))
+
+    if not path.exists(target) or not path.isdir(target):
+        raise FileNotFoundError(
+            'Cannot extract to {}, path does not exist'.format(target))
+
+    with zipfile.ZipFile(zip_path) as ziph:
+        if members is None:
+            infos = ziph.infolist()
+        else:
+            infos = [ziph.getinfo(name) for name in members]
+
+        directories = [info for info in infos if info.is_dir()]
+        files = [info for info in infos if not info.is_dir()]
+
+        made_dirs = set()
+        for info in directories:
+            made_dirs.add(_zip_member_path(target, info.filename))
+        for info in files:
+            made_dirs.add(path.dirname(_zip_member_path(target, info.filename)))
+        for directory in sorted(made_dirs):
+            os.makedirs(directory, exist_ok=True)
+
+        readers = _ZipReaders(zip_path)
+
+        def extract(info):
+            filen = readers.get().extract(info, target)
+            mode = _zip_mode(info)
+            if mode:
+                os.chmod(filen, mode)
+            _zip_member_done(info)
+
+        try:
+            for _ in treeutils.map_bounded(extract, files, workers):
+                pass
+        finally:
+            readers.close()
+
+    # Directory permissions last, in case they don't allow writing
+    for info in sorted(directories, key=lambda info: info.filename,
+                       reverse=True):
+        mode = _zip_mode(info)
+        if mode:
+            os.chmod(_zip_member_path(target, info.filename), mode)
@@ -0,0 +1,536 @@
+'''Batched operation plans, see plan.
+
+A Plan collects mv, cp, rm and mkdir operations and runs them together:
+
+    with nosh.plan(workers=4) as batch:
+        batch.mkdir('build')
+        batch.cp('src/*.c', 'build')
+        batch.rm('old_build', recursive=True)
+
+Nothing is changed until the plan runs (here, on leaving the block).
+Then every path is resolved and checked in one pass: the glob patterns
+of all the operations are expanded together, sharing directory
+listings, each distinct path is stat'ed and checked against nosh.state
+once, and the operations are simulated in order so later ones may
+depend on the effects of earlier ones (e.g. copying into a directory
+made earlier in the plan). All the problems found are raised together
+as a PlanError before anything is changed.
+
+The operations are then grouped into levels. Each operation goes in the
+level after the last earlier one touching any of the same paths, or
+their ancestors or descendants, so the operations within a level are
+independent of each other. Within a level they are ordered by directory
+for locality, and run in parallel if the plan has more than one worker.
+
+If an operation fails, the ones already done are undone in reverse.
+To make that possible, removed paths and overwritten files are first
+renamed to hidden trash paths beside them, and only deleted once every
+operation has succeeded.
+'''
+
+from os import path
+import threading
+from collections import namedtuple
+
+from nosh import copyutils
+from nosh import globbing
+from nosh import state
+from nosh import treeutils
+from nosh import vfs
+from nosh.utils import expand_path
+
+
+class PlanError(Exception):
+    '''Raised when a plan fails validation, or when an operation fails
+    as it runs (after the completed operations have been undone).
+    ``problems`` lists every problem found.'''
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super(PlanError, self).__init__(
+            '; '.join(str(problem) for problem in self.problems))
+
+
+Operation = namedtuple('Operation', ['command', 'source', 'target',
+                                     'recursive'])
+'''One resolved operation of a plan, acting on a single ``source`` and/or
+``target`` path. ``source`` is None for mkdir, and ``target`` None for
+rm. For mkdir, ``recursive`` means missing parents are made too.'''
+
+
+class _Simulation(object):
+    '''Tracks what the filesystem would look like after each operation,
+    stat'ing each real path and checking its permissions at most once.
+
+    Each change maps a path to None (removed), 'dir' (a new, empty
+    directory) or ('from', origin), meaning the path now holds what the
+    real path ``origin`` held when the plan started.
+    '''
+
+    def __init__(self):
+        self.kinds = {}
+        self.changes = {}
+        self.sequence = 0
+        self.readable = {}
+        self.writable = {}
+
+    def _disk_kind(self, filen):
+        kind = self.kinds.get(filen, False)
+        if kind is False:
+            try:
+                fs = vfs.get_filesystem()
+                kind = 'dir' if fs.isdir(filen) else (
+                    'file' if fs.lexists(filen) else None)
+            except OSError:
+                kind = None
+            self.kinds[filen] = kind
+        return kind
+
+    def _latest_change(self, filen):
+        '''Return the most recent change at or above ``filen``, and the
+        path components below the changed path.'''
+        latest = None
+        current = filen
+        relative = []
+        while True:
+            change = self.changes.get(current)
+            if change is not None and (latest is None or
+                                       change[0] > latest[0][0]):
+                latest = (change, list(reversed(relative)))
+            parent = path.dirname(current)
+            if parent == current:
+                return latest
+            relative.append(path.basename(current))
+            current = parent
+
+    def origin(self, filen):
+        '''Return the real path whose original contents ``filen`` would
+        hold, or None if it would be new or not exist.'''
+        latest = self._latest_change(filen)
+        if latest is None:
+            return filen if self._disk_kind(filen) is not None else None
+        (_, change), relative = latest
+        if isinstance(change, tuple) and change[1] is not None:
+            origin = path.join(change[1], *relative)
+            return origin if self._disk_kind(origin) is not None else None
+        return None
+
+    def kind(self, filen):
+        '''Return 'file', 'dir' or None if ``filen`` wouldn't exist.'''
+        latest = self._latest_change(filen)
+        if latest is None:
+            return self._disk_kind(filen)
+        (_, change), relative = latest
+        if change == 'dir':
+            return None if relative else 'dir'
+        if change is None:
+            return None
+        return self._disk_kind(path.join(change[1], *relative))
+
+    def change(self, filen, change):
+        self.sequence += 1
+        self.changes[filen] = (self.sequence, change)
+
+    def copied(self, source, target):
+        origin = self.origin(source)
+        self.change(target, 'dir' if origin is None else ('from', origin))
+
+    def is_readable(self, filen):
+        if filen not in self.readable:
+            self.readable[filen] = state.is_readable(filen)
+        return self.readable[filen]
+
+    def is_writable(self, filen):
+        if filen not in self.writable:
+            self.writable[filen] = state.is_writable(filen)
+        return self.writable[filen]
+
+
+def _expand_requests(requests):
+    '''Expand the paths of every request, with all the glob patterns
+    expanded in one go.'''
+    expanded_args = [[expand_path(arg) for arg in args]
+                     for _, args, _ in requests]
+    patterns = [arg for args in expanded_args for arg in args
+                if globbing.has_magic(arg)]
+    matches = iter(globbing.expand_globs_grouped(patterns))
+
+    expanded = []
+    for (command, _, options), args in zip(requests, expanded_args):
+        new_args = []
+        for arg in args:
+            if globbing.has_magic(arg):
+                new_args.extend(next(matches))
+            else:
+                new_args.append(arg)
+        expanded.append((command, new_args, options))
+    return expanded
+
+
+def _resolve_transfer(command, args, options, simulation, problems,
+                      operations):
+    sources, target = args[:-1], args[-1]
+    target_is_dir = simulation.kind(target) == 'dir'
+    if len(sources) > 1 and not target_is_dir:
+        problems.append(NotADirectoryError(
+            'Cannot {} multiple sources to {}, it is not a directory'.format(
+                command, target)))
+        return
+    if not sources:
+        problems.append(FileNotFoundError(
+            'Nothing matched the sources to {} to {}'.format(command, target)))
+
+    for source in sources:
+        kind = simulation.kind(source)
+        if kind is None:
+            problems.append(FileNotFoundError(
+                'Cannot {} {}, it does not exist'.format(command, source)))
+            continue
+        if command == 'cp' and kind == 'dir' and not options['recursive']:
+            problems.append(IsADirectoryError(
+                'Tried to copy directory {} but recursive is False'.format(
+                    source)))
+            continue
+
+        dest = path.join(target, path.basename(source)) if target_is_dir \
+            else target
+        dest_kind = simulation.kind(dest)
+        if dest_kind == 'dir' or (dest_kind is not None and kind == 'dir'):
+            problems.append(FileExistsError(
+                'Cannot {} {} to {}, it already exists'.format(
+                    command, source, dest)))
+            continue
+        if simulation.kind(path.dirname(dest)) != 'dir':
+            problems.append(FileNotFoundError(
+                'Cannot {} {} to {}, its directory does not exist'.format(
+                    command, source, dest)))
+            continue
+        if command == 'cp' and not simulation.is_readable(source):
+            problems.append(state.NotReadableError(source))
+            continue
+        if command == 'mv' and not simulation.is_writable(source):
+            problems.append(state.NotWritableError(source))
+            continue
+        if not simulation.is_writable(dest):
+            problems.append(state.NotWritableError(dest))
+            continue
+
+        operations.append(Operation(command, source, dest, kind == 'dir'))
+        simulation.copied(source, dest)
+        if command == 'mv':
+            simulation.change(source, None)
+
+
+def _resolve_rm(args, options, simulation, problems, operations):
+    for filen in args:
+        kind = simulation.kind(filen)
+        if kind is None:
+            problems.append(FileNotFoundError(
+                'Cannot remove {}, it does not exist'.format(filen)))
+        elif kind == 'dir' and not options['recursive']:
+            problems.append(IsADirectoryError(
+                'Cannot remove "{}": Is a directory'.format(filen)))
+        elif not simulation.is_writable(filen):
+            problems.append(state.NotWritableError(filen))
+        else:
+            operations.append(Operation('rm', filen, None, kind == 'dir'))
+            simulation.change(filen, None)
+
+
+def _resolve_mkdir(args, options, simulation, problems, operations):
+    dir_name, = args
+    kind = simulation.kind(dir_name)
+    if kind is not None:
+        if kind != 'dir' or not options['exist_ok']:
+            problems.append(FileExistsError(
+                'Cannot make directory {}, it already exists'.format(
+                    dir_name)))
+        return
+
+    missing = [dir_name]
+    parent = path.dirname(dir_name)
+    while simulation.kind(parent) is None and options['parents']:
+        missing.append(parent)
+        parent = path.dirname(parent)
+    if simulation.kind(parent) != 'dir':
+        problems.append(FileNotFoundError(
+            'Cannot make directory {}, its parent does not exist'.format(
+                dir_name)))
+    elif not simulation.is_writable(dir_name):
+        problems.append(state.NotWritableError(dir_name))
+    else:
+        operations.append(Operation('mkdir', None, dir_name,
+                                    options['parents']))
+        for filen in reversed(missing):
+            simulation.change(filen, 'dir')
+
+
+def _ancestors(filen):
+    '''Yield ``filen`` and every directory above it.'''
+    while True:
+        yield filen
+        parent = path.dirname(filen)
+        if parent == filen:
+            return
+        filen = parent
+
+
+def _operation_paths(operation):
+    '''Return the paths ``operation`` reads and the paths it writes.'''
+    if operation.command == 'cp':
+        return [operation.source], [operation.target]
+    return [], [filen for filen in (operation.source, operation.target)
+                if filen is not None]
+
+
+def assign_levels(operations):
+    '''Return ``operations`` grouped into lists that can each run in any
+    order, or in parallel, once the lists before them have run.
+
+    An operation must follow every earlier operation that writes to a
+    path it reads or writes, or reads a path it writes, where paths
+    conflict if they are the same or one is inside the other.
+    '''
+    # The highest level of an operation reading or writing each path
+    # exactly, or anything at or below each path
+    exact_read, exact_write = {}, {}
+    below_read, below_write = {}, {}
+
+    levels = []
+    for operation in operations:
+        reads, writes = _operation_paths(operation)
+        level = 0
+        for filen in reads:
+            level = max([level, below_write.get(filen, -1) + 1] +
+                        [exact_write.get(ancestor, -1) + 1
+                         for ancestor in _ancestors(filen)])
+        for filen in writes:
+            level = max([level, below_write.get(filen, -1) + 1,
+                         below_read.get(filen, -1) + 1] +
+                        [max(exact_write.get(ancestor, -1),
+                             exact_read.get(ancestor, -1)) + 1
+                         for ancestor in _ancestors(filen)])
+
+        for filens, exact, below in ((reads, exact_read, below_read),
+                                     (writes, exact_write, below_write)):
+            for filen in filens:
+                exact[filen] = max(exact.get(filen, -1), level)
+                for ancestor in _ancestors(filen):
+                    below[ancestor] = max(below.get(ancestor, -1), level)
+
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(operation)
+
+    for level in levels:
+        level.sort(key=lambda operation: path.dirname(
+            operation.target or operation.source))
+    return levels
+
+
+class _Journal(object):
+    '''Records how to undo each completed step, and the trash paths to
+    delete once the whole plan has succeeded.'''
+
+    def __init__(self):
+        self.undo = []
+        self.trash = []
+        self.lock = threading.Lock()
+
+    def add(self, undo=None, trash=None):
+        with self.lock:
+            if undo is not None:
+                self.undo.append(undo)
+            if trash is not None:
+                self.trash.append(trash)
+
+    def set_aside(self, filen):
+        '''Move ``filen`` to a trash path, to restore on rollback or
+        delete on success.'''
+        fs = vfs.get_filesystem()
+        trash = treeutils.trash_path(filen)
+        fs.rename(filen, trash)
+        self.add(lambda: fs.rename(trash, filen), trash)
+
+
+def _remove(filen):
+    fs = vfs.get_filesystem()
+    if fs.isdir(filen) and not fs.islink(filen):
+        fs.rmtree(filen)
+    elif fs.lexists(filen):
+        fs.unlink(filen)
+
+
+def _run_operation(operation, journal):
+    command, source, target, recursive = operation
+    fs = vfs.get_filesystem()
+
+    if command == 'mkdir':
+        missing = [target]
+        while recursive and not fs.exists(path.dirname(missing[-1])):
+            missing.append(path.dirname(missing[-1]))
+        for dir_name in reversed(missing):
+            fs.mkdir(dir_name)
+            journal.add(lambda dir_name=dir_name: fs.rmdir(dir_name))
+
+    elif command == 'rm':
+        journal.set_aside(source)
+
+    else:
+        if fs.lexists(target):
+            journal.set_aside(target)
+        if command == 'mv':
+            fs.move(source, target)
+            journal.add(lambda: fs.move(target, source))
+        else:
+            journal.add(lambda: _remove(target))
+            if recursive:
+                copied_dirs = []
+                results = treeutils.copy_files(
+                    treeutils.iter_tree_copy(source, target, copied_dirs),
+                    workers=1)
+                results.extend(treeutils.copy_dir_stats(copied_dirs))
+                for result in results:
+                    if result.error is not None:
+                        raise result.error
+            else:
+                copyutils.copy(source, target)
+
+
+class Plan(object):
+    '''A batch of operations, validated and run together. See the
+    module docstring, and plan.
+
+    The operation methods take the same arguments as the commands of the
+    same name in nosh.shell, and return the plan so calls can be
+    chained.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = treeutils.get_workers(workers)
+        self.requests = []
+        self.ran = False
+
+    def _add(self, command, args, **options):
+        if self.ran:
+            raise ValueError('This plan has already run')
+        self.requests.append((command, args, options))
+        return self
+
+    def mv(self, *args):
+        if len(args) < 2:
+            raise ValueError('mv takes at least 2 arguments, but {} '
+                             'given'.format(len(args)))
+        return self._add('mv', args)
+
+    def cp(self, *args, recursive=False):
+        if len(args) < 2:
+            raise ValueError('cp takes at least 2 arguments, but {} '
+                             'given'.format(len(args)))
+        return self._add('cp', args, recursive=recursive)
+
+    def rm(self, *args, recursive=False):
+        return self._add('rm', args, recursive=recursive)
+
+    def mkdir(self, dir_name, parents=False, exist_ok=False):
+        return self._add('mkdir', (dir_name, ), parents=parents,
+                         exist_ok=exist_ok)
+
+    def validate(self):
+        '''Resolve and check every operation without changing anything.
+
+        Returns
+        -------
+        list of lists of Operation
+            The levels the operations would run in, see assign_levels.
+
+        Raises PlanError listing every problem found.
+        '''
+        simulation = _Simulation()
+        problems = []
+        operations = []
+        for command, args, options in _expand_requests(self.requests):
+            if command in ('mv', 'cp'):
+                _resolve_transfer(command, args, options, simulation,
+                                  problems, operations)
+            elif command == 'rm':
+                _resolve_rm(args, options, simulation, problems, operations)
+            else:
+                _resolve_mkdir(args, options, simulation, problems,
+                               operations)
+        if problems:
+            raise PlanError(problems)
+        return assign_levels(operations)
+
+    def run(self):
+        '''Validate and run the plan, undoing it if any operation fails.
+
+        Returns
+        -------
+        list of Operation
+            The operations run, in the order they were started.
+
+        Raises PlanError, with the operation failures and any failures
+        to undo, if an operation failed.
+        '''
+        levels = self.validate()
+        self.ran = True
+
+        journal = _Journal()
+
+        def run_operation(operation):
+            try:
+                _run_operation(operation, journal)
+            except Exception as error:
+                return operation, error
+            return operation, None
+
+        completed = []
+        try:
+            for level in levels:
+                results = list(treeutils.map_bounded(
+                    run_operation, level, workers=self.workers))
+                errors = [error for _, error in results if error is not None]
+                completed.extend(operation for operation, _ in results)
+                if errors:
+                    raise PlanError(errors)
+        except BaseException as error:
+            failures = _rollback(journal)
+            if failures:
+                raise PlanError([error] + failures) from error
+            raise
+
+        for trash in journal.trash:
+            _remove(trash)
+        return completed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+
+def _rollback(journal):
+    failures = []
+    for undo in reversed(journal.undo):
+        try:
+            undo()
+        except OSError as error:
+            failures.append(error)
+    return failures
+
+
+def plan(workers=None):
+    '''Return a new Plan. Operations added to it run together when its
+    run method is called, or on leaving it when used as a context
+    manager.
+
+    Parameters
+    ----------
+    workers : int or None
+        The number of threads to run independent operations in.
+        Defaults to None, meaning treeutils.DEFAULT_WORKERS.
+    '''
+    return Plan(workers)
@@ -0,0 +1,497 @@
+'''Benchmarks for the nosh commands.
+
+Run with ``python -m nosh.bench``. Synthetic trees are generated in a
+temporary directory (or ``--dir``), each command is timed on each tree
+and the results are printed as seconds, files/s and MB/s:
+
+    python -m nosh.bench --output before.json
+    # ...change something...
+    python -m nosh.bench --output after.json --compare before.json
+
+The trees, built by make_tree, are:
+
+small
+    Many small files: 20 directories of 250 files of 1 KiB.
+huge
+    A few huge files: 4 files of 16 MiB.
+deep
+    Deep nesting: 64 nested directories, with 4 files of 4 KiB in each.
+wide
+    A wide directory: 10000 files of 256 bytes in one directory.
+
+``--scale`` multiplies the file counts (or, for the huge tree, the
+sizes). As well as the per-tree benchmarks there are measurements of
+the cost the decorators (expand_paths, the permission checks etc.) add
+to each call, of nosh.state permission checks against many allowed
+roots, and of tar's parallel compression with different thread counts.
+
+Each benchmark runs ``--repeat`` times and the fastest run is reported,
+so that noise from other processes only ever makes results slower.
+'''
+
+import argparse
+import fnmatch
+import inspect
+import json
+import os
+from os import path
+import platform
+import random
+import time
+
+from nosh import archives
+from nosh import dirutils
+from nosh import estimate
+from nosh import globbing
+from nosh import hashing
+from nosh import shell
+from nosh import state
+from nosh import utils
+
+RESULTS_VERSION = 1
+
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+'''The relative change in time compare reports as a regression or
+improvement.'''
+
+OVERHEAD_CALLS = 2000
+STATE_CHECKS = 2000
+STATE_ROOT_COUNTS = (1, 100, 5000)
+
+_BLOCK_SIZE = 1024 * 1024
+_block = None
+
+
+def _data_block():
+    # Semi-compressible text, so compression has something to do
+    global _block
+    if _block is None:
+        rand = random.Random(0)
+        words = [bytes(rand.choice(b'abcdefghijklmnop') for _ in range(8))
+                 for _ in range(4096)]
+        _block = b' '.join(rand.choice(words)
+                           for _ in range(_BLOCK_SIZE // 9 + 1))[:_BLOCK_SIZE]
+    return _block
+
+
+def _write_file(filen, size):
+    block = _data_block()
+    with open(filen, 'wb') as fileh:
+        while size > 0:
+            fileh.write(block[:size])
+            size -= len(block)
+
+
+def _scaled(count, scale):
+    return max(1, int(count * scale))
+
+
+def _build_small(root, scale):
+    for dir_index in range(_scaled(20, scale)):
+        directory = path.join(root, 'dir{}'.format(dir_index))
+        os.makedirs(directory)
+        for file_index in range(250):
+            _write_file(path.join(directory, 'file{}.txt'.format(file_index)),
+                        1024)
+
+
+def _build_huge(root, scale):
+    os.makedirs(root)
+    for index in range(4):
+        _write_file(path.join(root, 'huge{}.bin'.format(index)),
+                    _scaled(16 * 1024 * 1024, scale))
+
+
+def _build_deep(root, scale):
+    directory = root
+    for depth in range(_scaled(64, scale)):
+        directory = path.join(directory, 'level{}'.format(depth))
+        os.makedirs(directory)
+        for index in range(4):
+            _write_file(path.join(directory, 'file{}.txt'.format(index)),
+                        4096)
+
+
+def _build_wide(root, scale):
+    os.makedirs(root)
+    for index in range(_scaled(10000, scale)):
+        _write_file(path.join(root, 'file{}.txt'.format(index)), 256)
+
+
+TREES = {'small': _build_small, 'huge': _build_huge, 'deep': _build_deep,
+         'wide': _build_wide}
+'''The synthetic tree builders, by name.'''
+
+
+def make_tree(root, shape, scale=1.0):
+    '''Build the synthetic tree ``shape`` (a key of TREES) at ``root``,
+    returning its estimate.Size.'''
+    TREES[shape](root, scale)
+    return estimate.measure(root)
+
+
+def best_time(func, setup=None, repeat=DEFAULT_REPEAT):
+    '''Return the fastest of ``repeat`` timed calls of ``func``,
+    calling ``setup`` untimed before each.'''
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def result(name, seconds, files=0, nbytes=0, **extra):
+    '''Return the JSON-ready record of one benchmark.'''
+    record = {'name': name, 'seconds': seconds, 'files': files,
+              'bytes': nbytes,
+              'files_per_second': files / seconds if files else None,
+              'mb_per_second': (nbytes / 1e6 / seconds if nbytes else None)}
+    record.update(extra)
+    return record
+
+
+def _remove(filen):
+    if path.isdir(filen):
+        shell.rm(filen, recursive=True)
+    elif path.exists(filen):
+        os.unlink(filen)
+
+
+def _extraction_setup(directory, archive, create):
+    # Extract into a new directory each time, creating the archive if
+    # the benchmark making it didn't run
+    def setup():
+        if not path.exists(archive):
+            create()
+        _remove(directory)
+        os.mkdir(directory)
+    return setup
+
+
+def tree_benchmarks(workdir, shape, scale=1.0):
+    '''Yield (name, func, setup, files, nbytes) for each benchmark of the
+    tree ``shape``, built in ``workdir``.'''
+    source = path.join(workdir, shape)
+    size = make_tree(source, shape, scale)
+    files = size.files + size.directories
+    copy = path.join(workdir, shape + '-copy')
+    synced = path.join(workdir, shape + '-synced')
+    doomed = path.join(workdir, shape + '-doomed')
+    tarball = path.join(workdir, shape + '.tar.gz')
+    zip_file = path.join(workdir, shape + '.zip')
+    extracted = path.join(workdir, shape + '-extracted')
+
+    def name(command):
+        return '{}/{}'.format(command, shape)
+
+    yield (name('cp'), lambda: shell.cp(source, copy, recursive=True),
+           lambda: _remove(copy), files, size.bytes)
+    yield (name('sync-unchanged'), lambda: shell.sync(source, synced),
+           lambda: shell.sync(source, synced), files, size.bytes)
+    yield (name('find'), lambda: list(shell.find(source)), None, files, 0)
+    yield (name('ls'), lambda: shell.ls(source), None,
+           len(os.listdir(source)), 0)
+    yield (name('checksum'), lambda: shell.checksum(
+        source, recursive=True, cache=hashing.HashCache()), None,
+        size.files, size.bytes)
+    def make_tarball():
+        archives.tar(source, tarball)
+
+    def make_zip_file():
+        archives.zip(source, zip_file, recursive=True)
+
+    yield (name('tar'), make_tarball, lambda: _remove(tarball), files,
+           size.bytes)
+    yield (name('untar'), lambda: archives.untar(tarball, extracted),
+           _extraction_setup(extracted, tarball, make_tarball), files,
+           size.bytes)
+    yield (name('zip'), make_zip_file, lambda: _remove(zip_file), files,
+           size.bytes)
+    yield (name('unzip'), lambda: archives.unzip(zip_file, extracted),
+           _extraction_setup(extracted, zip_file, make_zip_file), files,
+           size.bytes)
+    yield (name('rm'), lambda: shell.rm(doomed, recursive=True),
+           lambda: shell.cp(source, doomed, recursive=True), files,
+           size.bytes)
+
+
+def overhead_benchmarks(workdir):
+    '''Yield (name, decorated, undecorated) call pairs measuring the
+    cost the command decorators add to each call.'''
+    directory = path.join(workdir, 'overhead')
+    os.makedirs(directory)
+    filen = path.join(directory, 'file.txt')
+    _write_file(filen, 16)
+    target = path.join(directory, 'copy.txt')
+    paths = [path.join(directory, 'file{}.txt'.format(index))
+             for index in range(100)]
+
+    def raw(command):
+        return inspect.unwrap(command)
+
+    yield ('ls', lambda: shell.ls(directory),
+           lambda: raw(shell.ls)(directory))
+    yield ('touch', lambda: shell.touch(filen),
+           lambda: raw(shell.touch)(filen))
+    yield ('cp', lambda: shell.cp(filen, target),
+           lambda: raw(shell.cp)(filen, target))
+    yield ('mkdir', lambda: shell.mkdir(directory, exist_ok=True),
+           lambda: raw(shell.mkdir)(directory, exist_ok=True))
+    expand = utils.expand_paths()(lambda *args: args)
+    yield ('expand_paths-100', lambda: expand(*paths), lambda: paths)
+    pattern = path.join(directory, '*.txt')
+    yield ('expand_paths-glob', lambda: expand(pattern),
+           lambda: globbing.glob(pattern))
+
+
+def run_overhead(workdir, calls=OVERHEAD_CALLS, repeat=DEFAULT_REPEAT):
+    results = []
+    for name, decorated, undecorated in overhead_benchmarks(workdir):
+        def loop(func):
+            def run():
+                for _ in range(calls):
+                    func()
+            return run
+        wrapped = best_time(loop(decorated), repeat=repeat) / calls
+        unwrapped = best_time(loop(undecorated), repeat=repeat) / calls
+        results.append(result('overhead/' + name, wrapped,
+                              undecorated_seconds=unwrapped,
+                              overhead_seconds=wrapped - unwrapped))
+    return results
+
+
+def run_state(root_counts=STATE_ROOT_COUNTS, checks=STATE_CHECKS,
+              repeat=DEFAULT_REPEAT):
+    '''Time nosh.state.is_readable with growing numbers of allowed
+    roots, with and without its verdict cache.'''
+    results = []
+    for root_count in root_counts:
+        roots = ['/srv/project{}/data'.format(i) for i in range(root_count)]
+        # Only the last root matches
+        target = '/srv/project{}/data/a/b/c/file.txt'.format(root_count - 1)
+        index = state.PathIndex(roots)
+
+        def cached():
+            for _ in range(checks):
+                state.is_readable(target)
+
+        def uncached():
+            for _ in range(checks):
+                index._contains(target)
+
+        with state.set_readable(*roots):
+            results.append(result(
+                'state/is_readable/{}'.format(root_count),
+                best_time(cached, repeat=repeat) / checks))
+        results.append(result(
+            'state/is_readable-uncached/{}'.format(root_count),
+            best_time(uncached, repeat=repeat) / checks))
+    return results
+
+
+def run_tar_threads(workdir, scale=1.0, repeat=DEFAULT_REPEAT):
+    '''Time tar's parallel compression of the huge tree with each codec
+    and thread count.'''
+    source = path.join(workdir, 'threads')
+    size = make_tree(source, 'huge', scale)
+    tarball = path.join(workdir, 'threads.tar')
+    results = []
+    for compress in ('gz', 'bz2'):
+        for threads in sorted({1, 2, 4, os.cpu_count() or 1}):
+            seconds = best_time(
+                lambda: archives.tar(source, tarball, compress=compress,
+                                     threads=threads),
+                setup=lambda: _remove(tarball), repeat=repeat)
+            results.append(result(
+                'tar-threads/{}/{}'.format(compress, threads), seconds,
+                size.files, size.bytes,
+                ratio=path.getsize(tarball) / size.bytes))
+    _remove(tarball)
+    return results
+
+
+def _selected(name, only):
+    return not only or any(fnmatch.fnmatch(name, pattern)
+                           for pattern in only)
+
+
+def _group_selected(group, only):
+    # Whether any benchmark named '<group>/...' might be selected
+    return not only or any(fnmatch.fnmatch(group, pattern.split('/')[0])
+                           for pattern in only)
+
+
+def run(workdir, scale=1.0, repeat=DEFAULT_REPEAT, only=None,
+        report=None):
+    '''Run the benchmarks in ``workdir``, returning their results.
+
+    Parameters
+    ----------
+    workdir : str
+        An empty directory to build the trees in.
+    scale : float
+        Multiplies the sizes of the trees. Defaults to 1.
+    repeat : int
+        The number of times to run each benchmark, keeping the fastest.
+        Defaults to DEFAULT_REPEAT.
+    only : list of str or None
+        Glob patterns of benchmark names to run, e.g. 'cp/*' or
+        '*/small'. Defaults to None, running all of them.
+    report : callable or None
+        Called with each result as it is measured.
+    '''
+    results = []
+
+    def add(records):
+        for record in records:
+            results.append(record)
+            if report is not None:
+                report(record)
+
+    for shape in TREES:
+        if not any(_selected('{}/{}'.format(command, shape), only)
+                   for command in ('cp', 'sync-unchanged', 'find', 'ls',
+                                   'checksum', 'tar', 'untar', 'zip',
+                                   'unzip', 'rm')):
+            continue
+        for name, func, setup, files, nbytes in tree_benchmarks(
+                workdir, shape, scale):
+            if _selected(name, only):
+                add([result(name, best_time(func, setup, repeat), files,
+                            nbytes)])
+    if _group_selected('overhead', only):
+        add(record for record in run_overhead(workdir, repeat=repeat)
+            if _selected(record['name'], only))
+    if _group_selected('state', only):
+        add(record for record in run_state(repeat=repeat)
+            if _selected(record['name'], only))
+    if _group_selected('tar-threads', only):
+        add(record for record in run_tar_threads(workdir, scale, repeat)
+            if _selected(record['name'], only))
+    return results
+
+
+def environment():
+    '''Return a description of the machine the benchmarks ran on.'''
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def save(filen, results, **settings):
+    '''Write ``results`` to the JSON file ``filen``, with the
+    environment and ``settings`` they were measured with.'''
+    document = {'version': RESULTS_VERSION, 'environment': environment(),
+                'settings': settings, 'results': results}
+    with open(filen, 'w') as fileh:
+        json.dump(document, fileh, indent=1)
+
+
+def load(filen):
+    '''Return the results saved in the JSON file ``filen``.'''
+    with open(filen) as fileh:
+        document = json.load(fileh)
+    if document.get('version') != RESULTS_VERSION:
+        raise ValueError('{} is not a version {} nosh benchmark '
+                         'file'.format(filen, RESULTS_VERSION))
+    return document['results']
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    '''Compare two lists of results by name.
+
+    Returns
+    -------
+    list of (str, float, float, float, str)
+        The name, old and new seconds, the ratio new/old and a verdict
+        ('slower', 'faster' or '') for each benchmark in both lists. The
+        verdict is only given if the time changed by more than
+        ``threshold``.
+    '''
+    old_seconds = {record['name']: record['seconds'] for record in old}
+    comparison = []
+    for record in new:
+        if record['name'] not in old_seconds:
+            continue
+        before = old_seconds[record['name']]
+        ratio = record['seconds'] / before if before else float('inf')
+        verdict = ''
+        if ratio > 1 + threshold:
+            verdict = 'slower'
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        comparison.append((record['name'], before, record['seconds'], ratio,
+                           verdict))
+    return comparison
+
+
+def _format_rate(rate):
+    return '-' if rate is None else '{:.1f}'.format(rate)
+
+
+def print_result(record, file=None):
+    line = '{:<32} {:>12.6f} {:>12} {:>10}'.format(
+        record['name'], record['seconds'],
+        _format_rate(record['files_per_second']),
+        _format_rate(record['mb_per_second']))
+    if 'overhead_seconds' in record:
+        line += '  ({:+.1f} us from decorators)'.format(
+            record['overhead_seconds'] * 1e6)
+    print(line, file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m nosh.bench',
+        description='Benchmark the nosh commands on synthetic trees.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the size of every tree')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='runs of each benchmark, keeping the fastest')
+    parser.add_argument('--only', action='append',
+                        help='glob pattern of benchmarks to run, e.g. '
+                        '"cp/*" (may be repeated)')
+    parser.add_argument('--dir',
+                        help='directory to build trees in (default: a '
+                        'temporary directory, deleted afterwards)')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='JSON file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change reported as slower or faster')
+    args = parser.parse_args(argv)
+
+    print('{:<32} {:>12} {:>12} {:>10}'.format(
+        'benchmark', 'seconds', 'files/s', 'MB/s'))
+    settings = {'scale': args.scale, 'repeat': args.repeat,
+                'only': args.only}
+    if args.dir is not None:
+        os.makedirs(args.dir, exist_ok=True)
+        results = run(args.dir, args.scale, args.repeat, args.only,
+                      print_result)
+    else:
+        with dirutils.temp_directory() as workdir:
+            results = run(workdir, args.scale, args.repeat, args.only,
+                          print_result)
+
+    if args.output is not None:
+        save(args.output, results, **settings)
+
+    if args.compare is not None:
+        print()
+        print('{:<32} {:>12} {:>12} {:>8}'.format(
+            'benchmark', 'before', 'after', 'ratio'))
+        for name, before, after, ratio, verdict in compare(
+                load(args.compare), results, args.threshold):
+            print('{:<32} {:>12.6f} {:>12.6f} {:>8.2f} {}'.format(
+                name, before, after, ratio, verdict))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''Caching of file digests, shared by the commands that compare file
+contents: checksum, cp(verify=True), sync(checksum=True), dedupe and
+cp(dedupe=...).
+
+Digests are stored by (device, inode, size, mtime_ns), so a file that
+hasn't changed since it was last hashed is never read again. By default
+commands share one in-memory cache for the life of the process. To
+reuse digests across processes, set a persistent cache stored with
+sqlite3:
+
+    nosh.cache.set_default_cache(nosh.cache.open_cache())
+
+or pass a cache to a single command, or to all the commands run within
+a block with use_cache.
+'''
+
+import os
+from os import path
+import sqlite3
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from nosh import hashing
+
+DEFAULT_CACHE_PATH = path.join(
+    os.environ.get('XDG_CACHE_HOME') or path.expanduser(path.join('~', '.cache')),
+    'nosh', 'digests.sqlite')
+DEFAULT_MAX_ENTRIES = 1000000
+MEMORY_MAX_ENTRIES = 100000
+COMMIT_INTERVAL = 1000
+PRUNE_FRACTION = 0.9
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, algorithm, length)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS digests_used ON digests (used);
+'''
+
+
+def _to_row(key):
+    dev, ino, size, mtime_ns, algorithm, limit = key
+    # sqlite integers are signed 64 bit, but devices and inodes needn't be
+    dev, ino = (value - 2 ** 64 if value >= 2 ** 63 else value
+                for value in (dev, ino))
+    return (dev, ino, size, mtime_ns, algorithm, -1 if limit is None else limit)
+
+
+def _close(connection):
+    try:
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class SqliteHashCache(hashing.HashCache):
+    '''A HashCache stored in an sqlite3 database at ``filen``, so it
+    persists between processes, and may be shared by several at once.
+
+    At most ``max_entries`` digests are kept: when there are more, the
+    least recently used are deleted until PRUNE_FRACTION of the limit
+    remain. Changes are committed every COMMIT_INTERVAL writes and when
+    the cache is flushed, closed or garbage collected.
+    '''
+
+    def __init__(self, filen=DEFAULT_CACHE_PATH,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        super(SqliteHashCache, self).__init__(max_entries)
+        self.filen = filen
+        if filen != ':memory:':
+            os.makedirs(path.dirname(path.abspath(filen)), exist_ok=True)
+        # Used from worker threads, always under self._lock
+        self._connection = sqlite3.connect(filen, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        self._count = self._connection.execute(
+            'SELECT COUNT(*) FROM digests').fetchone()[0]
+        self._writes = 0
+        self._finalizer = weakref.finalize(self, _close, self._connection)
+
+    def _written(self):
+        self._writes += 1
+        if self._writes >= COMMIT_INTERVAL:
+            self._connection.commit()
+            self._writes = 0
+
+    def lookup(self, key):
+        row = _to_row(key)
+        with self._lock:
+            found = self._connection.execute(
+                'SELECT digest FROM digests WHERE dev=? AND ino=? AND size=? '
+                'AND mtime_ns=? AND algorithm=? AND length=?', row).fetchone()
+            if found is None:
+                return None
+            self._connection.execute(
+                'UPDATE digests SET used=? WHERE dev=? AND ino=? AND size=? '
+                'AND mtime_ns=? AND algorithm=? AND length=?',
+                (time.time_ns(), ) + row)
+            self._written()
+            return found[0]
+
+    def store(self, key, digest):
+        row = _to_row(key)
+        with self._lock:
+            # Only count new rows, so that re-storing a key doesn't make
+            # _count drift up and prune early
+            updated = self._connection.execute(
+                'UPDATE digests SET digest=?, used=? WHERE dev=? AND ino=? '
+                'AND size=? AND mtime_ns=? AND algorithm=? AND length=?',
+                (digest, time.time_ns()) + row).rowcount
+            if not updated:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO digests '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    row + (digest, time.time_ns()))
+                self._count += 1
+            self._written()
+            if self.max_entries is not None and self._count > self.max_entries:
+                self._prune()
+
+    def _prune(self):
+        self._count = self._connection.execute(
+            'SELECT COUNT(*) FROM digests').fetchone()[0]
+        excess = self._count - int(self.max_entries * PRUNE_FRACTION)
+        if excess > 0 and self._count > self.max_entries:
+            self._connection.execute(
+                'DELETE FROM digests WHERE (dev, ino, size, mtime_ns, '
+                'algorithm, length) IN (SELECT dev, ino, size, mtime_ns, '
+                'algorithm, length FROM digests ORDER BY used LIMIT ?)',
+                (excess, ))
+            self._count -= excess
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM digests').fetchone()[0]
+
+    def flush(self):
+        '''Commit the digests stored so far.'''
+        with self._lock:
+            self._connection.commit()
+            self._writes = 0
+
+    def close(self):
+        with self._lock:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_cache(filen=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+    '''Return a SqliteHashCache stored at ``filen``, by default in the
+    user's cache directory.'''
+    return SqliteHashCache(filen, max_entries)
+
+
+_default_cache = hashing.HashCache(MEMORY_MAX_ENTRIES)
+_CACHE = ContextVar('nosh_hash_cache', default=None)
+
+
+def set_default_cache(cache):
+    '''Make ``cache`` the cache used by every command not given one
+    explicitly (outside use_cache blocks). Returns the previous default.'''
+    global _default_cache
+    previous, _default_cache = _default_cache, cache
+    return previous
+
+
+@contextmanager
+def use_cache(cache):
+    '''Context manager making the commands run within it in this thread
+    or task use ``cache`` unless given one explicitly.'''
+    token = _CACHE.set(cache)
+    try:
+        yield cache
+    finally:
+        _CACHE.reset(token)
+
+
+def get_cache(cache=None):
+    '''Return ``cache`` if it isn't None, otherwise the cache set with
+    use_cache, otherwise the default cache.'''
+    if cache is not None:
+        return cache
+    current = _CACHE.get()
+    if current is not None:
+        return current
+    return _default_cache
@@ -0,0 +1,319 @@
+'''Compression codecs for archives.
+
+CODECS holds a Codec for each supported compression format: gzip, bz2
+and xz from the standard library, plus zstd and lz4 if the
+``zstandard`` or ``lz4`` modules are installed. Further codecs can be
+added with register_codec. detect_codec identifies the codec of an
+existing file from its leading magic bytes.
+
+The parallel writers here are write-only file objects that split the
+data into blocks and compress the blocks in a pool of threads (zlib,
+bz2 and lzma release the GIL while compressing), writing the results
+out in order, in the style of pigz and pbzip2. The output is an
+ordinary compressed file that any decompressor, including tarfile, can
+read.
+'''
+
+import bz2
+import gzip as _gzip
+import lzma
+import struct
+import time
+import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_WINDOW_SIZE = 32 * 1024
+BZ2_BLOCK_SIZE = 900 * 1000
+XZ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class _ParallelWriter(object):
+    '''Base class for the parallel compressing writers. Subclasses
+    implement _compress_block, and optionally _header and _trailer.'''
+
+    block_size = GZIP_BLOCK_SIZE
+
+    def __init__(self, fileobj, threads, level=9):
+        if threads < 1:
+            raise ValueError('threads must be at least 1, got {}'.format(
+                threads))
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.closed = False
+        self.fileobj.write(self._header())
+
+    def _header(self):
+        return b''
+
+    def _trailer(self):
+        return b''
+
+    def _compress_block(self, data, previous, final):
+        raise NotImplementedError()
+
+    def _submit(self, data, final):
+        previous = getattr(self, '_previous', b'')
+        self._previous = bytes(data[-GZIP_WINDOW_SIZE:])
+        self._update(data)
+        self.pending.append(self.executor.submit(
+            self._compress_block, bytes(data), previous, final))
+        # Bound the memory used by blocks waiting to be written
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _update(self, data):
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(self.buffer[:self.block_size], False)
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(self.buffer, True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(self._trailer())
+            self.fileobj.flush()
+        finally:
+            self.closed = True
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParallelGzipWriter(_ParallelWriter):
+    '''Writes a single gzip member, compressing 1 MiB blocks of raw
+    deflate data in parallel.
+
+    Each block but the last ends with a sync flush, so the blocks join
+    up into one valid deflate stream, and is primed with the last 32 KiB
+    of the previous block so the compression ratio stays close to that
+    of single threaded gzip.
+    '''
+
+    block_size = GZIP_BLOCK_SIZE
+
+    def __init__(self, fileobj, threads, level=9):
+        self.crc = 0
+        self.size = 0
+        super(ParallelGzipWriter, self).__init__(fileobj, threads, level)
+
+    def _header(self):
+        return struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, int(time.time()),
+                           2 if self.level == 9 else 0, 255)
+
+    def _trailer(self):
+        return struct.pack('<LL', self.crc, self.size & 0xffffffff)
+
+    def _update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def _compress_block(self, data, previous, final):
+        if previous:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS, zdict=previous)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+        compressed = compressor.compress(data)
+        return compressed + compressor.flush(
+            zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelBz2Writer(_ParallelWriter):
+    '''Writes a series of bz2 streams, each compressed in parallel from
+    one 900 kB block. Decompressors (including Python's bz2 module)
+    read concatenated streams as a single file.
+    '''
+
+    block_size = BZ2_BLOCK_SIZE
+
+    def _compress_block(self, data, previous, final):
+        if not data:
+            return b''
+        return bz2.compress(data, self.level)
+
+
+class ParallelXzWriter(_ParallelWriter):
+    '''Writes a series of xz streams, each compressed in parallel from
+    one 4 MiB block. Like bz2, xz decompressors read concatenated
+    streams as a single file.
+    '''
+
+    block_size = XZ_BLOCK_SIZE
+
+    def _compress_block(self, data, previous, final):
+        return lzma.compress(data, preset=self.level)
+
+
+class Codec(object):
+    '''A compression format.
+
+    Attributes
+    ----------
+    name : str
+        The name used for the ``compress`` argument of the archive
+        commands.
+    magic : bytes
+        The bytes every compressed file starts with.
+    default_level : int
+        The compression level used when none is given.
+    levels : range
+        The valid compression levels.
+    tarfile_name : str or None
+        The name tarfile uses for this codec (e.g. 'gz' in 'w:gz'), if
+        tarfile supports it natively.
+    tarfile_level_kwarg : str or None
+        The keyword tarfile.open takes the compression level as.
+    parallel_writer : class or None
+        A _ParallelWriter subclass for multi-threaded compression.
+    aliases : tuple of str
+        Alternative names for ``name``.
+    '''
+
+    def __init__(self, name, magic, default_level, levels,
+                 tarfile_name=None, tarfile_level_kwarg=None,
+                 open_writer=None, open_reader=None,
+                 parallel_writer=None, aliases=()):
+        self.name = name
+        self.magic = magic
+        self.default_level = default_level
+        self.levels = levels
+        self.tarfile_name = tarfile_name
+        self.tarfile_level_kwarg = tarfile_level_kwarg
+        self._open_writer = open_writer
+        self._open_reader = open_reader
+        self.parallel_writer = parallel_writer
+        self.aliases = aliases
+
+    def check_level(self, level):
+        '''Return ``level``, or the default level if it is None.'''
+        if level is None:
+            return self.default_level
+        if level not in self.levels:
+            raise ValueError(
+                'level for {} must be from {} to {}, got {}'.format(
+                    self.name, self.levels[0], self.levels[-1], level))
+        return level
+
+    def open_writer(self, fileobj, level=None, threads=1):
+        '''Return a write-only file object compressing into ``fileobj``.
+        Closing it does not close ``fileobj``.'''
+        level = self.check_level(level)
+        if threads > 1 and self.parallel_writer is not None:
+            return self.parallel_writer(fileobj, threads, level)
+        return self._open_writer(fileobj, level)
+
+    def open_reader(self, fileobj):
+        '''Return a read-only file object decompressing ``fileobj``.'''
+        return self._open_reader(fileobj)
+
+    def __repr__(self):
+        return '<Codec {}>'.format(self.name)
+
+
+CODECS = OrderedDict()
+'''The available codecs, by name.'''
+
+
+def register_codec(codec):
+    '''Make ``codec`` available to the archive commands.'''
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    '''Return the Codec called ``name`` (or one of its aliases), or None
+    if ``name`` is None, meaning no compression.'''
+    if name is None:
+        return None
+    for codec in CODECS.values():
+        if name == codec.name or name in codec.aliases:
+            return codec
+    raise ValueError('compress must be None or one of {}, got {}'.format(
+        list(CODECS), name))
+
+
+MAGIC_LENGTH = 8
+
+
+def detect_codec(filen):
+    '''Return the Codec whose magic bytes begin the file ``filen``, or
+    None if it doesn't look compressed by any registered codec.'''
+    with open(filen, 'rb') as fileh:
+        start = fileh.read(MAGIC_LENGTH)
+    for codec in CODECS.values():
+        if start.startswith(codec.magic):
+            return codec
+    return None
+
+
+register_codec(Codec(
+    'gz', b'\x1f\x8b', 9, range(0, 10),
+    tarfile_name='gz', tarfile_level_kwarg='compresslevel',
+    open_writer=lambda fileobj, level: _gzip.GzipFile(
+        fileobj=fileobj, mode='wb', compresslevel=level),
+    open_reader=lambda fileobj: _gzip.GzipFile(fileobj=fileobj, mode='rb'),
+    parallel_writer=ParallelGzipWriter, aliases=('gzip', )))
+
+register_codec(Codec(
+    'bz2', b'BZh', 9, range(1, 10),
+    tarfile_name='bz2', tarfile_level_kwarg='compresslevel',
+    open_writer=lambda fileobj, level: bz2.BZ2File(
+        fileobj, mode='wb', compresslevel=level),
+    open_reader=lambda fileobj: bz2.BZ2File(fileobj, mode='rb'),
+    parallel_writer=ParallelBz2Writer, aliases=('bzip2', )))
+
+register_codec(Codec(
+    'xz', b'\xfd7zXZ\x00', 6, range(0, 10),
+    tarfile_name='xz', tarfile_level_kwarg='preset',
+    open_writer=lambda fileobj, level: lzma.LZMAFile(
+        fileobj, mode='wb', preset=level),
+    open_reader=lambda fileobj: lzma.LZMAFile(fileobj, mode='rb'),
+    parallel_writer=ParallelXzWriter, aliases=('lzma', )))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+else:
+    register_codec(Codec(
+        'zst', b'\x28\xb5\x2f\xfd', 3, range(1, 23),
+        open_writer=lambda fileobj, level: zstandard.ZstdCompressor(
+            level=level).stream_writer(fileobj, closefd=False),
+        open_reader=lambda fileobj: zstandard.ZstdDecompressor(
+            ).stream_reader(fileobj, closefd=False),
+        aliases=('zstd', )))
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+else:
+    register_codec(Codec(
+        'lz4', b'\x04\x22\x4d\x18', 0, range(0, 17),
+        open_writer=lambda fileobj, level: lz4.frame.LZ4FrameFile(
+            fileobj, mode='wb', compression_level=level),
+        open_reader=lambda fileobj: lz4.frame.LZ4FrameFile(
+            fileobj, mode='rb')))
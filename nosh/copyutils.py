@@ -0,0 +1,304 @@
+'''Pluggable backends for copying the contents of single files.
+
+Where the platform and filesystem allow it the data is never copied
+through Python at all: nosh first tries to clone the file (a reflink,
+sharing the underlying blocks on e.g. btrfs or XFS), then asks the
+kernel to copy it with ``os.copy_file_range`` or ``os.sendfile``, and
+only then falls back to reading and writing buffers in userspace.
+
+Every copy function here returns the name of the backend that actually
+copied the data, so callers can check what happened.
+'''
+
+import os
+from os import path
+import errno
+import shutil
+import stat
+from collections import OrderedDict
+
+from nosh import progress, throttle, vfs
+from nosh.cache import get_cache
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+FICLONE = 0x40049409
+'''The Linux ioctl request number to clone one file into another.'''
+
+# errnos meaning a backend can't be used for this pair of files, rather
+# than that something is actually wrong with them
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                       errno.ENOTTY, errno.EBADF, errno.ETXTBSY,
+                       getattr(errno, 'EOPNOTSUPP', errno.ENOTSUP),
+                       errno.ENOTSUP}
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+MIN_BLOCK_SIZE = 8 * 1024 * 1024
+MAX_BLOCK_SIZE = 2 ** 30
+'''The bounds on the bytes a kernel copy backend asks for at once. The
+file's size is only a hint: they copy until no more data comes.'''
+
+
+class BackendUnsupported(Exception):
+    '''Raised by a copy backend that cannot copy the given files, so
+    that the next backend should be tried instead.'''
+
+
+def _maybe_unsupported(error):
+    if error.errno in _UNSUPPORTED_ERRNOS:
+        raise BackendUnsupported(str(error))
+    raise error
+
+
+def _copy_reflink(src_fd, dst_fd, size):
+    if fcntl is None:
+        raise BackendUnsupported('fcntl is not available')
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as error:
+        _maybe_unsupported(error)
+
+
+def _block_size(size):
+    # As shutil's fast copies, ask for the whole file at once (at least
+    # MIN_BLOCK_SIZE, as st_size may be 0 or out of date) and keep
+    # asking until no more is copied. With a throttle, copy in chunks of
+    # throttle.COPY_CHUNK_SIZE and return the throttle to wait for after
+    # each chunk.
+    current = throttle.get_throttle()
+    if current is not None:
+        return throttle.COPY_CHUNK_SIZE, current
+    return min(max(size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE), None
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise BackendUnsupported('os.copy_file_range is not available')
+    block_size, current = _block_size(size)
+    offset = 0
+    while True:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, block_size)
+        except OSError as error:
+            _maybe_unsupported(error)
+        if copied == 0:
+            if offset == 0:
+                # Some filesystems (e.g. procfs) report no data at all
+                raise BackendUnsupported('copy_file_range copied no data')
+            break
+        offset += copied
+        if current is not None:
+            current.wait(nbytes=copied)
+
+
+def _copy_sendfile(src_fd, dst_fd, size):
+    if not hasattr(os, 'sendfile'):
+        raise BackendUnsupported('os.sendfile is not available')
+    block_size, current = _block_size(size)
+    offset = 0
+    while True:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, block_size)
+        except OSError as error:
+            _maybe_unsupported(error)
+        if sent == 0:
+            if offset == 0:
+                raise BackendUnsupported('sendfile copied no data')
+            break
+        offset += sent
+        if current is not None:
+            current.wait(nbytes=sent)
+
+
+def _copy_userspace(src_fd, dst_fd, size):
+    current = throttle.get_throttle()
+    while True:
+        data = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not data:
+            break
+        if current is not None:
+            current.wait(nbytes=len(data))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+BACKENDS = OrderedDict([
+    ('reflink', _copy_reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _copy_sendfile),
+    ('userspace', _copy_userspace),
+])
+'''The available copy backends, in the order 'auto' tries them. Each is
+called as ``func(src_fd, dst_fd, size)`` with both file offsets at 0,
+and should raise BackendUnsupported if it cannot copy the files.
+``size`` is the source's st_size, which may be wrong (e.g. 0 for files
+in /proc), so backends should copy until the end of the file.
+Backends that move the data should wait for the current
+nosh.throttle.Throttle, if any, as they go.'''
+
+
+def register_backend(name, func, before=None):
+    '''Add a copy backend.
+
+    Parameters
+    ----------
+    name : str
+        The name of the backend, as reported in copy results.
+    func : callable
+        Called as ``func(src_fd, dst_fd, size)``; see BACKENDS.
+    before : str or None
+        The name of an existing backend that this one should be tried
+        before when using 'auto'. Defaults to None, which places the new
+        backend just before 'userspace'.
+    '''
+    if before is None:
+        before = 'userspace'
+    if before not in BACKENDS:
+        raise ValueError('Unknown copy backend {}'.format(before))
+    items = [(key, value) for key, value in BACKENDS.items() if key != name]
+    index = [key for key, _ in items].index(before)
+    items.insert(index, (name, func))
+    BACKENDS.clear()
+    BACKENDS.update(items)
+
+
+def get_backends(backend):
+    '''Return the (name, function) pairs to try for ``backend``, raising
+    ValueError if it names an unknown backend.'''
+    if backend in (None, 'auto'):
+        return list(BACKENDS.items())
+    if isinstance(backend, str):
+        backend = [backend]
+    for name in backend:
+        if name not in BACKENDS:
+            raise ValueError('backend must be one of {}, got {}'.format(
+                ['auto'] + list(BACKENDS), name))
+    return [(name, BACKENDS[name]) for name in backend]
+
+
+def copyfile(source, target, backend='auto'):
+    '''Copy the contents of ``source`` to the file path ``target``.
+
+    Parameters
+    ----------
+    source : str
+        The file to copy.
+    target : str
+        The file path to copy to. Overwritten if it already exists.
+    backend : str or list of str
+        The backend to use, a list of backends to try in order, or
+        'auto' (the default) to try every backend in BACKENDS order.
+
+    Returns
+    -------
+    str
+        The name of the backend that copied the data, or 'shutil' if
+        the source is not a regular file and was handed to
+        shutil.copyfile.
+    '''
+    backends = get_backends(backend)
+
+    if path.exists(target) and path.samefile(source, target):
+        raise shutil.SameFileError(
+            '{} and {} are the same file'.format(source, target))
+
+    if not stat.S_ISREG(os.stat(source).st_mode):
+        shutil.copyfile(source, target)
+        return 'shutil'
+
+    with open(source, 'rb') as src_fileh:
+        src_stat = os.fstat(src_fileh.fileno())
+        with open(target, 'wb') as dst_fileh:
+            src_fd = src_fileh.fileno()
+            dst_fd = dst_fileh.fileno()
+            for name, func in backends:
+                try:
+                    func(src_fd, dst_fd, src_stat.st_size)
+                except BackendUnsupported:
+                    # Start again from scratch with the next backend
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+                    continue
+                return name
+
+    raise OSError('No copy backend could copy {} to {} (tried {})'.format(
+        source, target, [name for name, _ in backends]))
+
+
+def file_target(source, target):
+    '''Return the path copying ``source`` to ``target`` writes, which is
+    inside ``target`` if it is a directory.'''
+    if vfs.get_filesystem().isdir(target):
+        return path.join(target, path.basename(source))
+    return target
+
+
+def _advance_progress(fs, target):
+    # Only stat the copy if progress is being reported
+    if progress.active():
+        progress.advance(1, fs.stat(target).st_size)
+
+
+def copy(source, target, backend='auto'):
+    '''Copy the file ``source`` to ``target`` along with its permission
+    bits, like shutil.copy. ``target`` may be a directory.
+
+    The copy is made on the current filesystem (see nosh.vfs), which
+    for the local disk means copyfile. Returns the name of the backend
+    used.
+    '''
+    fs = vfs.get_filesystem()
+    target = file_target(source, target)
+    throttle.wait(files=1)
+    used = fs.copy(source, target, backend=backend)
+    fs.copymode(source, target)
+    _advance_progress(fs, target)
+    return used
+
+
+def copy2(source, target, backend='auto'):
+    '''Copy the file ``source`` to ``target`` along with all its
+    metadata, like shutil.copy2. ``target`` may be a directory.
+
+    As copy, the copy is made on the current filesystem. Returns the
+    name of the backend used.
+    '''
+    fs = vfs.get_filesystem()
+    target = file_target(source, target)
+    throttle.wait(files=1)
+    used = fs.copy(source, target, backend=backend)
+    fs.copystat(source, target)
+    _advance_progress(fs, target)
+    return used
+
+
+class VerificationError(OSError):
+    '''Raised when a copied file's contents don't match its source.'''
+
+
+def verify(source, target, cache=None):
+    '''Raise VerificationError unless the file ``target`` has the same
+    contents as ``source``, comparing digests looked up in ``cache``
+    where possible (see nosh.cache.get_cache). ``target`` may be the
+    directory ``source`` was copied into.
+    '''
+    cache = get_cache(cache)
+    target = file_target(source, target)
+    if cache.digest(source) != cache.digest(target):
+        raise VerificationError(
+            'Copy {} does not match {}'.format(target, source))
+
+
+def verified(copy_function, cache=None):
+    '''Return a version of ``copy_function`` that verifies each copy.'''
+    def copy_and_verify(source, target):
+        used = copy_function(source, target)
+        verify(source, target, cache)
+        return used
+    return copy_and_verify
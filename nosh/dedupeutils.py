@@ -0,0 +1,291 @@
+'''Finding files with identical contents and linking them together,
+behind ``nosh.dedupe`` and ``cp(dedupe=...)``.
+
+Candidates are narrowed down in stages so that most files are never
+read in full: files are first grouped by device and size, which only
+needs a stat, then files sharing a group are compared by a digest of
+their first hashing.PARTIAL_HASH_SIZE bytes, and only those still
+matching are hashed in full.
+
+Digests may come from a cache keyed on each file's stat, which can't
+see a rewrite keeping the same size within one mtime tick, or a new
+file reusing a deleted one's inode. So before a file is replaced by a
+link its bytes are compared with the file it will be linked to.
+'''
+
+import os
+from os import path
+import shutil
+import stat
+import uuid
+from collections import namedtuple, OrderedDict
+
+from nosh import copyutils
+from nosh import hashing
+from nosh import treeutils
+from nosh.cache import get_cache
+from nosh.treeutils import CopyResult
+from nosh.utils import check_cancelled
+
+DEDUPE_MODES = ('hardlink', 'reflink')
+LINK_PREFIX = '.nosh-dedupe-'
+
+DedupeSummary = namedtuple('DedupeSummary', [
+    'linked', 'bytes_saved', 'errors'])
+'''The outcome of a dedupe. ``linked`` holds a (source, duplicate) pair
+for each duplicate file replaced by a link to ``source``,
+``bytes_saved`` their total size and ``errors`` a CopyResult for each
+failure. In a dry run, these are what would have happened.'''
+
+
+def check_mode(mode):
+    if mode not in DEDUPE_MODES:
+        raise ValueError('dedupe must be one of {}, got {}'.format(
+            DEDUPE_MODES, mode))
+
+
+def _group(items, key):
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _split_by_digest(groups, cache, algorithm, limit, workers):
+    def hash_file(item):
+        filen, stat_result = item
+        try:
+            return filen, cache.digest(filen, algorithm, limit, stat_result)
+        except OSError:
+            return filen, None
+
+    items = [item for group in groups for item in group]
+    digests = dict(treeutils.map_bounded(hash_file, items, workers))
+    new_groups = []
+    for group in groups:
+        new_groups.extend(_group(
+            (item for item in group if digests[item[0]] is not None),
+            lambda item: digests[item[0]]))
+    return new_groups
+
+
+def find_duplicate_stats(filens, cache=None, algorithm=hashing.DEFAULT_ALGORITHM,
+                         workers=None):
+    '''As find_duplicates, but each path is paired with the os.stat_result
+    it had when it was hashed.'''
+    cache = get_cache(cache)
+
+    items = []
+    inodes = set()
+    for filen in filens:
+        check_cancelled()
+        try:
+            stat_result = os.lstat(filen)
+        except OSError:
+            continue
+        if not stat.S_ISREG(stat_result.st_mode) or not stat_result.st_size:
+            continue
+        inode = (stat_result.st_dev, stat_result.st_ino)
+        if inode in inodes:
+            continue
+        inodes.add(inode)
+        items.append((filen, stat_result))
+
+    groups = _group(items, lambda item: (item[1].st_dev, item[1].st_size))
+    groups = _split_by_digest(groups, cache, algorithm,
+                              hashing.PARTIAL_HASH_SIZE, workers)
+
+    # Files no bigger than the partial hash size were hashed in full
+    small = [group for group in groups
+             if group[0][1].st_size <= hashing.PARTIAL_HASH_SIZE]
+    large = [group for group in groups
+             if group[0][1].st_size > hashing.PARTIAL_HASH_SIZE]
+    return small + _split_by_digest(large, cache, algorithm, None, workers)
+
+
+def find_duplicates(filens, cache=None, algorithm=hashing.DEFAULT_ALGORITHM,
+                    workers=None):
+    '''Return groups of the paths in ``filens`` whose files have identical
+    contents.
+
+    Only non-empty regular files are considered, and paths that are
+    already hard links to the same file count once (the first is
+    kept). Each group is in the order of ``filens``.
+
+    Parameters
+    ----------
+    filens : iterable of str
+        The paths to compare.
+    cache : hashing.HashCache or None
+        The cache to look up and store digests in. Passing the same
+        cache to repeated calls avoids re-reading unchanged files.
+        Defaults to None, meaning nosh.cache.get_cache().
+    algorithm : str
+        The hashlib algorithm to compare contents with.
+    workers : int or None
+        The number of threads to hash files with. Defaults to None,
+        meaning treeutils.DEFAULT_WORKERS.
+    '''
+    return [[filen for filen, _ in group]
+            for group in find_duplicate_stats(filens, cache, algorithm,
+                                              workers)]
+
+
+def link_file(source, target, mode='hardlink'):
+    '''Atomically replace ``target`` with a hard link to or reflink
+    (copy-on-write clone) of ``source``.
+
+    A reflinked file keeps the permission bits and timestamps of the file
+    it replaces. Raises OSError if the filesystem can't reflink.
+    '''
+    check_mode(mode)
+    temporary = path.join(path.dirname(target), LINK_PREFIX + uuid.uuid4().hex)
+    if mode == 'hardlink':
+        os.link(source, temporary)
+    else:
+        try:
+            copyutils.copyfile(source, temporary, backend='reflink')
+            shutil.copystat(target, temporary)
+        except BaseException:
+            if path.lexists(temporary):
+                os.unlink(temporary)
+            raise
+    try:
+        os.replace(temporary, target)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def _check_unchanged(filen, stat_result):
+    if hashing.stat_key(os.lstat(filen)) != hashing.stat_key(stat_result):
+        raise OSError('{} changed while being deduplicated'.format(filen))
+
+
+def same_contents(filen1, filen2):
+    '''Return whether the files ``filen1`` and ``filen2`` hold the same
+    bytes, reading both in full unless they differ early.'''
+    with open(filen1, 'rb') as fileh1, open(filen2, 'rb') as fileh2:
+        while True:
+            data = fileh1.read(hashing.HASH_BUFFER_SIZE)
+            if data != fileh2.read(hashing.HASH_BUFFER_SIZE):
+                return False
+            if not data:
+                return True
+
+
+def _check_same_contents(source, filen):
+    if not same_contents(source, filen):
+        raise OSError('{} no longer matches {}'.format(filen, source))
+
+
+def link_duplicates(groups, mode='hardlink', dry_run=False):
+    '''Replace all but the first file in each of ``groups`` (as returned
+    by find_duplicate_stats) with a link to the first.
+
+    A file is left alone if it has changed since it was hashed, or
+    (other than in a dry run) if its bytes differ from the first's.
+
+    Returns
+    -------
+    DedupeSummary
+    '''
+    check_mode(mode)
+    linked = []
+    bytes_saved = 0
+    errors = []
+    for group in groups:
+        (source, source_stat), duplicates = group[0], group[1:]
+        for filen, stat_result in duplicates:
+            check_cancelled()
+            try:
+                _check_unchanged(source, source_stat)
+                _check_unchanged(filen, stat_result)
+                if not dry_run:
+                    _check_same_contents(source, filen)
+                    link_file(source, filen, mode)
+            except OSError as error:
+                errors.append(CopyResult(source, filen, error))
+                continue
+            linked.append((source, filen))
+            bytes_saved += stat_result.st_size
+    return DedupeSummary(linked, bytes_saved, errors)
+
+
+def _link_copy(first_target, source, target, mode):
+    if mode == 'hardlink':
+        if path.lexists(target):
+            link_file(first_target, target, mode)
+        else:
+            os.link(first_target, target)
+    else:
+        copyutils.copyfile(first_target, target, backend='reflink')
+        shutil.copystat(source, target)
+
+
+def copy_deduplicated(job_sets, mode='hardlink', cache=None, workers=None):
+    '''Copy files like treeutils.copy_files, except that of each set of
+    source files with identical contents only the first is copied, and
+    the targets of the rest are linked to its copy. A source whose bytes
+    turn out to differ from the first's is copied after all.
+
+    Hard linked copies share the permission bits and timestamps of the
+    first copy; reflinked copies get their own source's.
+
+    Parameters
+    ----------
+    job_sets : list of (jobs, copy_function) pairs
+        The jobs, and function to copy them with, as would be passed to
+        treeutils.copy_files. Duplicates are found across all the sets.
+    mode : str
+        'hardlink' or 'reflink'.
+    cache : hashing.HashCache or None
+        The digest cache, see find_duplicates.
+    workers : int or None
+        The number of threads to hash and copy files with.
+
+    Returns
+    -------
+    list of treeutils.CopyResult
+        A result per file, whose backend is ``mode`` for linked files.
+    '''
+    check_mode(mode)
+    job_sets = [(list(jobs), copy_function) for jobs, copy_function in job_sets]
+    targets = OrderedDict(
+        (job[0], copyutils.file_target(job[0], job[1]))
+        for jobs, _ in job_sets for job in jobs if len(job) == 2)
+
+    groups = find_duplicate_stats(targets, cache, workers=workers)
+    first_of = {filen: group[0][0] for group in groups
+                for filen, _ in group[1:]}
+
+    def is_duplicate(job):
+        return len(job) == 2 and job[0] in first_of
+
+    results = []
+    for jobs, copy_function in job_sets:
+        results.extend(treeutils.copy_files(
+            [job for job in jobs if not is_duplicate(job)],
+            workers=workers, copy_function=copy_function))
+    failed = {result.source for result in results if result.error is not None}
+
+    for jobs, copy_function in job_sets:
+        for job in filter(is_duplicate, jobs):
+            check_cancelled()
+            source = job[0]
+            first = first_of[source]
+            try:
+                duplicate = same_contents(first, source)
+            except OSError:
+                duplicate = False
+            if first in failed or not duplicate:
+                results.extend(treeutils.copy_files(
+                    [job], workers=1, copy_function=copy_function))
+                continue
+            try:
+                _link_copy(targets[first], source, targets[source], mode)
+            except OSError as error:
+                results.append(CopyResult(source, targets[source], error))
+            else:
+                results.append(CopyResult(source, targets[source], None, mode))
+    return results
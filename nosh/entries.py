@@ -0,0 +1,121 @@
+'''Lightweight directory entries, as returned by ``ls(long=True)``.
+
+Entries are built from the scandir of the current filesystem (see
+nosh.vfs), normally ``os.scandir``, so asking whether they are
+directories, files or symlinks reuses the file type the OS returned
+with the listing. ``stat`` data is only loaded when first asked for, and
+then cached.
+'''
+
+from os import path
+import stat
+
+from nosh import vfs
+
+SORT_KEYS = ('name', 'size', 'mtime')
+
+
+class Entry(object):
+    '''A single file or directory.
+
+    Attributes
+    ----------
+    name : str
+        The final component of the path.
+    path : str
+        The full path, as given or as joined from the scanned directory.
+    '''
+    __slots__ = ('name', 'path', '_dir_entry', '_stat')
+
+    def __init__(self, name, path, dir_entry=None):
+        self.name = name
+        self.path = path
+        self._dir_entry = dir_entry
+        self._stat = None
+
+    @classmethod
+    def from_dir_entry(cls, dir_entry):
+        return cls(dir_entry.name, dir_entry.path, dir_entry)
+
+    @classmethod
+    def from_path(cls, filen):
+        return cls(path.basename(filen), filen)
+
+    def stat(self):
+        '''Return the os.stat_result for this entry, following symlinks,
+        or of the symlink itself if it is dangling (as ``ls -l`` shows).
+        The result is cached after the first call.'''
+        if self._stat is None:
+            try:
+                if self._dir_entry is not None:
+                    self._stat = self._dir_entry.stat()
+                else:
+                    self._stat = vfs.get_filesystem().stat(self.path)
+            except FileNotFoundError:
+                if not self.is_symlink():
+                    raise
+                self._stat = self._lstat()
+        return self._stat
+
+    def _lstat(self):
+        if self._dir_entry is not None:
+            return self._dir_entry.stat(follow_symlinks=False)
+        return vfs.get_filesystem().lstat(self.path)
+
+    def is_dir(self):
+        if self._dir_entry is not None:
+            return self._dir_entry.is_dir()
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        if self._dir_entry is not None:
+            return self._dir_entry.is_file()
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        if self._dir_entry is not None:
+            return self._dir_entry.is_symlink()
+        return vfs.get_filesystem().islink(self.path)
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    @property
+    def mode(self):
+        return self.stat().st_mode
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return '<Entry {!r}>'.format(self.path)
+
+
+def scan(directory):
+    '''Return an Entry for every item in ``directory``.'''
+    with vfs.get_filesystem().scandir(directory) as dir_entries:
+        return [Entry.from_dir_entry(dir_entry) for dir_entry in dir_entries]
+
+
+def sort_entries(entries, key='name', reverse=False):
+    '''Sort ``entries`` in place by 'name', 'size' or 'mtime'.
+
+    Each entry is stat'ed at most once, and not at all when sorting by
+    name.
+    '''
+    if key not in SORT_KEYS:
+        raise ValueError('sort must be one of {}, got {}'.format(
+            SORT_KEYS, key))
+    entries.sort(key=lambda entry: getattr(entry, key), reverse=reverse)
+    return entries
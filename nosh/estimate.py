@@ -0,0 +1,294 @@
+'''Dry runs: estimating what a command would do without doing it.
+
+Commands decorated with nosh.utils.supports_dry_run take a ``dry_run``
+argument. With dry_run=True the command changes nothing and returns a
+DryRunReport instead, listing the operations it would perform, the
+files, directories and bytes they would touch, whether any cross a
+filesystem boundary, and a rough estimate of the time they would take.
+
+The sizes come from a single scandir walk of each source tree,
+which on most filesystems reads file types from the directory entries
+and only stats regular files. The time estimate uses the per-file and
+per-byte costs in RATES and COMPRESSION_RATES, which are only rough
+figures for a local SSD; adjust them to suit your storage.
+
+The estimators for the nosh.shell commands are here, named after the
+commands; those for the archive commands are in nosh.archives.
+'''
+
+from os import path
+from collections import namedtuple
+
+from nosh import vfs
+
+DryRunReport = namedtuple('DryRunReport', [
+    'command', 'operations', 'files', 'directories', 'bytes',
+    'cross_device', 'seconds', 'problems'])
+'''The result of a dry run. ``operations`` is a list of
+PlannedOperation, and ``files``, ``directories``, ``bytes`` and
+``seconds`` are their totals. ``cross_device`` is True if any operation
+crosses a filesystem boundary. ``problems`` lists the errors the
+command would raise (or print, with ignore_errors=True).'''
+
+PlannedOperation = namedtuple('PlannedOperation', [
+    'action', 'source', 'target', 'files', 'directories', 'bytes',
+    'cross_device', 'seconds'])
+'''One operation of a dry run, e.g. ('copy', source, target, ...) for
+a file or tree copied by cp. ``source`` or ``target`` is None for
+actions without one, such as 'remove' or 'mkdir'.'''
+
+Size = namedtuple('Size', ['files', 'directories', 'bytes'])
+'''The totals of measure. Symlinks and other non-directories count as
+files.'''
+
+RATES = {
+    'copy': (2e-4, 400e6),
+    'rename': (5e-5, None),
+    'remove': (3e-5, None),
+    'mkdir': (5e-5, None),
+    'touch': (3e-5, None),
+    'hash': (5e-5, 800e6),
+    'archive': (1e-4, 600e6),
+    'extract': (2e-4, 400e6),
+}
+'''The estimated cost of each action, as (seconds per file or directory,
+bytes per second). A bytes per second of None means the cost doesn't
+depend on the size, as for a rename.'''
+
+COMPRESSION_RATES = {
+    'gz': (30e6, 250e6),
+    'bz2': (10e6, 30e6),
+    'xz': (4e6, 80e6),
+    'zst': (300e6, 1000e6),
+    'lz4': (500e6, 2000e6),
+    'deflate': (30e6, 250e6),
+}
+'''The estimated (compression, decompression) speed of each codec or
+zip method, in uncompressed bytes per second of one thread. Codecs not
+listed are assumed to be as fast as gz.'''
+
+
+def measure(filen, recursive=True):
+    '''Return the Size of ``filen``, and everything in it if it is a
+    directory and ``recursive`` is True, without following symlinks.
+    Entries that can't be read are skipped.'''
+    fs = vfs.get_filesystem()
+    try:
+        root_stat = fs.lstat(filen)
+    except OSError:
+        return Size(0, 0, 0)
+    if not fs.isdir(filen) or fs.islink(filen):
+        return Size(1, 0, root_stat.st_size)
+
+    files = nbytes = 0
+    directories = 1
+    pending = [filen] if recursive else []
+    while pending:
+        try:
+            with fs.scandir(pending.pop()) as scanner:
+                for entry in scanner:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories += 1
+                        pending.append(entry.path)
+                        continue
+                    files += 1
+                    if entry.is_file(follow_symlinks=False):
+                        try:
+                            nbytes += entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            pass
+        except OSError:
+            continue
+    return Size(files, directories, nbytes)
+
+
+def device(filen):
+    '''Return the st_dev of ``filen``, or of its nearest existing
+    ancestor if it doesn't exist yet.'''
+    fs = vfs.get_filesystem()
+    filen = path.abspath(filen)
+    while True:
+        try:
+            return fs.stat(filen).st_dev
+        except OSError:
+            parent = path.dirname(filen)
+            if parent == filen:
+                return None
+            filen = parent
+
+
+def cost(action, files=1, nbytes=0):
+    '''Return the estimated seconds ``action`` takes on ``files`` files
+    and directories holding ``nbytes`` bytes, from RATES.'''
+    per_file, per_second = RATES[action]
+    seconds = files * per_file
+    if per_second is not None:
+        seconds += nbytes / per_second
+    return seconds
+
+
+def compression_cost(codec_name, nbytes, threads=1, decompress=False):
+    '''Return the estimated seconds to (de)compress ``nbytes`` with the
+    codec or zip method ``codec_name``, from COMPRESSION_RATES. No codec
+    (None or 'store') costs nothing.'''
+    if codec_name in (None, 'store'):
+        return 0
+    rates = COMPRESSION_RATES.get(codec_name, COMPRESSION_RATES['gz'])
+    return nbytes / (rates[decompress] * max(threads, 1))
+
+
+def _crosses(source, target):
+    if not isinstance(source, str) or not isinstance(target, str):
+        return False
+    return device(source) != device(target)
+
+
+def operation(action, source=None, target=None, size=None, seconds=None):
+    '''Return a PlannedOperation, measuring ``source`` if no ``size`` is
+    given and estimating its cost from RATES if no ``seconds`` are.'''
+    if size is None:
+        size = measure(source) if source is not None else Size(0, 0, 0)
+    if seconds is None:
+        seconds = cost(action, max(size.files + size.directories, 1),
+                       size.bytes)
+    return PlannedOperation(action, source, target, size.files,
+                            size.directories, size.bytes,
+                            _crosses(source, target), seconds)
+
+
+def report(command, operations, problems=()):
+    '''Return the DryRunReport totalling ``operations``.'''
+    return DryRunReport(
+        command, list(operations),
+        sum(op.files for op in operations),
+        sum(op.directories for op in operations),
+        sum(op.bytes for op in operations),
+        any(op.cross_device for op in operations),
+        sum(op.seconds for op in operations),
+        list(problems))
+
+
+def _transfer_pairs(sources, target, problems):
+    # The (source, destination) pairs of cp and mv
+    fs = vfs.get_filesystem()
+    if fs.isdir(target):
+        return [(source, path.join(target, path.basename(source)))
+                for source in sources]
+    if len(sources) > 1:
+        problems.append('Target {} is not a directory but multiple sources '
+                        'were specified'.format(target))
+    return [(sources[0], target)]
+
+
+def mv(*args, **kwargs):
+    '''Estimate nosh.shell.mv. A move within a filesystem is a single
+    'rename'; a move across filesystems is a 'copy' then a 'remove'.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    for source, target in _transfer_pairs(args[:-1], args[-1], problems):
+        if not fs.lexists(source):
+            problems.append('{} does not exist'.format(source))
+            continue
+        size = measure(source)
+        if not _crosses(source, target):
+            operations.append(operation('rename', source, target, size,
+                                        seconds=cost('rename')))
+            continue
+        operations.append(operation('copy', source, target, size))
+        operations.append(operation('remove', source, None, size))
+    return report('mv', operations, problems)
+
+
+def rm(*args, recursive=False, ignore_errors=False, **kwargs):
+    '''Estimate nosh.shell.rm.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    for arg in args:
+        if not fs.lexists(arg):
+            if not ignore_errors:
+                problems.append('{} does not exist'.format(arg))
+            continue
+        if fs.isdir(arg) and not fs.islink(arg) and not recursive:
+            problems.append('Cannot remove "{}": Is a directory'.format(arg))
+            continue
+        operations.append(operation('remove', arg))
+    return report('rm', operations, problems)
+
+
+def cp(*args, recursive=False, **kwargs):
+    '''Estimate nosh.shell.cp.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    target = args[-1]
+    for source, source_target in _transfer_pairs(args[:-1], target,
+                                                 problems):
+        if not fs.lexists(source):
+            problems.append('{} does not exist'.format(source))
+        elif fs.isdir(source) and not recursive:
+            problems.append('Tried to copy directory {} but recursive is '
+                            'False.'.format(source))
+        elif (fs.isdir(source) and not fs.isdir(target) and
+                fs.exists(target)):
+            problems.append('Cannot copy directory to file that already '
+                            'exists')
+        else:
+            operations.append(operation('copy', source, source_target))
+    return report('cp', operations, problems)
+
+
+def checksum(*args, recursive=False, **kwargs):
+    '''Estimate nosh.shell.checksum. Cached digests aren't looked up, so
+    the estimate is for hashing every file.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    for arg in args:
+        if fs.isdir(arg) and not recursive:
+            problems.append('Tried to checksum directory {} but recursive '
+                            'is False.'.format(arg))
+        elif not fs.exists(arg):
+            problems.append('{} does not exist'.format(arg))
+        else:
+            operations.append(operation('hash', arg))
+    return report('checksum', operations, problems)
+
+
+def mkdir(dir_name, mode=511, parents=False, exist_ok=False):
+    '''Estimate nosh.shell.mkdir.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    if fs.exists(dir_name):
+        if not exist_ok:
+            problems.append('Cannot make dir at {}, it already '
+                            'exists'.format(dir_name))
+    else:
+        missing = [dir_name]
+        parent = path.dirname(dir_name)
+        while parent and not fs.exists(parent):
+            missing.append(parent)
+            parent = path.dirname(parent)
+        if len(missing) > 1 and not parents:
+            problems.append('Cannot make dir at {}, its parent does not '
+                            'exist'.format(dir_name))
+            missing = []
+        operations = [operation('mkdir', None, filen, Size(0, 1, 0))
+                      for filen in reversed(missing)]
+    return report('mkdir', operations, problems)
+
+
+def touch(*args):
+    '''Estimate nosh.shell.touch.'''
+    fs = vfs.get_filesystem()
+    problems = []
+    operations = []
+    for filen in args:
+        if fs.isdir(filen):
+            problems.append('Cannot touch {}, directory of that name '
+                            'exists'.format(filen))
+        else:
+            operations.append(operation('touch', None, filen, Size(1, 0, 0)))
+    return report('touch', operations, problems)
@@ -0,0 +1,188 @@
+'''The directory walking and matching behind ``nosh.find``.
+
+Directories are read with ``os.scandir`` (or the scandir of the
+current nosh.vfs filesystem) and results are produced as
+each directory is read, so walking a huge tree uses memory proportional
+to the number of directories still waiting to be read rather than the
+number of files found.
+'''
+
+import contextvars
+import fnmatch
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from nosh import entries
+from nosh import treeutils
+from nosh import vfs
+from nosh.utils import check_cancelled
+
+FILE_TYPES = {'f': 'is_file', 'd': 'is_dir', 'l': 'is_symlink'}
+
+_SIZE_UNITS = {'': 1, 'c': 1, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+_SIZE_RE = re.compile(r'^([+-]?)(\d+)([{}]?)$'.format(''.join(_SIZE_UNITS)))
+
+
+def parse_size(size):
+    '''Return a predicate on file sizes in bytes for ``size``.
+
+    ``size`` may be an int, matching exactly that many bytes, or a
+    string in the style of find's -size: e.g. '+10M' matches files
+    larger than 10 MiB, '-4k' files smaller than 4 KiB and '100'
+    exactly 100 bytes. Supported units are c (bytes), k, M, G and T.
+    '''
+    if isinstance(size, int):
+        return lambda file_size: file_size == size
+    match = _SIZE_RE.match(size)
+    if match is None:
+        raise ValueError('Could not parse size {!r}'.format(size))
+    sign, number, unit = match.groups()
+    number = int(number) * _SIZE_UNITS[unit]
+    if sign == '+':
+        return lambda file_size: file_size > number
+    elif sign == '-':
+        return lambda file_size: file_size < number
+    return lambda file_size: file_size == number
+
+
+def compile_patterns(patterns):
+    '''Return a regex matching any of the glob ``patterns`` (a string or
+    list of strings), or None if ``patterns`` is None.'''
+    if patterns is None:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile('|'.join(fnmatch.translate(pattern)
+                               for pattern in patterns))
+
+
+class Matcher(object):
+    '''Decides which entries find yields and which directories it
+    descends into.
+
+    The cheap tests (name and type, which need no stat) run before the
+    size and mtime tests, so most non-matching entries are rejected
+    without stat'ing them.
+    '''
+
+    def __init__(self, name=None, type=None, size=None, newer=None,
+                 mindepth=0, maxdepth=None, prune=None):
+        self.name = compile_patterns(name)
+
+        if type is not None and type not in FILE_TYPES:
+            raise ValueError('type must be one of {}, got {}'.format(
+                list(FILE_TYPES), type))
+        self.type_method = None if type is None else FILE_TYPES[type]
+
+        self.size = None if size is None else parse_size(size)
+
+        if isinstance(newer, str):
+            newer = vfs.get_filesystem().stat(newer).st_mtime
+        self.newer = newer
+
+        self.mindepth = mindepth
+        self.maxdepth = maxdepth
+
+        if prune is None or callable(prune):
+            self.prune_function = prune
+            self.prune_names = None
+        else:
+            self.prune_function = None
+            self.prune_names = compile_patterns(prune)
+
+    def matches(self, entry, depth):
+        if depth < self.mindepth:
+            return False
+        if self.name is not None and not self.name.match(entry.name):
+            return False
+        try:
+            if (self.type_method is not None and
+                    not getattr(entry, self.type_method)()):
+                return False
+            if self.size is not None and not self.size(entry.size):
+                return False
+            if self.newer is not None and not entry.mtime > self.newer:
+                return False
+        except OSError:
+            # e.g. a broken symlink, whose size or mtime can't be read
+            return False
+        return True
+
+    def descend(self, entry, depth):
+        '''Return True if find should read the directory ``entry``.'''
+        if self.maxdepth is not None and depth >= self.maxdepth:
+            return False
+        if (self.prune_names is not None and
+                self.prune_names.match(entry.name)):
+            return False
+        if (self.prune_function is not None and
+                self.prune_function(entry)):
+            return False
+        try:
+            # Like find, don't follow symlinks to directories
+            return entry.is_dir() and not entry.is_symlink()
+        except OSError:
+            return False
+
+
+def _scan(directory, depth, matcher):
+    '''Read one directory, returning the matching entries and the
+    subdirectories to read next.'''
+    matches = []
+    subdirs = []
+    try:
+        listing = entries.scan(directory)
+    except OSError:
+        return matches, subdirs
+    for entry in listing:
+        if matcher.matches(entry, depth):
+            matches.append(entry)
+        if matcher.descend(entry, depth):
+            subdirs.append(entry.path)
+    return matches, subdirs
+
+
+def walk(roots, matcher, workers=None):
+    '''Yield every entries.Entry under ``roots`` accepted by ``matcher``.
+
+    If ``workers`` is more than 1, directories are read concurrently in
+    that many threads and results are yielded in the order directories
+    finish being read.
+    '''
+    workers = treeutils.get_workers(workers)
+
+    pending = deque()
+    for root in roots:
+        entry = entries.Entry.from_path(root)
+        if matcher.matches(entry, 0):
+            yield entry
+        if matcher.descend(entry, 0):
+            pending.append((root, 1))
+
+    if workers == 1:
+        # Depth first, so that the pending stack stays small
+        while pending:
+            check_cancelled()
+            directory, depth = pending.pop()
+            matches, subdirs = _scan(directory, depth, matcher)
+            yield from matches
+            pending.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+        return
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            check_cancelled()
+            while pending and len(running) < workers * 2:
+                directory, depth = pending.pop()
+                future = executor.submit(contextvars.copy_context().run,
+                                         _scan, directory, depth, matcher)
+                running[future] = depth
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = running.pop(future)
+                matches, subdirs = future.result()
+                yield from matches
+                pending.extend((subdir, depth + 1) for subdir in subdirs)
@@ -0,0 +1,252 @@
+'''Glob pattern expansion for many patterns at once.
+
+Unlike calling ``glob.glob`` once per pattern, the patterns passed to
+expand_globs share their directory listings: each directory is read at
+most once, and all the patterns matching entries in the same directory
+are compiled into a single regex, so the listing is filtered in one
+pass however many patterns there are.
+
+As well as the usual ``*``, ``?`` and ``[...]`` wildcards, ``**``
+matches any number of nested directories (including none), and braces
+expand to each of their comma separated alternatives, e.g.
+``*.{txt,log}``.
+'''
+
+import os
+from os import path
+import fnmatch
+import re
+from collections import OrderedDict
+
+from nosh import vfs
+
+MAGIC_CHARS = '*?['
+
+
+def _find_brace(pattern, start=0):
+    '''Return the (open, close, comma_positions) of the first brace pair
+    in ``pattern`` containing a top level comma, or None.'''
+    index = pattern.find('{', start)
+    while index != -1:
+        depth = 0
+        commas = []
+        for position in range(index, len(pattern)):
+            char = pattern[position]
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    if commas:
+                        return index, position, commas
+                    break
+            elif char == ',' and depth == 1:
+                commas.append(position)
+        index = pattern.find('{', index + 1)
+    return None
+
+
+def expand_braces(pattern):
+    '''Return the list of patterns ``pattern`` expands to, e.g.
+    'a{b,c{d,e}}' gives ['ab', 'acd', 'ace']. Braces without a comma
+    are left alone.'''
+    brace = _find_brace(pattern)
+    if brace is None:
+        return [pattern]
+    start, end, commas = brace
+    bounds = [start] + commas + [end]
+    expanded = []
+    for left, right in zip(bounds[:-1], bounds[1:]):
+        alternative = (pattern[:start] + pattern[left + 1:right] +
+                       pattern[end + 1:])
+        expanded.extend(expand_braces(alternative))
+    return expanded
+
+
+def has_magic(pattern):
+    '''Return True if ``pattern`` contains glob wildcards or braces to
+    expand.'''
+    return (any(char in pattern for char in MAGIC_CHARS) or
+            _find_brace(pattern) is not None)
+
+
+def _translate(component):
+    regex = fnmatch.translate(component)
+    if not component.startswith('.'):
+        # As in the shell, wildcards don't match hidden files
+        regex = r'(?!\.)' + regex
+    return regex
+
+
+class _Listings(object):
+    '''Caches (name, is_dir) listings so each directory is read once.'''
+
+    def __init__(self):
+        self.listings = {}
+
+    def __call__(self, directory):
+        listing = self.listings.get(directory)
+        if listing is None:
+            listing = []
+            try:
+                with vfs.get_filesystem().scandir(
+                        directory or os.curdir) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        listing.append((entry.name, is_dir))
+            except OSError:
+                pass
+            self.listings[directory] = listing
+        return listing
+
+    def descendants(self, directory, dirs_only=False):
+        '''Return the paths below ``directory``, skipping hidden ones.'''
+        found = []
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            for name, is_dir in self(current):
+                if name.startswith('.'):
+                    continue
+                filen = _join(current, name)
+                if is_dir:
+                    pending.append(filen)
+                if is_dir or not dirs_only:
+                    found.append(filen)
+        return found
+
+
+def _join(directory, name):
+    if not directory:
+        return name
+    return path.join(directory, name)
+
+
+def _split(pattern):
+    '''Split ``pattern`` into its literal leading directory, and the
+    remaining components.'''
+    parts = pattern.split(os.sep)
+    for index, part in enumerate(parts):
+        if has_magic(part):
+            break
+    prefix = os.sep.join(parts[:index])
+    if not prefix and pattern.startswith(os.sep):
+        prefix = os.sep
+    return prefix, parts[index:]
+
+
+def _expand_dirs(prefix, components, listings):
+    '''Return the directories matching ``prefix`` followed by the
+    directory ``components``.'''
+    dirs = [prefix]
+    for component in components:
+        new_dirs = []
+        if component == '**':
+            for directory in dirs:
+                new_dirs.append(directory)
+                new_dirs.extend(listings.descendants(directory, True))
+        elif has_magic(component):
+            regex = re.compile(_translate(component))
+            for directory in dirs:
+                new_dirs.extend(_join(directory, name)
+                                for name, is_dir in listings(directory)
+                                if is_dir and regex.match(name))
+        else:
+            isdir = vfs.get_filesystem().isdir
+            new_dirs = [_join(directory, component) for directory in dirs
+                        if isdir(_join(directory, component))]
+        dirs = new_dirs
+    return dirs
+
+
+def expand_globs_grouped(patterns):
+    '''Return a list of the paths matching each of ``patterns``.
+
+    Patterns without any wildcards are only included if they exist, as
+    with glob.glob.
+    '''
+    listings = _Listings()
+    lexists = vfs.get_filesystem().lexists
+    results = [[] for _ in patterns]
+
+    # Maps each directory to the (result index, regex) pairs that must
+    # be matched against its entries
+    groups = OrderedDict()
+
+    for index, pattern in enumerate(patterns):
+        for expanded in expand_braces(pattern):
+            if not has_magic(expanded):
+                if lexists(expanded):
+                    results[index].append(expanded)
+                continue
+            prefix, components = _split(expanded)
+            dirs = _expand_dirs(prefix, components[:-1], listings)
+            final = components[-1]
+            if final == '':  # the pattern ended with a separator
+                results[index].extend(_join(d, '') for d in dirs)
+            elif final == '**':
+                for directory in dirs:
+                    results[index].extend(listings.descendants(directory))
+            elif has_magic(final):
+                regex = _translate(final)
+                for directory in dirs:
+                    groups.setdefault(directory, []).append((index, regex))
+            else:
+                results[index].extend(
+                    _join(d, final) for d in dirs
+                    if lexists(_join(d, final)))
+
+    for directory, matchers in groups.items():
+        combined = re.compile('|'.join(regex for _, regex in matchers))
+        if len(matchers) > 1:
+            matchers = [(index, re.compile(regex))
+                        for index, regex in matchers]
+        for name, _ in listings(directory):
+            if not combined.match(name):
+                continue
+            filen = _join(directory, name)
+            if len(matchers) == 1:
+                results[matchers[0][0]].append(filen)
+                continue
+            for index, regex in matchers:
+                if regex.match(name):
+                    results[index].append(filen)
+
+    return results
+
+
+def expand_globs(patterns):
+    '''Return the list of paths matching each of ``patterns``, in order.
+
+    A path matching several patterns is included once for each.
+    '''
+    return [filen for result in expand_globs_grouped(patterns)
+            for filen in result]
+
+
+def glob(pattern):
+    '''Return the list of paths matching ``pattern``.'''
+    return expand_globs([pattern])
+
+
+def expand_args(args):
+    '''Expand the glob patterns in ``args``, leaving arguments without
+    wildcards (or that aren't strings) untouched whether or not they
+    exist.'''
+    def is_pattern(arg):
+        return isinstance(arg, str) and has_magic(arg)
+
+    patterns = [arg for arg in args if is_pattern(arg)]
+    if not patterns:
+        return list(args)
+    listings = iter(expand_globs_grouped(patterns))
+    expanded = []
+    for arg in args:
+        if is_pattern(arg):
+            expanded.extend(next(listings))
+        else:
+            expanded.append(arg)
+    return expanded
@@ -0,0 +1,109 @@
+'''Helpers for computing file content digests.'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from nosh import vfs
+
+HASH_BUFFER_SIZE = 1024 * 1024
+DEFAULT_ALGORITHM = 'sha256'
+PARTIAL_HASH_SIZE = 64 * 1024
+'''The number of leading bytes read for a partial digest, see
+HashCache.digest.'''
+
+
+def file_digest(filen, algorithm=DEFAULT_ALGORITHM, limit=None):
+    '''Return the hex digest of the contents of the file at ``filen``.
+
+    Parameters
+    ----------
+    filen : str
+        The path of the file to hash.
+    algorithm : str
+        Any algorithm name accepted by hashlib.new. Defaults to
+        DEFAULT_ALGORITHM.
+    limit : int or None
+        If given, only the first ``limit`` bytes of the file are hashed.
+        Defaults to None, hashing the whole file.
+    '''
+    hasher = hashlib.new(algorithm)
+    remaining = limit
+    with vfs.get_filesystem().open(filen, 'rb') as fileh:
+        while remaining is None or remaining > 0:
+            size = HASH_BUFFER_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            data = fileh.read(size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def stat_key(stat_result):
+    '''Return the (device, inode, size, mtime_ns) identifying one version
+    of a file's contents.'''
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns)
+
+
+class HashCache(object):
+    '''Remembers file digests by stat_key, so passing the same cache to
+    repeated operations only reads files that have changed in between.
+
+    This cache lives in memory and holds at most ``max_entries`` digests
+    (None for no limit), forgetting the least recently used first.
+    Subclasses may store digests elsewhere by overriding lookup and
+    store, see nosh.cache.SqliteHashCache.
+    '''
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        '''Return the digest stored for ``key``, or None.'''
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+            return digest
+
+    def store(self, key, digest):
+        with self._lock:
+            self._digests[key] = digest
+            self._digests.move_to_end(key)
+            if self.max_entries is not None:
+                while len(self._digests) > self.max_entries:
+                    self._digests.popitem(last=False)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def digest(self, filen, algorithm=DEFAULT_ALGORITHM, limit=None,
+               stat_result=None):
+        '''Return the hex digest of ``filen``, as file_digest, reading the
+        file only if its digest isn't already cached.
+
+        ``stat_result`` may be passed if the file has already been
+        stat'ed. A file no longer than ``limit`` is hashed in full, so
+        its partial and full digests share one cache entry.
+        '''
+        fs = vfs.get_filesystem()
+        if stat_result is None:
+            stat_result = fs.stat(filen)
+        if limit is not None and stat_result.st_size <= limit:
+            limit = None
+        key = stat_key(stat_result) + (algorithm, limit)
+
+        digest = self.lookup(key)
+        if digest is None:
+            digest = file_digest(filen, algorithm, limit)
+            # Don't remember a digest of contents that changed as they
+            # were read
+            if stat_key(fs.stat(filen)) == key[:4]:
+                self.store(key, digest)
+        return digest
@@ -0,0 +1,263 @@
+'''Progress reports from long-running commands.
+
+Commands decorated with nosh.utils.supports_progress (cp, mv, rm, tar,
+untar, zip and unzip) take a ``progress`` argument: a callable that is
+passed a ProgressReport every DEFAULT_INTERVAL seconds while the command
+runs, and once more when it finishes. ``progress=True`` draws a
+ProgressBar on stderr:
+
+    nosh.cp('photos', '/backup', recursive=True, progress=True)
+
+The totals come from the command's dry run (see nosh.estimate), so
+there is one extra scan of the sources before the command starts. The
+exception is untar of a tarball without a sidecar index, whose dry run
+would decompress it all once more: it reports no totals (or ETA).
+
+The commands only count the files and bytes done as they go, and the
+reports are made by a background thread, so however many files there
+are the callback is never called more often than the interval. It is
+called in that thread, not the one running the command. Bytes are
+counted as each file is finished, so a single huge file shows no
+progress until it is done; ``stalled`` then says how long it has been
+since anything finished.
+'''
+
+import sys
+import threading
+import time
+from collections import namedtuple, defaultdict
+from contextvars import ContextVar
+
+DEFAULT_INTERVAL = 0.5
+'''The seconds between progress reports.'''
+
+ProgressReport = namedtuple('ProgressReport', [
+    'command', 'files', 'files_total', 'bytes', 'bytes_total', 'seconds',
+    'files_per_second', 'bytes_per_second', 'eta', 'stalled', 'finished'])
+'''The progress of a command. ``files`` and ``bytes`` have been done out
+of ``files_total`` and ``bytes_total`` (None if unknown, and
+``bytes_total`` for commands that don't count bytes, such as rm).
+``files_per_second`` and ``bytes_per_second`` are the throughput since
+the last report, and ``eta`` the seconds left at the average throughput
+so far (None until something is done).
+``stalled`` is the seconds since a file was last finished, and
+``finished`` is True for the last report of the command.'''
+
+_PROGRESS = ContextVar('nosh_progress', default=None)
+
+
+class Progress(object):
+    '''Counts the files and bytes a command has done, reporting them to
+    ``callback`` from a background thread while it is in use as a
+    context manager.
+
+    Parameters
+    ----------
+    callback : callable
+        Called with a ProgressReport every ``interval`` seconds, and
+        once the context exits.
+    command : str
+        The name of the command, for the reports.
+    files_total : int or None
+        The number of files the command will do.
+    bytes_total : int or None
+        The number of bytes the command will do, or None if it doesn't
+        count bytes.
+    operations : list of nosh.estimate.PlannedOperation
+        The operations planned by the command's dry run, looked up by
+        complete.
+    interval : float
+        The seconds between reports. Defaults to DEFAULT_INTERVAL.
+    '''
+
+    def __init__(self, callback, command, files_total=None,
+                 bytes_total=None, operations=(), interval=None):
+        self.callback = callback
+        self.command = command
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.interval = DEFAULT_INTERVAL if interval is None else interval
+        self.files = 0
+        self.bytes = 0
+        self._sizes = defaultdict(lambda: [0, 0])
+        for operation in operations:
+            size = self._sizes[operation.source, operation.action]
+            size[0] += operation.files
+            size[1] += operation.bytes
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._token = None
+        self._started = self._last_done = time.monotonic()
+        self._last_report = (self._started, 0, 0)
+
+    def advance(self, files=1, nbytes=0):
+        '''Count ``files`` more files and ``nbytes`` more bytes done.'''
+        with self._lock:
+            self.files += files
+            self.bytes += nbytes
+            self._last_done = time.monotonic()
+
+    def complete(self, source, action=None):
+        '''Count everything the dry run planned for ``source`` (or only
+        its ``action`` operations) as done, e.g. once a whole tree has
+        been renamed.'''
+        for (planned, planned_action), size in list(self._sizes.items()):
+            if planned == source and action in (None, planned_action):
+                files, nbytes = size
+                self.advance(files, 0 if self.bytes_total is None else nbytes)
+
+    def report(self, finished=False):
+        '''Return a ProgressReport of the progress so far.'''
+        now = time.monotonic()
+        with self._lock:
+            files, nbytes, last_done = self.files, self.bytes, self._last_done
+        last_time, last_files, last_bytes = self._last_report
+        self._last_report = (now, files, nbytes)
+        interval = now - last_time
+        seconds = now - self._started
+        if interval > 0:
+            files_per_second = (files - last_files) / interval
+            bytes_per_second = (nbytes - last_bytes) / interval
+        else:
+            files_per_second = bytes_per_second = 0.
+
+        if self.bytes_total and nbytes:
+            done, total = nbytes, self.bytes_total
+        else:
+            done, total = files, self.files_total
+        eta = None
+        if finished:
+            eta = 0.
+        elif done and total is not None:
+            eta = max(total - done, 0) * seconds / done
+        return ProgressReport(
+            self.command, files, self.files_total, nbytes, self.bytes_total,
+            seconds, files_per_second, bytes_per_second, eta,
+            now - last_done, finished)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.callback(self.report())
+
+    def __enter__(self):
+        self._token = _PROGRESS.set(self)
+        self._thread = threading.Thread(target=self._run,
+                                        name='nosh-progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _PROGRESS.reset(self._token)
+        self._stopped.set()
+        self._thread.join()
+        self.callback(self.report(finished=True))
+
+
+def advance(files=1, nbytes=0):
+    '''Count ``files`` files and ``nbytes`` bytes done by the running
+    command, if its progress is being reported. Commands call this as
+    they finish each file.'''
+    progress = _PROGRESS.get()
+    if progress is not None:
+        progress.advance(files, nbytes)
+
+
+def complete(source, action=None):
+    '''Call Progress.complete for the running command, if its progress
+    is being reported.'''
+    progress = _PROGRESS.get()
+    if progress is not None:
+        progress.complete(source, action)
+
+
+def detach():
+    '''Stop reporting progress in the current context, for work a
+    command leaves running in the background once it returns.'''
+    _PROGRESS.set(None)
+
+
+def active():
+    '''Return True if the running command's progress is being reported.'''
+    return _PROGRESS.get() is not None
+
+
+def _format_bytes(nbytes):
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if abs(nbytes) < 1000 or unit == 'TB':
+            break
+        nbytes /= 1000.
+    return '{:.1f} {}'.format(nbytes, unit)
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class ProgressBar(object):
+    '''A progress callback drawing a one-line progress bar, e.g.
+
+        cp [##########..........]  50%  2,500/5,000 files  1.2 GB/2.4 GB
+           120.0 MB/s  ETA 0:00:10
+
+    Parameters
+    ----------
+    file : file or None
+        The terminal to draw on. Defaults to None, meaning sys.stderr.
+    width : int
+        The number of characters in the bar itself. Defaults to 20.
+    stall_after : float
+        The seconds without a file finishing after which the bar says
+        the command is stalled. Defaults to 10.
+    '''
+
+    def __init__(self, file=None, width=20, stall_after=10):
+        self.file = file
+        self.width = width
+        self.stall_after = stall_after
+        self._length = 0
+
+    def format(self, report):
+        '''Return the line drawn for the ProgressReport ``report``.'''
+        if report.bytes_total:
+            fraction = report.bytes / report.bytes_total
+        elif report.files_total:
+            fraction = report.files / report.files_total
+        else:
+            fraction = 1. if report.finished else 0.
+        fraction = min(fraction, 1.)
+        filled = int(round(fraction * self.width))
+        parts = ['{} [{}{}] {:3.0f}%'.format(
+            report.command, '#' * filled, '.' * (self.width - filled),
+            fraction * 100)]
+        if report.files_total is not None:
+            parts.append('{:,}/{:,} files'.format(report.files,
+                                                  report.files_total))
+        else:
+            parts.append('{:,} files'.format(report.files))
+        if report.bytes_total is not None:
+            parts.append('{}/{}'.format(_format_bytes(report.bytes),
+                                        _format_bytes(report.bytes_total)))
+            parts.append('{}/s'.format(_format_bytes(report.bytes_per_second)))
+        else:
+            parts.append('{:.0f} files/s'.format(report.files_per_second))
+        if report.finished:
+            parts.append('in {}'.format(_format_seconds(report.seconds)))
+        elif report.stalled >= self.stall_after:
+            parts.append('stalled for {}'.format(
+                _format_seconds(report.stalled)))
+        elif report.eta is not None:
+            parts.append('ETA {}'.format(_format_seconds(report.eta)))
+        return '  '.join(parts)
+
+    def __call__(self, report):
+        fileh = sys.stderr if self.file is None else self.file
+        line = self.format(report)
+        # Pad with spaces to cover any longer line drawn before
+        fileh.write('\r' + line.ljust(self._length))
+        self._length = len(line)
+        if report.finished:
+            fileh.write('\n')
+        fileh.flush()
@@ -4,24 +4,37 @@ Implementations of file management shell commands.
 
 import os
 from os import path
-import shutil
-import glob
 from collections import defaultdict
+from functools import partial
 
 from nosh.utils import (expand_path, require_args, expand_paths,
-                        maybe_exception)
+                        maybe_exception, maybe_result_exceptions,
+                        check_cancelled, supports_dry_run, supports_progress,
+                        supports_throttle)
 from nosh.wrapperutils import (
     require_readable_args, require_writable_args, require_arg_state)
 from nosh import state
-# from nosh.wrappers import os
-# from nosh.wrappers.os import path
-# from nosh.wrappers import shutil
+from nosh import treeutils
+from nosh import copyutils
+from nosh import dedupeutils
+from nosh import estimate
+from nosh import hashing
+from nosh import progress
+from nosh import throttle
+from nosh.cache import get_cache
+from nosh import entries
+from nosh import findutils
+from nosh import globbing
+from nosh import vfs
 
 
 @require_args(min=2, max=None)
 @expand_paths()
 @require_writable_args()
-def mv(*args, ignore_errors=False):
+@supports_throttle
+@supports_progress()
+@supports_dry_run(estimate.mv)
+def mv(*args, ignore_errors=False, backend='auto'):
     '''Move files from one location to another.
 
     If the the final argument is a directory, all preceding arguments
@@ -30,27 +43,73 @@ def mv(*args, ignore_errors=False):
     If the final argument is a filepath, there can only be one other
     argument, which is moved to the target location.
 
+    Parameters
+    ----------
+    backend : str or list of str
+        The copy backend(s) to use when a file can't simply be renamed,
+        e.g. when moving across filesystems. See copyutils.copyfile.
+        Defaults to 'auto'.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    Returns
+    -------
+    list of treeutils.CopyResult
+        One result per source renamed in place (with backend 'rename'),
+        or per file copied when a source had to be copied and deleted.
     '''
+    fs = vfs.get_filesystem()
     target = args[-1]
     sources = args[:-1]
+    copyutils.get_backends(backend)
 
-    if not path.isdir(target) and len(sources) > 1:
+    if not fs.isdir(target) and len(sources) > 1:
         maybe_exception(NotADirectoryError,
                         ('Target {} is not a directory but multiple sources '
                          'were specified'.format(target)),
                         ignore_errors)
 
-    if path.isdir(target):
-        for source in sources:
-            shutil.move(source, target)
-    else:
-        shutil.move(sources[0], target)
+    if not fs.isdir(target):
+        sources = sources[:1]
+
+    results = []
+    for source in sources:
+        check_cancelled()
+        throttle.wait(files=1)
+        copied = []
+
+        def copy_function(src, dst):
+            backend_used = copyutils.copy2(src, dst, backend=backend)
+            copied.append(treeutils.CopyResult(src, dst, None, backend_used))
+
+        moved_to = fs.move(source, target, copy_function=copy_function)
+        if copied:
+            progress.complete(source, 'remove')
+            results.extend(copied)
+        else:
+            progress.complete(source)
+            results.append(
+                treeutils.CopyResult(source, moved_to, None, 'rename'))
+    return results
 
 
 @require_args(min=1)
 @expand_paths()
 @require_writable_args()
-def rm(*args, recursive=False, ignore_errors=False):
+@supports_throttle
+@supports_progress(count_bytes=False)
+@supports_dry_run(estimate.rm)
+def rm(*args, recursive=False, ignore_errors=False, workers=None,
+       background=False):
     '''
     Delete files and/or directories.
 
@@ -64,25 +123,76 @@ def rm(*args, recursive=False, ignore_errors=False):
     ignore_errors : bool
         If True, will ignore errors when e.g. specified  files do not exist.
         Defaults to False.
+    workers : int or None
+        The number of threads to delete directory contents with. If more
+        than 1, directory trees are read with os.scandir and their files
+        unlinked in parallel, which helps most on filesystems where each
+        unlink is slow (e.g. network filesystems). Defaults to None,
+        meaning treeutils.DEFAULT_WORKERS.
+    background : bool
+        If True, each directory is renamed to a hidden trash path beside
+        it and deleted in a background thread, so rm returns almost
+        immediately. See treeutils.remove_tree_in_background. Directories
+        whose parent isn't writable are deleted normally. Defaults to
+        False.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    Returns
+    -------
+    list of treeutils.RemoveResult
+        A result for each path in a directory tree that could not be
+        deleted (only if ignore_errors is True, otherwise the first
+        failure is raised).
     '''
+    fs = vfs.get_filesystem()
+    workers = treeutils.get_workers(workers)
+    failures = []
     for arg in args:
-        if not path.exists(arg) and ignore_errors:
+        check_cancelled()
+        if not fs.exists(arg) and ignore_errors:
             continue
-        if path.isdir(arg):
+        if fs.isdir(arg):
             if not recursive:
                 error = 'Cannot remove "{}": Is a directory'.format(arg)
                 maybe_exception(IsADirectoryError, error, ignore_errors)
+            elif (background and
+                  state.is_writable(treeutils.trash_path(arg))):
+                treeutils.remove_tree_in_background(arg, workers=workers)
+                progress.complete(arg)
+            elif (workers > 1 or progress.active() or
+                    throttle.get_throttle() is not None):
+                # rmtree can't report progress or be throttled
+                failures.extend(treeutils.remove_tree(arg, workers=workers))
             else:
-                shutil.rmtree(arg, ignore_errors=ignore_errors)
+                fs.rmtree(arg, ignore_errors=ignore_errors)
         else:
-            os.unlink(arg)
+            throttle.wait(files=1)
+            fs.unlink(arg)
+            progress.advance()
+
+    maybe_result_exceptions(failures, ignore_errors)
+    return failures
 
 
 @require_args(min=2)
 @expand_paths()
 @require_readable_args()
 @require_writable_args(-1)
-def cp(*args, recursive=False, ignore_errors=False):
+@supports_throttle
+@supports_progress()
+@supports_dry_run(estimate.cp)
+def cp(*args, recursive=False, ignore_errors=False, workers=None,
+       backend='auto', dedupe=None, verify=False, cache=None):
     '''Copy files and/or directories.
 
     Parameters
@@ -92,50 +202,329 @@ def cp(*args, recursive=False, ignore_errors=False):
         target filepath/directory, all preceding args are copied. Each path
         is expanded as a glob pattern.
     recursive : bool
-        Whether to copy directories (recursively). 
+        Whether to copy directories (recursively).
+    ignore_errors : bool
+        If True, errors are printed rather than raised. Defaults to False.
+    workers : int or None
+        The number of threads to copy files with. Directory trees are
+        walked once and their files spread across the threads. Defaults
+        to None, meaning treeutils.DEFAULT_WORKERS.
+    backend : str or list of str
+        The copy backend(s) to use, e.g. 'reflink' to only accept
+        clones. See copyutils.copyfile. Defaults to 'auto', which uses
+        the fastest backend the filesystem supports.
+    dedupe : str or None
+        If 'hardlink' or 'reflink', files with identical contents are
+        only copied once, and the other copies are made hard links to or
+        reflinks of it. See dedupeutils.copy_deduplicated. Defaults to
+        None, copying every file.
+    verify : bool
+        If True, each copy's digest is compared with its source's, and
+        a mismatch fails with copyutils.VerificationError. Source
+        digests are looked up in the cache. Defaults to False.
+    cache : hashing.HashCache or None
+        The cache of digests used to verify copies and find identical
+        files. Defaults to None, meaning nosh.cache.get_cache().
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+    progress : callable or bool or None
+        If given, called with a nosh.progress.ProgressReport every
+        nosh.progress.DEFAULT_INTERVAL seconds, and when done. True
+        draws a nosh.progress.ProgressBar. Defaults to None.
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    Returns
+    -------
+    list of treeutils.CopyResult
+        One result per file copied, including the backend used. A
+        failure to copy one file does not stop the others being copied;
+        if ignore_errors is False the first failure is raised once every
+        file has been attempted.
     '''
+    fs = vfs.get_filesystem()
     target = args[-1]
     sources = args[:-1]
+    copyutils.get_backends(backend)
+    if dedupe is not None:
+        dedupeutils.check_mode(dedupe)
+        vfs.require_local('cp(dedupe=...)')
 
-    print('isdir is', path.isdir)
-
-    if not path.isdir(target) and len(sources) > 1:
+    if not fs.isdir(target) and len(sources) > 1:
         maybe_exception(NotADirectoryError,
                         ('Target is not a directory but multiple '
                          'sources were specified'),
                         ignore_errors)
 
-    if path.isdir(target):
+    file_jobs = []
+    tree_sources = []
+    if fs.isdir(target):
         for source in sources:
-            if path.isdir(source):
+            if fs.isdir(source):
                 if recursive:
                     dir_name = path.basename(source)
-                    shutil.copytree(source, path.join(target, dir_name))
+                    tree_sources.append((source, path.join(target, dir_name)))
                 else:
                     maybe_exception(IsADirectoryError,
                                     ('Tried to copy directory but '
                                      'recursive is False.'),
                                     ignore_errors)
             else:
-                shutil.copy(source, target)
+                file_jobs.append((source, target))
     else:
         source = sources[0]
 
-        if path.isdir(source) and path.exists(target):
+        if fs.isdir(source) and fs.exists(target):
             maybe_exception(NotADirectoryError,
                             ('Cannot copy directory to file that '
                              'already exists'),
                             ignore_errors)
-        elif path.isdir(source):
+        elif fs.isdir(source):
             if recursive:
-                shutil.copytree(source, target)
+                tree_sources.append((source, target))
             else:
                 maybe_exception(IsADirectoryError,
                                 ('Tried to copy directory but '
                                  'recursive is False.'),
                                 ignore_errors)
         else:
-            shutil.copy(source, target)
+            file_jobs.append((source, target))
+
+    copied_dirs = []
+    tree_jobs = (job for source, tree_target in tree_sources
+                 for job in treeutils.iter_tree_copy(
+                     source, tree_target, copied_dirs))
+    job_sets = [(file_jobs, partial(copyutils.copy, backend=backend)),
+                (tree_jobs, partial(copyutils.copy2, backend=backend))]
+    if verify:
+        job_sets = [(jobs, copyutils.verified(copy_function, cache))
+                    for jobs, copy_function in job_sets]
+
+    if dedupe is None:
+        results = []
+        for jobs, copy_function in job_sets:
+            results.extend(treeutils.copy_files(
+                jobs, workers=workers, copy_function=copy_function))
+    else:
+        results = dedupeutils.copy_deduplicated(
+            job_sets, dedupe, cache=cache, workers=workers)
+    results.extend(treeutils.copy_dir_stats(copied_dirs))
+
+    maybe_result_exceptions(results, ignore_errors)
+    return results
+
+
+@require_args(min=2)
+@expand_paths()
+@require_readable_args()
+@require_writable_args(-1)
+@supports_throttle
+def sync(*args, checksum=False, delete=False, dry_run=False,
+         ignore_errors=False, workers=None, backend='auto', cache=None):
+    '''Copy files and directories, skipping any that are already up to
+    date at the target.
+
+    Arguments are handled as for cp with recursive=True, except that
+    when syncing directories the target is always the directory to sync
+    them into (created if necessary), so repeating a sync is a no-op.
+
+    Parameters
+    ----------
+    *args : strings
+        The paths to sync, and the target. If the target is a directory,
+        or any path to sync is a directory, each path is synced to a path
+        of the same name inside the target. Otherwise there may only be
+        one file to sync, and it is synced to the target path directly.
+    checksum : bool
+        If True, files of the same size are compared by content digest.
+        If False (the default) they are compared by modification time.
+    delete : bool
+        If True, files and directories in the target trees that are not
+        in the source trees are deleted. Defaults to False.
+    dry_run : bool
+        If True, nothing is changed and the returned summary describes
+        what would have been done. Defaults to False.
+    ignore_errors : bool
+        If True, errors are printed rather than raised. Defaults to False.
+    workers : int or None
+        The number of threads to copy files with, see cp.
+    backend : str or list of str
+        The copy backend(s) to use, see cp.
+    cache : hashing.HashCache or None
+        The cache of digests used when ``checksum`` is True. Defaults to
+        None, meaning nosh.cache.get_cache().
+    throttle : nosh.throttle.Throttle or None
+        Limits on the bytes and files per second, in place of the
+        default set with nosh.throttle.set_default_throttle. Defaults to
+        None.
+
+    Returns
+    -------
+    treeutils.SyncSummary
+        The files copied, skipped and deleted, and the bytes transferred
+        and skipped.
+    '''
+    fs = vfs.get_filesystem()
+    target = args[-1]
+    sources = args[:-1]
+    copyutils.get_backends(backend)
+
+    if fs.isdir(target) or any(fs.isdir(source) for source in sources):
+        if fs.exists(target) and not fs.isdir(target):
+            raise NotADirectoryError(
+                'Cannot sync directories into {}, it is not a '
+                'directory'.format(target))
+        if not fs.exists(target) and not dry_run:
+            fs.makedirs(target)
+        pairs = [(source, path.join(target, path.basename(source)))
+                 for source in sources]
+    elif len(sources) > 1:
+        maybe_exception(NotADirectoryError,
+                        ('Target is not a directory but multiple '
+                         'sources were specified'),
+                        ignore_errors)
+        pairs = []
+    else:
+        pairs = [(sources[0], target)]
+
+    syncer = treeutils.Syncer(checksum=checksum, delete=delete,
+                               dry_run=dry_run, cache=cache)
+
+    def jobs():
+        for source, source_target in pairs:
+            if fs.isdir(source):
+                yield from syncer.iter_tree(source, source_target)
+            else:
+                yield from syncer.iter_file(source, source_target)
+
+    results = treeutils.copy_files(
+        jobs(), workers=workers,
+        copy_function=partial(copyutils.copy2, backend=backend))
+    if not dry_run:
+        results.extend(treeutils.copy_dir_stats(syncer.copied_dirs))
+
+    summary = syncer.summary(results)
+    maybe_result_exceptions(summary.errors, ignore_errors)
+    return summary
+
+
+@vfs.local_only
+@require_args(min=1)
+@expand_paths()
+@require_writable_args()
+def dedupe(*args, mode='hardlink', cache=None, dry_run=False,
+           ignore_errors=False, workers=None):
+    '''Replace files with identical contents with links to one copy.
+
+    Parameters
+    ----------
+    *args : strings
+        The files and directories to deduplicate, searched recursively.
+        Duplicates are found across all of them.
+    mode : str
+        'hardlink' to replace duplicates with hard links to the first
+        copy, which then share its permissions and timestamps, or
+        'reflink' to replace them with copy-on-write clones, which keep
+        their own. Defaults to 'hardlink'.
+    cache : hashing.HashCache or None
+        The cache of digests to look up and store in, so repeated runs
+        only read files that changed. Defaults to None, meaning
+        nosh.cache.get_cache().
+    dry_run : bool
+        If True, nothing is changed and the returned summary describes
+        what would have been done. Defaults to False.
+    ignore_errors : bool
+        If True, errors are printed rather than raised. Defaults to False.
+    workers : int or None
+        The number of threads to walk directories and hash files with.
+        Defaults to None, meaning treeutils.DEFAULT_WORKERS.
+
+    Returns
+    -------
+    dedupeutils.DedupeSummary
+        The files linked and the bytes saved.
+    '''
+    dedupeutils.check_mode(mode)
+    filens = (entry.path for entry in findutils.walk(
+        args, findutils.Matcher(type='f'), workers))
+    groups = dedupeutils.find_duplicate_stats(filens, cache, workers=workers)
+    summary = dedupeutils.link_duplicates(groups, mode, dry_run=dry_run)
+    maybe_result_exceptions(summary.errors, ignore_errors)
+    return summary
+
+
+@require_args(min=1)
+@expand_paths()
+@require_readable_args()
+@supports_dry_run(estimate.checksum)
+def checksum(*args, algorithm=hashing.DEFAULT_ALGORITHM, recursive=False,
+             cache=None, ignore_errors=False, workers=None):
+    '''Compute the digests of files' contents, like sha256sum.
+
+    Parameters
+    ----------
+    *args : strings
+        The files to hash. Each path is expanded as a glob pattern.
+    algorithm : str
+        Any algorithm name accepted by hashlib.new. Defaults to
+        hashing.DEFAULT_ALGORITHM.
+    recursive : bool
+        Whether to hash every file in directories (recursively).
+    cache : hashing.HashCache or None
+        The cache of digests to look up and store in, so unchanged files
+        aren't read again. Defaults to None, meaning
+        nosh.cache.get_cache().
+    ignore_errors : bool
+        If True, errors are printed rather than raised. Defaults to False.
+    workers : int or None
+        The number of threads to hash files with. Defaults to None,
+        meaning treeutils.DEFAULT_WORKERS.
+    dry_run : bool
+        If True, nothing is changed and a nosh.estimate.DryRunReport of
+        what would be done is returned instead. Defaults to False.
+
+    Returns
+    -------
+    list of (str, str)
+        The path and hex digest of each file, in the order given, with
+        the files in a directory sorted by path.
+    '''
+    fs = vfs.get_filesystem()
+    cache = get_cache(cache)
+
+    filens = []
+    for arg in args:
+        if not fs.isdir(arg):
+            filens.append(arg)
+        elif recursive:
+            filens.extend(sorted(entry.path for entry in findutils.walk(
+                [arg], findutils.Matcher(type='f'), workers)))
+        else:
+            maybe_exception(IsADirectoryError,
+                            ('Tried to checksum directory {} but recursive '
+                             'is False.'.format(arg)),
+                            ignore_errors)
+
+    def hash_file(filen):
+        try:
+            return filen, cache.digest(filen, algorithm)
+        except OSError as error:
+            return filen, error
+
+    digests = dict(treeutils.map_bounded(hash_file, filens, workers))
+    results = []
+    for filen in filens:
+        digest = digests[filen]
+        if isinstance(digest, OSError):
+            if not ignore_errors:
+                raise digest
+            print('Ignoring error: {}'.format(digest))
+        else:
+            results.append((filen, digest))
+    return results
 
 
 def pwd():
@@ -144,7 +533,30 @@ def pwd():
 
 @expand_paths(do_glob=False)
 @require_readable_args()
-def ls(*args):
+def ls(*args, long=False, sort=None, reverse=False):
+    '''List the contents of directories.
+
+    Parameters
+    ----------
+    *args : strings
+        The directories, files or glob patterns to list. Defaults to the
+        current directory.
+    long : bool
+        If True, return entries.Entry objects instead of names. These
+        know whether they are directories without any further system
+        calls, and load their stat data lazily. Defaults to False.
+    sort : str or None
+        Sort each listing by 'name', 'size' or 'mtime'. Defaults to
+        None, leaving items in the order the OS returns them.
+    reverse : bool
+        Whether to reverse the sort order. Defaults to False.
+
+    Returns
+    -------
+    list, or dict of lists
+        The listing, or if args from multiple directories were given a
+        dict mapping each directory to its listing.
+    '''
     if not args:
         args = ['.']
 
@@ -152,45 +564,127 @@ def ls(*args):
         # can't catch this arg
         if not state.is_readable('.'):
             raise state.NotReadableError()
+    fs = vfs.get_filesystem()
     results = defaultdict(lambda: [])
+    scanned_dirs = set()
     for arg in args:
-        if path.isdir(arg):
-            results[arg] = os.listdir(arg)
-        elif path.exists(arg):  # arg is a file
-            results[path.dirname(arg)].append(arg)
+        if fs.isdir(arg):
+            results[arg] = entries.scan(arg)
+            scanned_dirs.add(arg)
+        elif fs.exists(arg):  # arg is a file
+            results[path.dirname(arg)].append(entries.Entry.from_path(arg))
         else:
-            results[path.dirname(arg)].extend(glob.glob(arg))
+            results[path.dirname(arg)].extend(
+                entries.Entry.from_path(filen) for filen in globbing.glob(arg))
+
+    for dir_name, listing in results.items():
+        if sort is not None:
+            entries.sort_entries(listing, sort, reverse=reverse)
+        if not long:
+            results[dir_name] = [
+                entry.name if dir_name in scanned_dirs else entry.path
+                for entry in listing]
+
     if len(results) == 1:
         return results[list(results.keys())[0]]
     return results
 
 
+def ls_entries(*args, sort=None, reverse=False):
+    '''Equivalent to ls(*args, long=True, ...).'''
+    return ls(*args, long=True, sort=sort, reverse=reverse)
+
+
+@expand_paths(do_glob=False)
+@require_readable_args()
+def find(*args, name=None, type=None, size=None, newer=None, mindepth=0,
+         maxdepth=None, prune=None, long=False, workers=None):
+    '''Recursively search directories, yielding each matching path as
+    soon as it is found.
+
+    Parameters
+    ----------
+    *args : strings
+        The directories to search. Defaults to the current directory.
+        Each is itself a candidate result, at depth 0.
+    name : str or list of str
+        Only yield items whose name matches this glob pattern, or any of
+        these patterns.
+    type : str
+        Only yield files ('f'), directories ('d') or symlinks ('l').
+    size : int or str
+        Only yield items of this size, e.g. 1024 (exactly 1024 bytes),
+        '+10M' (more than 10 MiB) or '-4k' (less than 4 KiB).
+    newer : str or float
+        Only yield items modified more recently than this path, or this
+        timestamp.
+    mindepth : int
+        Don't yield items less than this many levels below the search
+        directories. Defaults to 0.
+    maxdepth : int or None
+        Don't descend more than this many levels below the search
+        directories. Defaults to None, no limit.
+    prune : str, list of str or callable
+        Don't descend into directories whose names match these glob
+        patterns, or for which ``prune(entry)`` returns True. Pruned
+        directories are never read, though they may still be yielded.
+    long : bool
+        If True, yield entries.Entry objects rather than paths, see ls.
+        Defaults to False.
+    workers : int or None
+        The number of threads to read directories with. If more than 1,
+        results are no longer yielded in a depth first order. Defaults to
+        None, meaning treeutils.DEFAULT_WORKERS.
+    '''
+    if not args:
+        args = [expand_path('.')]
+
+        # Do an extra check if the dir is readable, as the decorator
+        # can't catch this arg
+        if not state.is_readable('.'):
+            raise state.NotReadableError()
+
+    matcher = findutils.Matcher(
+        name=name, type=type, size=size, newer=newer, mindepth=mindepth,
+        maxdepth=maxdepth, prune=prune)
+    return _find(args, matcher, long, workers)
+
+
+def _find(roots, matcher, long, workers):
+    for entry in findutils.walk(roots, matcher, workers=workers):
+        yield entry if long else entry.path
+
+
 @expand_paths(do_glob=False)
+@supports_dry_run(estimate.mkdir)
 def mkdir(dir_name, mode=511, parents=False, exist_ok=False):
-    if path.exists(dir_name):
+    fs = vfs.get_filesystem()
+    if fs.exists(dir_name):
         if not exist_ok:
             raise FileExistsError(
                 'Cannot make dir at {}, it already exists'.format(dir_name))
         else:
             return
     if parents:
-        os.makedirs(dir_name, mode=mode, exist_ok=exist_ok)
+        fs.makedirs(dir_name, mode=mode, exist_ok=exist_ok)
     else:
-        os.mkdir(dir_name, mode=mode)
+        fs.mkdir(dir_name, mode=mode)
 
 
 @expand_paths()
+@supports_dry_run(estimate.touch)
 def touch(*args):
     '''Highly incomplete touch implementation (currently only can create
     empty files or touch existing ones).
     '''
+    fs = vfs.get_filesystem()
     for filen in args:
-        if path.isdir(filen):
+        if fs.isdir(filen):
             raise OSError(
                 'Cannot touch {}, directory of that name exists'.format(filen))
-        if not path.exists(filen):
-            with open(filen, 'w'):
+        if not fs.exists(filen):
+            with fs.open(filen, 'w'):
                 pass
         else:
-            with open(filen, 'r'):
+            with fs.open(filen, 'r'):
                 pass
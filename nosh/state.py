@@ -1,54 +1,124 @@
 '''Module for maintaining and manipulating nosh's global state
-regarding directories that are currently readable or writable.  '''
+regarding directories that are currently readable or writable.
+
+The state is held in context variables, so each thread and asyncio
+task sees its own readable and writable paths: entering e.g.
+set_readable in one task or thread does not affect any other. Tasks
+start with a copy of the state of the code that created them, while
+new threads start from the process-wide default unless run with
+``contextvars.copy_context().run``.
+
+The default is everything readable and writable. To confine every
+thread, including ones started by other libraries, set the default
+with set_default_readable and set_default_writable (or
+set_default_valid) rather than entering set_readable etc.
+'''
 
 from contextlib import contextmanager
-from os.path import isdir, isfile, relpath, split
-from collections import defaultdict
-import copy
-
-READABLE_PATHS_STACK = []
-WRITABLE_PATHS_STACK = []
-CURRENT_READABLE_PATHS = set('/')
-CURRENT_WRITABLE_PATHS = set('/')
-RESTRICT_PATHS = False
+from contextvars import ContextVar
+from os.path import (isdir, isfile, relpath, split, abspath, normpath,
+                     dirname, isabs)
+from functools import lru_cache
+
+CHECK_CACHE_SIZE = 4096
 
-def _push_readable():
-    READABLE_PATHS_STACK.append(CURRENT_READABLE_PATHS.copy())
 
-def _push_writable():
-    WRITABLE_PATHS_STACK.append(CURRENT_WRITABLE_PATHS.copy())
+class PathIndex(object):
+    '''An index of allowed root paths, answering whether a path is
+    inside any of them.
 
-def _pop_readable():
-    global CURRENT_READABLE_PATHS
-    CURRENT_READABLE_PATHS = READABLE_PATHS_STACK.pop()
+    Rather than comparing the path against every root in turn, the
+    path's own ancestors are looked up in a set of the normalised roots,
+    so a check costs O(path depth) however many roots there are.
+    '''
+
+    def __init__(self, paths):
+        self.paths = paths = frozenset(paths)
+        self.absolute = frozenset(normpath(p) for p in paths if isabs(p))
+        # Relative roots depend on the working directory at the time of
+        # each check, so can't be normalised up front
+        self.relative = tuple(p for p in paths if not isabs(p))
+
+    def contains(self, path):
+        if self.relative and is_subpath(path, self.relative):
+            return True
+        if isabs(path) and not self.relative:
+            return _cached_contains(self, path)
+        return self._contains(abspath(path))
+
+    def _contains(self, path):
+        path = normpath(path)
+        while True:
+            if path in self.absolute:
+                return True
+            parent = dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+
+@lru_cache(maxsize=CHECK_CACHE_SIZE)
+def _cached_contains(index, path):
+    return index._contains(path)
+
+
+RESTRICT_PATHS = False
 
-def _pop_writable():
-    global CURRENT_WRITABLE_PATHS
-    CURRENT_WRITABLE_PATHS = WRITABLE_PATHS_STACK.pop()
+_default_readable = PathIndex({'/'})
+_default_writable = PathIndex({'/'})
+_READABLE = ContextVar('nosh_readable', default=None)
+_WRITABLE = ContextVar('nosh_writable', default=None)
+
+def _readable_index():
+    index = _READABLE.get()
+    return _default_readable if index is None else index
+
+def _writable_index():
+    index = _WRITABLE.get()
+    return _default_writable if index is None else index
 
 def get_readable():
-    return CURRENT_READABLE_PATHS
+    return _readable_index().paths
 
 def get_writable():
-    return CURRENT_WRITABLE_PATHS
+    return _writable_index().paths
+
+def set_default_readable(*args):
+    '''Make ``args`` the readable paths outside any set_readable or
+    push_readable block, in every thread. Returns the previous default
+    paths.'''
+    global _default_readable
+    previous, _default_readable = _default_readable, PathIndex(args)
+    return previous.paths
+
+def set_default_writable(*args):
+    '''As set_default_readable, for the writable paths.'''
+    global _default_writable
+    previous, _default_writable = _default_writable, PathIndex(args)
+    return previous.paths
+
+def set_default_valid(*args):
+    '''Set both the default readable and writable paths. Returns the
+    previous defaults as a (readable, writable) pair.'''
+    return set_default_readable(*args), set_default_writable(*args)
+
+@contextmanager
+def _set_index(var, paths):
+    token = var.set(PathIndex(paths))
+    try:
+        yield
+    finally:
+        var.reset(token)
 
 @contextmanager
 def push_readable(*args):
-    global CURRENT_READABLE_PATHS
-    _push_readable()
-    for arg in args:
-        CURRENT_READABLE_PATHS.add(arg)
-    yield
-    _pop_readable()
-            
+    with _set_index(_READABLE, get_readable().union(args)):
+        yield
+
 @contextmanager
 def push_writable(*args):
-    global CURRENT_WRITABLE_PATHS
-    _push_writable()
-    for arg in args:
-        CURRENT_WRITABLE_PATHS.add(arg)
-    yield
-    _pop_writable()
+    with _set_index(_WRITABLE, get_writable().union(args)):
+        yield
 
 @contextmanager
 def push_valid(*args):
@@ -57,19 +127,13 @@ def push_valid(*args):
 
 @contextmanager
 def set_readable(*args):
-    global CURRENT_READABLE_PATHS
-    _push_readable()
-    CURRENT_READABLE_PATHS = set(args)
-    yield
-    _pop_readable()
-    
+    with _set_index(_READABLE, args):
+        yield
+
 @contextmanager
 def set_writable(*args):
-    global CURRENT_WRITABLE_PATHS
-    _push_writable()
-    CURRENT_WRITABLE_PATHS = set(args)
-    yield
-    _pop_writable()
+    with _set_index(_WRITABLE, args):
+        yield
 
 @contextmanager
 def set_valid(*args):
@@ -85,10 +149,10 @@ def no_valid_paths():
         yield
 
 def is_readable(path):
-    return is_subpath(path, CURRENT_READABLE_PATHS)
+    return _readable_index().contains(path)
 
 def is_writable(path):
-    return is_subpath(path, CURRENT_WRITABLE_PATHS)
+    return _writable_index().contains(path)
 
 def is_subpath(path, start_paths):
     for start_path in start_paths:
@@ -0,0 +1,102 @@
+'''Sidecar indexes for tarballs.
+
+An index records, for every member of a tarball, its name, type,
+metadata and offsets within the (uncompressed) tar stream. It is stored
+as JSON beside the tarball, at ``<tarball>.idx``, along with the size
+and modification time of the tarball it describes so that stale indexes
+are ignored.
+
+With an index, listing a tarball doesn't need to read it at all, and
+extracting individual members can seek straight to their data rather
+than reading every header before them.
+'''
+
+import json
+import os
+import tarfile
+
+from nosh import state
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+
+_FIELDS = ('name', 'type', 'size', 'mode', 'mtime', 'linkname', 'uid',
+           'gid', 'uname', 'gname', 'offset', 'offset_data')
+
+
+def index_path(tar_path):
+    '''Return the path of the index for the tarball at ``tar_path``.'''
+    return tar_path + INDEX_SUFFIX
+
+
+def tarinfo_to_entry(tarinfo):
+    entry = {field: getattr(tarinfo, field) for field in _FIELDS}
+    entry['type'] = entry['type'].decode('ascii')
+    return entry
+
+
+def entry_to_tarinfo(entry):
+    '''Return a tarfile.TarInfo for the index ``entry``. It can be passed
+    to TarFile.extract on the tarball the index describes.'''
+    tarinfo = tarfile.TarInfo(entry['name'])
+    for field in _FIELDS:
+        setattr(tarinfo, field, entry[field])
+    tarinfo.type = entry['type'].encode('ascii')
+    return tarinfo
+
+
+def set_offsets(added, end):
+    '''Fill in the offsets of members just written to a tarball, which
+    tarfile only records when reading.
+
+    ``added`` is a list of (tarinfo, offset) pairs, each with the
+    TarFile.offset at which its header began, and ``end`` is the offset
+    after the last member.
+    '''
+    ends = [offset for _, offset in added[1:]] + [end]
+    for (tarinfo, offset), member_end in zip(added, ends):
+        data_size = 0
+        if tarinfo.isreg():
+            data_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        tarinfo.offset = offset
+        tarinfo.offset_data = member_end - data_size
+
+
+def _tar_signature(tar_path):
+    tar_stat = os.stat(tar_path)
+    return [tar_stat.st_size, tar_stat.st_mtime_ns]
+
+
+def write_index(tar_path, members):
+    '''Write the index of ``tar_path`` from its list of TarInfo
+    ``members``.
+
+    The index is only written if it is writable according to nosh.state
+    and the filesystem; returns True if it was written.
+    '''
+    filen = index_path(tar_path)
+    if not state.is_writable(filen):
+        return False
+    index = {'version': INDEX_VERSION,
+             'tarball': _tar_signature(tar_path),
+             'members': [tarinfo_to_entry(member) for member in members]}
+    try:
+        with open(filen, 'w') as fileh:
+            json.dump(index, fileh)
+    except OSError:
+        return False
+    return True
+
+
+def load_index(tar_path):
+    '''Return the list of index entries for ``tar_path``, or None if it
+    has no index or the index is out of date.'''
+    try:
+        with open(index_path(tar_path)) as fileh:
+            index = json.load(fileh)
+    except (OSError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION or
+            index.get('tarball') != _tar_signature(tar_path)):
+        return None
+    return index['members']
@@ -0,0 +1,169 @@
+'''Limiting the disk bandwidth and operations of bulk commands.
+
+A Throttle holds a token bucket for bytes and one for files. The copy,
+delete and archive paths take tokens from the current throttle as they
+go, sleeping whenever a bucket runs dry, so the sustained rate never
+exceeds the limits but up to ``burst`` seconds' worth can go at full
+speed after a quiet spell:
+
+    nosh.throttle.set_default_throttle(
+        nosh.throttle.Throttle(bytes_per_second=50e6,
+                               files_per_second=2000))
+
+or for a single call:
+
+    slow = nosh.throttle.Throttle(bytes_per_second=10e6)
+    nosh.cp('data', '/backup', recursive=True, throttle=slow)
+    slow.throttled  # seconds spent waiting
+
+Bytes are taken as file data is copied, in COPY_CHUNK_SIZE pieces, by
+the kernel and userspace copy backends (a reflink moves no data, so only
+takes a file token), and as each archive member is added or extracted.
+Files are taken for each file copied, removed, renamed or archived.
+
+A Throttle may be shared by many commands and threads, which then share
+its limits. The time a command waits is also recorded as its
+'throttled' phase by nosh.instrumentation.
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from nosh import instrumentation
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+'''The most bytes copied by a kernel copy backend between checks of the
+throttle.'''
+
+
+class TokenBucket(object):
+    '''``rate`` tokens are added per second, up to ``capacity``.
+
+    Tokens can be overdrawn: a take larger than the tokens available
+    always succeeds, and returns how long to wait before the bucket is
+    back in credit, so later takes (e.g. by other threads) queue behind
+    it.
+    '''
+
+    def __init__(self, rate, capacity):
+        if rate <= 0:
+            raise ValueError('rate must be positive, got {}'.format(rate))
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        '''Take ``amount`` tokens, returning the seconds to wait before
+        using them.'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens / self.rate
+
+
+class Throttle(object):
+    '''Limits on the rate of bytes and files processed.
+
+    Parameters
+    ----------
+    bytes_per_second : float or None
+        The sustained bytes per second allowed. Defaults to None, no
+        limit.
+    files_per_second : float or None
+        The sustained files per second allowed. Defaults to None, no
+        limit.
+    burst : float
+        The seconds' worth of each rate that may be used at once after
+        a pause. Defaults to 1.
+
+    Attributes
+    ----------
+    throttled : float
+        The total seconds spent waiting for this throttle.
+    '''
+
+    def __init__(self, bytes_per_second=None, files_per_second=None,
+                 burst=1.):
+        self.bytes_per_second = bytes_per_second
+        self.files_per_second = files_per_second
+        self.burst = burst
+        self._bytes = self._files = None
+        if bytes_per_second is not None:
+            self._bytes = TokenBucket(bytes_per_second,
+                                      bytes_per_second * burst)
+        if files_per_second is not None:
+            self._files = TokenBucket(files_per_second,
+                                      max(files_per_second * burst, 1))
+        self.throttled = 0.
+        self._lock = threading.Lock()
+
+    def wait(self, files=0, nbytes=0):
+        '''Take ``files`` files and ``nbytes`` bytes from the buckets,
+        sleeping if they are overdrawn. Returns the seconds slept.'''
+        delay = 0.
+        if files and self._files is not None:
+            delay = self._files.take(files)
+        if nbytes and self._bytes is not None:
+            delay = max(delay, self._bytes.take(nbytes))
+        if delay > 0:
+            time.sleep(delay)
+            with self._lock:
+                self.throttled += delay
+            record = instrumentation.current_call()
+            if record is not None:
+                record.add_time('throttled', delay)
+        return delay
+
+    def __repr__(self):
+        return '<Throttle {} bytes/s, {} files/s>'.format(
+            self.bytes_per_second, self.files_per_second)
+
+
+_default_throttle = None
+_THROTTLE = ContextVar('nosh_throttle', default=None)
+
+
+def set_default_throttle(throttle):
+    '''Make ``throttle`` apply outside any use_throttle block, in every
+    thread, or remove the limits if it is None. Returns the previous
+    default.'''
+    global _default_throttle
+    previous, _default_throttle = _default_throttle, throttle
+    return previous
+
+
+@contextmanager
+def use_throttle(throttle):
+    '''Context manager making commands run within it use ``throttle``
+    in place of the default.'''
+    token = _THROTTLE.set(throttle)
+    try:
+        yield throttle
+    finally:
+        _THROTTLE.reset(token)
+
+
+def get_throttle():
+    '''Return the Throttle set with use_throttle, or the default, or
+    None if there are no limits.'''
+    throttle = _THROTTLE.get()
+    if throttle is None:
+        return _default_throttle
+    return throttle
+
+
+def wait(files=0, nbytes=0):
+    '''Call Throttle.wait on the current throttle, if any.'''
+    throttle = get_throttle()
+    if throttle is None:
+        return 0.
+    return throttle.wait(files, nbytes)
@@ -0,0 +1,486 @@
+'''Utilities for operating on whole directory trees, optionally
+spreading the per-file work across a pool of threads.
+'''
+
+from os import path
+import contextvars
+import threading
+import uuid
+from collections import namedtuple, deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from nosh import copyutils
+from nosh import progress
+from nosh import throttle
+from nosh import vfs
+from nosh.cache import get_cache
+from nosh.utils import check_cancelled
+
+DEFAULT_WORKERS = 1
+'''The number of threads used by tree operations when no explicit
+``workers`` argument is given. 1 means everything runs serially in the
+calling thread.'''
+
+CopyResult = namedtuple('CopyResult', ['source', 'target', 'error', 'backend'])
+CopyResult.__new__.__defaults__ = (None, None)
+
+
+def get_workers(workers=None):
+    '''Return ``workers``, or DEFAULT_WORKERS if it is None.'''
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    if workers < 1:
+        raise ValueError('workers must be at least 1, got {}'.format(workers))
+    return workers
+
+
+def iter_tree_copy(source, target, copied_dirs=None):
+    '''Walk the tree at ``source`` once, creating the matching directory
+    structure under ``target`` and yielding a (source, target) pair for
+    every file that must be copied.
+
+    Directories are always created before any of their files are
+    yielded, so the pairs can be copied in any order. ``target`` must
+    not already exist.
+
+    Errors reading individual subdirectories are yielded as
+    (source, target, exception) triples rather than raised, so one
+    unreadable directory does not stop the rest of the copy.
+
+    If ``copied_dirs`` is a list, every (source, target) directory pair
+    created is appended to it, for use with copy_dir_stats once the
+    files have been copied.
+    '''
+    fs = vfs.get_filesystem()
+    fs.makedirs(target)
+    if copied_dirs is None:
+        copied_dirs = []
+    copied_dirs.append((source, target))
+    pending = deque([(source, target)])
+    while pending:
+        src_dir, dst_dir = pending.popleft()
+        try:
+            with fs.scandir(src_dir) as entries:
+                entries = list(entries)
+        except OSError as error:
+            yield (src_dir, dst_dir, error)
+            continue
+        for entry in entries:
+            dst = path.join(dst_dir, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                try:
+                    fs.mkdir(dst)
+                except OSError as error:
+                    yield (entry.path, dst, error)
+                    continue
+                copied_dirs.append((entry.path, dst))
+                pending.append((entry.path, dst))
+            else:
+                yield (entry.path, dst)
+
+
+def copy_dir_stats(copied_dirs):
+    '''Copy the permission bits and timestamps of each (source, target)
+    directory pair, as shutil.copytree does once a directory's contents
+    have been copied.
+
+    Deepest directories go first, so that e.g. read-only modes don't
+    block updates to their children.
+
+    Returns
+    -------
+    list of CopyResult
+        Results for the directories whose metadata could not be copied.
+    '''
+    fs = vfs.get_filesystem()
+    results = []
+    for src_dir, dst_dir in reversed(copied_dirs):
+        try:
+            fs.copystat(src_dir, dst_dir)
+        except OSError as error:
+            results.append(CopyResult(src_dir, dst_dir, error))
+    return results
+
+
+def map_bounded(func, items, workers=None):
+    '''Yield ``func(item)`` for each of ``items``, calling it in
+    ``workers`` threads.
+
+    Only a bounded number of calls are queued at once, so ``items`` may
+    be a generator walking a huge tree. Results are yielded in the order
+    the calls finish. Each call runs with a copy of the calling thread's
+    context, so e.g. nosh.state applies in the worker threads too.
+    '''
+    workers = get_workers(workers)
+
+    if workers == 1:
+        for item in items:
+            check_cancelled()
+            yield func(item)
+        return
+
+    max_pending = workers * 4
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            check_cancelled()
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(
+                contextvars.copy_context().run, func, item))
+        for future in pending:
+            yield future.result()
+
+
+def _copy_job(copy_function, job):
+    if len(job) == 3:
+        return CopyResult(*job)
+    source, target = job
+    try:
+        backend = copy_function(source, target)
+    except OSError as error:
+        return CopyResult(source, target, error)
+    return CopyResult(source, target, None, backend)
+
+
+def copy_files(jobs, workers=None, copy_function=copyutils.copy2):
+    '''Copy every (source, target) pair in ``jobs``.
+
+    Parameters
+    ----------
+    jobs : iterable
+        Pairs of (source, target) paths. Triples of (source, target,
+        exception) are passed straight through as failed results, as
+        produced by iter_tree_copy. ``jobs`` is consumed lazily, so it
+        may be a generator walking a very large tree.
+    workers : int or None
+        The number of threads to copy with. Defaults to DEFAULT_WORKERS.
+    copy_function : callable
+        The function used to copy each file, returning the name of the
+        copy backend it used. Defaults to copyutils.copy2.
+
+    Returns
+    -------
+    list of CopyResult
+        One result per job, with ``error`` set to the exception raised
+        for that file, or None if it was copied successfully, and
+        ``backend`` set to the copy backend used. Failures do not stop
+        the remaining jobs from running.
+    '''
+    return list(map_bounded(partial(_copy_job, copy_function), jobs,
+                            workers=workers))
+
+
+RemoveResult = namedtuple('RemoveResult', ['path', 'error'])
+
+
+def _remove_job(job):
+    filen, is_dir = job
+    fs = vfs.get_filesystem()
+    throttle.wait(files=1)
+    try:
+        if is_dir:
+            fs.rmdir(filen)
+        else:
+            fs.unlink(filen)
+    except OSError as error:
+        return RemoveResult(filen, error)
+    return None
+
+
+def remove_tree(root, workers=None):
+    '''Delete the directory ``root`` and everything in it.
+
+    The tree is read with scandir, and files are unlinked across
+    ``workers`` threads as they are found. Once every file is gone the
+    directories are removed deepest first, each level again spread
+    across the threads. Symlinks are removed, never followed.
+
+    Returns
+    -------
+    list of RemoveResult
+        A result for each path that could not be removed. Failures do
+        not stop the rest of the tree being removed, though directories
+        still containing files will fail too.
+    '''
+    fs = vfs.get_filesystem()
+    if fs.islink(root):
+        # as shutil.rmtree, never delete the contents of a linked dir
+        raise OSError('Cannot remove tree at symbolic link {}'.format(root))
+    dirs_by_depth = []
+
+    def files():
+        pending = [(root, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            if len(dirs_by_depth) <= depth:
+                dirs_by_depth.append([])
+            dirs_by_depth[depth].append(directory)
+            try:
+                with fs.scandir(directory) as entries:
+                    entries = list(entries)
+            except OSError as error:
+                yield (directory, error)
+                continue
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    pending.append((entry.path, depth + 1))
+                else:
+                    yield (entry.path, False)
+
+    def remove(job):
+        if isinstance(job[1], Exception):
+            return RemoveResult(*job)
+        result = _remove_job(job)
+        if result is None:
+            progress.advance()
+        return result
+
+    failures = [result for result in map_bounded(remove, files(), workers)
+                if result is not None]
+    for dirs in reversed(dirs_by_depth):
+        failures.extend(
+            result for result in map_bounded(
+                _remove_job, ((directory, True) for directory in dirs),
+                workers)
+            if result is not None)
+    return failures
+
+
+_BACKGROUND_REMOVALS = set()
+_BACKGROUND_LOCK = threading.Lock()
+
+TRASH_PREFIX = '.nosh-trash-'
+
+
+def trash_path(filen):
+    '''Return a new, unused path next to ``filen`` to move it to before
+    deleting it in the background.'''
+    directory, name = path.split(path.normpath(filen))
+    return path.join(directory, '{}{}-{}'.format(
+        TRASH_PREFIX, name, uuid.uuid4().hex))
+
+
+def remove_tree_in_background(root, workers=None):
+    '''Move the directory ``root`` to a trash path beside it, then
+    delete it with remove_tree in a background thread.
+
+    ``root`` disappears as soon as this returns. Raises OSError if it
+    is a symbolic link, as remove_tree does. The thread is not a
+    daemon, so the interpreter waits for it before exiting; call
+    wait_for_background_removals to wait sooner. Errors in the
+    background are printed rather than raised.
+
+    Returns
+    -------
+    str
+        The trash path the tree is being deleted from.
+    '''
+    fs = vfs.get_filesystem()
+    if fs.islink(root):
+        # Checked before the rename, to raise here rather than in the
+        # thread, and leave the link where it is
+        raise OSError('Cannot remove tree at symbolic link {}'.format(root))
+    trash = trash_path(root)
+    fs.rename(root, trash)
+
+    def remove():
+        progress.detach()
+        try:
+            for failure in remove_tree(trash, workers=workers):
+                print('Error removing {} in the background: {}'.format(
+                    failure.path, failure.error))
+        except Exception as error:
+            print('Error removing {} in the background: {}'.format(
+                trash, error))
+        finally:
+            with _BACKGROUND_LOCK:
+                _BACKGROUND_REMOVALS.discard(thread)
+
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(remove, ), name='nosh-rm-background')
+    with _BACKGROUND_LOCK:
+        _BACKGROUND_REMOVALS.add(thread)
+    thread.start()
+    return trash
+
+
+def wait_for_background_removals(timeout=None):
+    '''Wait for every removal started by remove_tree_in_background to
+    finish. Returns True if they all finished within ``timeout``
+    seconds (or no timeout was given).'''
+    with _BACKGROUND_LOCK:
+        threads = list(_BACKGROUND_REMOVALS)
+    for thread in threads:
+        thread.join(timeout)
+    return not any(thread.is_alive() for thread in threads)
+
+
+SyncSummary = namedtuple('SyncSummary', [
+    'copied', 'skipped', 'deleted', 'bytes_transferred', 'bytes_skipped',
+    'errors'])
+'''The outcome of a sync. ``copied`` holds the (source, target) pairs
+copied, ``skipped`` the target paths already up to date, ``deleted`` the
+extraneous target paths removed and ``errors`` a CopyResult for each
+failure. In a dry run, these are what would have happened.'''
+
+
+def file_unchanged(source_stat, target_stat, source, target, checksum=False,
+                   cache=None):
+    '''Return True if the file ``target`` already matches ``source``.
+
+    Files of different sizes always differ. Otherwise, if ``checksum``
+    is True the contents are compared by digest, looked up in ``cache``
+    (see nosh.cache.get_cache) where possible, and if not the files are
+    assumed equal if their modification times match to the second (the
+    same rule rsync uses by default).
+    '''
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    if checksum:
+        cache = get_cache(cache)
+        return (cache.digest(source, stat_result=source_stat) ==
+                cache.digest(target, stat_result=target_stat))
+    return int(source_stat.st_mtime) == int(target_stat.st_mtime)
+
+
+def _remove_path(filen, is_dir):
+    fs = vfs.get_filesystem()
+    if is_dir:
+        fs.rmtree(filen)
+    else:
+        fs.unlink(filen)
+
+
+class Syncer(object):
+    '''Walks a source and target tree together, deciding which files
+    need copying and, if ``delete`` is True, which should be removed.
+    '''
+
+    def __init__(self, checksum=False, delete=False, dry_run=False,
+                 cache=None):
+        self.checksum = checksum
+        self.cache = cache
+        self.delete = delete
+        self.dry_run = dry_run
+        self.copied = []
+        self.skipped = []
+        self.deleted = []
+        self.errors = []
+        self.bytes_transferred = 0
+        self.bytes_skipped = 0
+        self.copied_dirs = []
+
+    def summary(self, copy_results=()):
+        errors = self.errors + [result for result in copy_results
+                                if result.error is not None]
+        failed = {result.source for result in errors}
+        return SyncSummary(
+            [pair for pair in self.copied if pair[0] not in failed],
+            self.skipped, self.deleted, self.bytes_transferred,
+            self.bytes_skipped, errors)
+
+    def _remove(self, filen, is_dir):
+        if not self.dry_run:
+            try:
+                _remove_path(filen, is_dir)
+            except OSError as error:
+                self.errors.append(CopyResult(filen, filen, error))
+                return False
+        self.deleted.append(filen)
+        return True
+
+    def iter_file(self, source, target, source_stat=None):
+        '''Yield a copy job for ``source`` if ``target`` is out of date.'''
+        fs = vfs.get_filesystem()
+        try:
+            if source_stat is None:
+                source_stat = fs.stat(source)
+            if fs.isdir(target):
+                # A link to a directory is unlinked, not its contents
+                if not self._remove(target, not fs.islink(target)):
+                    return
+            elif fs.exists(target):
+                target_stat = fs.stat(target)
+                if file_unchanged(source_stat, target_stat, source, target,
+                                  self.checksum, self.cache):
+                    self.skipped.append(target)
+                    self.bytes_skipped += source_stat.st_size
+                    return
+        except OSError as error:
+            self.errors.append(CopyResult(source, target, error))
+            return
+        self.copied.append((source, target))
+        self.bytes_transferred += source_stat.st_size
+        if not self.dry_run:
+            yield (source, target)
+
+    def iter_tree(self, source, target):
+        '''Yield copy jobs for every out of date file under ``target``,
+        creating directories as necessary.'''
+        fs = vfs.get_filesystem()
+        pending = deque([(source, target)])
+        while pending:
+            src_dir, dst_dir = pending.popleft()
+
+            if fs.exists(dst_dir) and not fs.isdir(dst_dir):
+                if not self._remove(dst_dir, False):
+                    continue
+            if not fs.isdir(dst_dir):
+                if not self.dry_run:
+                    try:
+                        fs.mkdir(dst_dir)
+                    except OSError as error:
+                        yield (src_dir, dst_dir, error)
+                        continue
+                self.copied_dirs.append((src_dir, dst_dir))
+                existing = {}
+            else:
+                self.copied_dirs.append((src_dir, dst_dir))
+                try:
+                    with fs.scandir(dst_dir) as entries:
+                        existing = {
+                            entry.name: entry.is_dir(follow_symlinks=False)
+                            for entry in entries}
+                except OSError as error:
+                    yield (src_dir, dst_dir, error)
+                    continue
+
+            try:
+                with fs.scandir(src_dir) as entries:
+                    entries = list(entries)
+            except OSError as error:
+                yield (src_dir, dst_dir, error)
+                continue
+
+            for entry in entries:
+                existing.pop(entry.name, None)
+                dst = path.join(dst_dir, entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    pending.append((entry.path, dst))
+                    continue
+                try:
+                    entry_stat = entry.stat()
+                except OSError as error:
+                    yield (entry.path, dst, error)
+                    continue
+                yield from self.iter_file(entry.path, dst, entry_stat)
+
+            if self.delete:
+                for name, is_dir in existing.items():
+                    self._remove(path.join(dst_dir, name), is_dir)
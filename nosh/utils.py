@@ -2,14 +2,23 @@
 Utilities for other functions.
 '''
 
+import inspect
 import os
 from os import path
 import shutil
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import wraps
-import glob
+
+from nosh import globbing, instrumentation
+from nosh.progress import Progress, ProgressBar
+from nosh.throttle import use_throttle
 
 
 def expand_path(input, abspath=True):
+    if not isinstance(input, (str, bytes, os.PathLike)):
+        # e.g. a file object given in place of a path
+        return input
     p = path.expanduser(input)
     if abspath:
         p = path.abspath(p)
@@ -41,13 +50,17 @@ def require_args(min=None, max=None,
         Defaults to None (no maximum).
     '''
     def require_args_decorator(func):
+        command = inspect.unwrap(func)
+
         @wraps(func)
         def new_func(*args, **kwargs):
-            if ((max is not None and len(args) > max) or
-                (min is not None and len(args) < min)):
-                raise ValueError('{} takes {}, but {} given'.format(
-                    func, _get_num_args_text(min, max), len(args)))
-            return func(*args, **kwargs)
+            with instrumentation.phase(command, 'require_args') as timer:
+                if ((max is not None and len(args) > max) or
+                    (min is not None and len(args) < min)):
+                    raise ValueError('{} takes {}, but {} given'.format(
+                        func, _get_num_args_text(min, max), len(args)))
+                timer.done()
+                return func(*args, **kwargs)
         return new_func
     return require_args_decorator
 
@@ -60,31 +73,106 @@ def expand_paths(*args, do_glob=True, abspath=True):
     Parameters
     ----------
     do_glob : bool
-        If True, glob patterns in the args are expanded. Defaults to True. 
+        If True, glob patterns in the args are expanded, see
+        nosh.globbing. Defaults to True.
     '''
     def expand_paths_decorator(func):
+        command = inspect.unwrap(func)
+
         @wraps(func)
         def new_func(*fargs, **fkwargs):
-            fargs = [expand_path(arg, abspath=abspath) for arg in fargs]
-            if do_glob:
-                new_args = []
-                for arg in fargs:
-                    if not glob_pattern_present(arg):
-                        new_args.append(arg)
-                    else:
-                        new_args.extend(glob.glob(arg))
-                fargs = new_args
-            
-            for kwarg in fkwargs:
-                if kwarg in args:
-                    fkwargs[kwarg] = expand_path(fkwargs[kwarg], abspath=abspath)
-                
-            return func(*fargs, **fkwargs)
+            with instrumentation.phase(command, 'expand_paths') as timer:
+                fargs = [expand_path(arg, abspath=abspath) for arg in fargs]
+                if do_glob:
+                    fargs = globbing.expand_args(fargs)
+
+                for kwarg in fkwargs:
+                    if kwarg in args:
+                        fkwargs[kwarg] = expand_path(fkwargs[kwarg],
+                                                     abspath=abspath)
+
+                timer.done()
+                return func(*fargs, **fkwargs)
         return new_func
     return expand_paths_decorator
 
+def supports_dry_run(estimator):
+    '''Decorator adding a ``dry_run`` keyword argument to a command.
+
+    With dry_run=True the command isn't run; ``estimator`` is called
+    with the same arguments instead and its result (usually a
+    nosh.estimate.DryRunReport) returned. Place it below expand_paths
+    and the permission checks, so the estimator gets the expanded paths
+    and a dry run fails wherever the command would before starting.
+
+    Parameters
+    ----------
+    estimator : callable
+        Takes the command's arguments and returns what would be done.
+    '''
+    def supports_dry_run_decorator(func):
+        command = inspect.unwrap(func)
+
+        @wraps(func)
+        def new_func(*args, dry_run=False, **kwargs):
+            if dry_run:
+                with instrumentation.phase(command, 'dry_run'):
+                    return estimator(*args, **kwargs)
+            return func(*args, **kwargs)
+        return new_func
+    return supports_dry_run_decorator
+
+def supports_progress(count_bytes=True, plan_if=None):
+    '''Decorator adding a ``progress`` keyword argument to a command,
+    see nosh.progress.
+
+    Given a progress callback (or True, for a nosh.progress.ProgressBar)
+    the command is first dry run for the totals, then run with its
+    progress reported. Place it directly above supports_dry_run.
+
+    Parameters
+    ----------
+    count_bytes : bool
+        Whether the command counts the bytes it has done, as well as the
+        files. Defaults to True.
+    plan_if : callable or None
+        Called with the command's arguments, returning whether its dry
+        run is cheap enough to be worth making for the totals. If not,
+        progress is reported without totals. Defaults to None, always
+        dry running.
+    '''
+    def supports_progress_decorator(func):
+        @wraps(func)
+        def new_func(*args, progress=None, **kwargs):
+            if progress is None or progress is False or kwargs.get('dry_run'):
+                return func(*args, **kwargs)
+            if progress is True:
+                progress = ProgressBar()
+            if plan_if is not None and not plan_if(*args, **kwargs):
+                with Progress(progress, func.__name__):
+                    return func(*args, **kwargs)
+            plan = func(*args, dry_run=True, **kwargs)
+            with Progress(progress, func.__name__, plan.files,
+                          plan.bytes if count_bytes else None,
+                          plan.operations):
+                return func(*args, **kwargs)
+        return new_func
+    return supports_progress_decorator
+
+def supports_throttle(func):
+    '''Decorator adding a ``throttle`` keyword argument to a command: a
+    nosh.throttle.Throttle applying to this call in place of the
+    default.'''
+    @wraps(func)
+    def new_func(*args, throttle=None, **kwargs):
+        if throttle is None:
+            return func(*args, **kwargs)
+        with use_throttle(throttle):
+            return func(*args, **kwargs)
+    return new_func
+
 def glob_pattern_present(string):
-    return any([c in string for c in ('*?[]')])
+    return globbing.has_magic(string)
 
 
 def maybe_exception(exception, message, errors_okay):
@@ -92,3 +180,43 @@ def maybe_exception(exception, message, errors_okay):
         raise exception(message)
     else:
         print('Ignoring error: {}'.format(message))
+
+
+def maybe_result_exceptions(results, errors_okay):
+    '''Like maybe_exception, but for a list of per-file results with an
+    ``error`` attribute (e.g. treeutils.CopyResult). If errors are not
+    okay the first error is re-raised, otherwise every error is printed.
+    '''
+    failures = [result for result in results if result.error is not None]
+    if failures and not errors_okay:
+        raise failures[0].error
+    for failure in failures:
+        print('Ignoring error: {}'.format(failure.error))
+
+
+class OperationCancelled(Exception):
+    '''Raised between files when a running command has been cancelled,
+    see cancel_on.'''
+
+
+_CANCEL_EVENT = ContextVar('nosh_cancel_event', default=None)
+
+
+@contextmanager
+def cancel_on(event):
+    '''Context manager making commands run within it stop with
+    OperationCancelled at the next file boundary after the
+    threading.Event ``event`` is set.'''
+    token = _CANCEL_EVENT.set(event)
+    try:
+        yield
+    finally:
+        _CANCEL_EVENT.reset(token)
+
+
+def check_cancelled():
+    '''Raise OperationCancelled if the current command has been
+    cancelled. Commands call this between files.'''
+    event = _CANCEL_EVENT.get()
+    if event is not None and event.is_set():
+        raise OperationCancelled()
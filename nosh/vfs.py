@@ -0,0 +1,616 @@
+'''Filesystems the nosh commands operate on.
+
+The commands don't call ``os``, ``os.path`` and ``shutil`` directly but
+go through the current FileSystem, which is the LocalFileSystem (the
+real disk) unless another is chosen. A MemoryFileSystem holds a whole
+tree in RAM, for staging trees before writing them out or for tests
+that shouldn't touch the disk:
+
+    from nosh import vfs
+    with vfs.use_filesystem(vfs.MemoryFileSystem()):
+        nosh.mkdir('/build')
+        nosh.touch('/build/a.txt')
+        nosh.cp('/build', '/staged', recursive=True)
+
+As with nosh.state and nosh.cache, the current filesystem is held in a
+context variable, so it applies to the calling thread or asyncio task
+and to the worker threads commands start, but not to other threads.
+
+A FileSystem subclass only needs to implement the primitive operations
+stat, scandir, open, rename, unlink, mkdir, rmdir, copy, chmod and
+utime; everything else (exists, makedirs, rmtree, move etc.) has a
+default built on them. Commands that depend on features of the real
+disk, such as the archive commands (tarfile and zipfile read the disk
+themselves) and dedupe (hard links and reflinks), are marked with
+local_only and raise UnsupportedFileSystem on any other filesystem.
+'''
+
+import errno
+import inspect
+import io
+import itertools
+import os
+from os import path
+import shutil
+import stat
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from nosh import copyutils, instrumentation
+
+
+class UnsupportedFileSystem(OSError):
+    '''Raised by commands that can't run on the current filesystem.'''
+
+
+class FileSystem(object):
+    '''The operations nosh performs on files.
+
+    Paths are str paths, interpreted relative to the working directory
+    as os functions do. Errors are raised as the OSError subclass os
+    would raise (FileNotFoundError, NotADirectoryError etc.).
+    '''
+
+    def stat(self, filen, follow_symlinks=True):
+        '''Return the os.stat_result of ``filen``.'''
+        raise NotImplementedError()
+
+    def scandir(self, directory):
+        '''Return an iterator of os.DirEntry-like objects for the items
+        in ``directory``, usable as a context manager like os.scandir.'''
+        raise NotImplementedError()
+
+    def open(self, filen, mode='r', encoding=None, errors=None,
+             newline=None):
+        '''Open ``filen``, as the builtin open.'''
+        raise NotImplementedError()
+
+    def rename(self, source, target):
+        '''Rename ``source`` to ``target``, replacing ``target`` if it is
+        a file or empty directory, as os.rename does on POSIX.'''
+        raise NotImplementedError()
+
+    def unlink(self, filen):
+        raise NotImplementedError()
+
+    def mkdir(self, directory, mode=0o777):
+        raise NotImplementedError()
+
+    def rmdir(self, directory):
+        raise NotImplementedError()
+
+    def copy(self, source, target, backend='auto'):
+        '''Copy the contents of the file ``source`` to the file path
+        ``target``, returning the name of the copy backend used (see
+        nosh.copyutils.copyfile).'''
+        raise NotImplementedError()
+
+    def chmod(self, filen, mode):
+        raise NotImplementedError()
+
+    def utime(self, filen, ns=None):
+        '''Set the (atime_ns, mtime_ns) of ``filen``, or the current time
+        if ``ns`` is None.'''
+        raise NotImplementedError()
+
+    def lstat(self, filen):
+        return self.stat(filen, follow_symlinks=False)
+
+    def _mode(self, filen, follow_symlinks=True):
+        try:
+            return self.stat(filen, follow_symlinks).st_mode
+        except (OSError, ValueError):
+            return None
+
+    def exists(self, filen):
+        return self._mode(filen) is not None
+
+    def lexists(self, filen):
+        return self._mode(filen, follow_symlinks=False) is not None
+
+    def isdir(self, filen):
+        mode = self._mode(filen)
+        return mode is not None and stat.S_ISDIR(mode)
+
+    def isfile(self, filen):
+        mode = self._mode(filen)
+        return mode is not None and stat.S_ISREG(mode)
+
+    def islink(self, filen):
+        mode = self._mode(filen, follow_symlinks=False)
+        return mode is not None and stat.S_ISLNK(mode)
+
+    def samefile(self, first, second):
+        first_stat = self.stat(first)
+        second_stat = self.stat(second)
+        return (first_stat.st_dev == second_stat.st_dev and
+                first_stat.st_ino == second_stat.st_ino)
+
+    def listdir(self, directory):
+        with self.scandir(directory) as entries:
+            return [entry.name for entry in entries]
+
+    def makedirs(self, directory, mode=0o777, exist_ok=False):
+        '''Create ``directory`` and any missing parents, as os.makedirs.'''
+        parent = path.dirname(path.abspath(directory))
+        if not self.exists(parent):
+            self.makedirs(parent, mode, exist_ok=True)
+        try:
+            self.mkdir(directory, mode)
+        except OSError:
+            if not exist_ok or not self.isdir(directory):
+                raise
+
+    def rmtree(self, directory, ignore_errors=False):
+        '''Delete ``directory`` and everything in it, as shutil.rmtree.'''
+        if ignore_errors:
+            try:
+                self.rmtree(directory)
+            except OSError:
+                pass
+            return
+        if self.islink(directory):
+            raise OSError(
+                'Cannot remove tree at symbolic link {}'.format(directory))
+        with self.scandir(directory) as entries:
+            entries = list(entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.rmtree(entry.path)
+            else:
+                self.unlink(entry.path)
+        self.rmdir(directory)
+
+    def copymode(self, source, target):
+        self.chmod(target, stat.S_IMODE(self.stat(source).st_mode))
+
+    def copystat(self, source, target):
+        '''Copy the permission bits and timestamps of ``source``.'''
+        source_stat = self.stat(source)
+        self.utime(target, (source_stat.st_atime_ns,
+                            source_stat.st_mtime_ns))
+        self.chmod(target, stat.S_IMODE(source_stat.st_mode))
+
+    def move(self, source, target, copy_function=None):
+        '''Move ``source`` to ``target``, or into it if it is a
+        directory, returning the path moved to, as shutil.move.
+
+        Within one filesystem a move is always a rename; the local
+        filesystem uses ``copy_function`` to move between devices.
+        '''
+        if self.isdir(target):
+            target = path.join(target, path.basename(path.normpath(source)))
+            if self.lexists(target):
+                raise shutil.Error(
+                    'Destination path {} already exists'.format(target))
+        self.rename(source, target)
+        return target
+
+
+class LocalFileSystem(FileSystem):
+    '''The real disk, through os, os.path and shutil.'''
+
+    def stat(self, filen, follow_symlinks=True):
+        return os.stat(filen, follow_symlinks=follow_symlinks)
+
+    def scandir(self, directory):
+        return os.scandir(directory)
+
+    def open(self, filen, mode='r', encoding=None, errors=None,
+             newline=None):
+        return open(filen, mode, encoding=encoding, errors=errors,
+                    newline=newline)
+
+    def rename(self, source, target):
+        os.rename(source, target)
+
+    def unlink(self, filen):
+        os.unlink(filen)
+
+    def mkdir(self, directory, mode=0o777):
+        os.mkdir(directory, mode)
+
+    def rmdir(self, directory):
+        os.rmdir(directory)
+
+    def copy(self, source, target, backend='auto'):
+        return copyutils.copyfile(source, target, backend=backend)
+
+    def chmod(self, filen, mode):
+        os.chmod(filen, mode)
+
+    def utime(self, filen, ns=None):
+        if ns is None:
+            os.utime(filen)
+        else:
+            os.utime(filen, ns=ns)
+
+    # The os.path versions skip building stat_result objects
+    exists = staticmethod(path.exists)
+    lexists = staticmethod(path.lexists)
+    isdir = staticmethod(path.isdir)
+    isfile = staticmethod(path.isfile)
+    islink = staticmethod(path.islink)
+    samefile = staticmethod(path.samefile)
+    listdir = staticmethod(os.listdir)
+    copymode = staticmethod(shutil.copymode)
+    copystat = staticmethod(shutil.copystat)
+
+    def makedirs(self, directory, mode=0o777, exist_ok=False):
+        os.makedirs(directory, mode, exist_ok=exist_ok)
+
+    def rmtree(self, directory, ignore_errors=False):
+        shutil.rmtree(directory, ignore_errors=ignore_errors)
+
+    def move(self, source, target, copy_function=None):
+        if copy_function is None:
+            return shutil.move(source, target)
+        return shutil.move(source, target, copy_function=copy_function)
+
+    def __repr__(self):
+        return '<LocalFileSystem>'
+
+
+def _error(error_class, code, filen):
+    return error_class(code, os.strerror(code), filen)
+
+
+_DEVICES = itertools.count(1 << 40)
+_INODES = itertools.count(1)
+
+
+class _Node(object):
+    __slots__ = ('mode', 'data', 'children', 'ino', 'atime_ns', 'mtime_ns',
+                 'ctime_ns')
+
+    def __init__(self, mode, children=None):
+        self.mode = mode
+        self.data = b''
+        self.children = children
+        self.ino = next(_INODES)
+        self.atime_ns = self.mtime_ns = self.ctime_ns = time.time_ns()
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+
+class _MemoryFile(io.BytesIO):
+    '''A file opened on a MemoryFileSystem. Writes are saved to the
+    file when it is flushed or closed.'''
+
+    def __init__(self, node, data, writable, append=False):
+        super(_MemoryFile, self).__init__(data)
+        self._node = node
+        self._writable = writable
+        if append:
+            self.seek(0, io.SEEK_END)
+
+    def writable(self):
+        return self._writable
+
+    def write(self, data):
+        if not self._writable:
+            raise io.UnsupportedOperation('not writable')
+        return super(_MemoryFile, self).write(data)
+
+    def truncate(self, size=None):
+        if not self._writable:
+            raise io.UnsupportedOperation('not writable')
+        return super(_MemoryFile, self).truncate(size)
+
+    def flush(self):
+        if self._writable and not self.closed:
+            self._node.data = self.getvalue()
+            self._node.mtime_ns = time.time_ns()
+        super(_MemoryFile, self).flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+        super(_MemoryFile, self).close()
+
+
+class _MemoryDirEntry(object):
+    '''The os.DirEntry of an item in a MemoryFileSystem.'''
+
+    __slots__ = ('name', 'path', '_fs', '_node')
+
+    def __init__(self, fs, directory, name, node):
+        self.name = name
+        self.path = path.join(directory, name)
+        self._fs = fs
+        self._node = node
+
+    def is_dir(self, follow_symlinks=True):
+        return self._node.is_dir
+
+    def is_file(self, follow_symlinks=True):
+        return not self._node.is_dir
+
+    def is_symlink(self):
+        return False
+
+    def inode(self):
+        return self._node.ino
+
+    def stat(self, follow_symlinks=True):
+        return self._fs._stat_node(self._node)
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return '<_MemoryDirEntry {!r}>'.format(self.name)
+
+
+class _ScandirIterator(object):
+
+    def __init__(self, entries):
+        self._entries = iter(entries)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._entries)
+
+    def close(self):
+        self._entries = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemoryFileSystem(FileSystem):
+    '''A filesystem held entirely in memory, starting with just an
+    empty root directory.
+
+    It holds regular files and directories only (no symlinks), and
+    records but doesn't enforce permission bits. Operations are
+    thread safe. Every MemoryFileSystem has its own st_dev, so cached
+    digests (see nosh.cache) of its files never match those of other
+    filesystems.
+    '''
+
+    def __init__(self):
+        self.device = next(_DEVICES)
+        self.root = _Node(stat.S_IFDIR | 0o755, {})
+        self.lock = threading.RLock()
+
+    def _parts(self, filen):
+        return [part for part in path.abspath(os.fspath(filen)).split(os.sep)
+                if part]
+
+    def _lookup(self, filen):
+        node = self.root
+        for part in self._parts(filen):
+            if not node.is_dir:
+                raise _error(NotADirectoryError, errno.ENOTDIR, filen)
+            node = node.children.get(part)
+            if node is None:
+                raise _error(FileNotFoundError, errno.ENOENT, filen)
+        return node
+
+    def _parent(self, filen):
+        '''Return the directory node containing ``filen``, and its name.'''
+        parts = self._parts(filen)
+        if not parts:
+            raise _error(OSError, errno.EBUSY, filen)
+        parent = self._lookup(os.sep + os.sep.join(parts[:-1]))
+        if not parent.is_dir:
+            raise _error(NotADirectoryError, errno.ENOTDIR, filen)
+        return parent, parts[-1]
+
+    def _stat_node(self, node):
+        size = len(node.data) if not node.is_dir else 0
+        return os.stat_result((
+            node.mode, node.ino, self.device,
+            len(node.children) + 2 if node.is_dir else 1, os.getuid(),
+            os.getgid(), size, node.atime_ns // 10 ** 9,
+            node.mtime_ns // 10 ** 9, node.ctime_ns // 10 ** 9,
+            node.atime_ns / 1e9, node.mtime_ns / 1e9, node.ctime_ns / 1e9,
+            node.atime_ns, node.mtime_ns, node.ctime_ns))
+
+    def stat(self, filen, follow_symlinks=True):
+        with self.lock:
+            return self._stat_node(self._lookup(filen))
+
+    def scandir(self, directory):
+        with self.lock:
+            node = self._lookup(directory)
+            if not node.is_dir:
+                raise _error(NotADirectoryError, errno.ENOTDIR, directory)
+            directory = os.fspath(directory)
+            return _ScandirIterator([
+                _MemoryDirEntry(self, directory, name, child)
+                for name, child in node.children.items()])
+
+    def open(self, filen, mode='r', encoding=None, errors=None,
+             newline=None):
+        base = mode.replace('b', '').replace('t', '')
+        writable = base != 'r'
+        with self.lock:
+            parent, name = self._parent(filen)
+            node = parent.children.get(name)
+            if node is not None and node.is_dir:
+                raise _error(IsADirectoryError, errno.EISDIR, filen)
+            if base.startswith('x') and node is not None:
+                raise _error(FileExistsError, errno.EEXIST, filen)
+            if node is None:
+                if base.startswith('r'):
+                    raise _error(FileNotFoundError, errno.ENOENT, filen)
+                node = parent.children[name] = _Node(stat.S_IFREG | 0o644)
+                parent.mtime_ns = node.mtime_ns
+            if base.startswith(('w', 'x')):
+                node.data = b''
+                node.mtime_ns = time.time_ns()
+            fileh = _MemoryFile(node, node.data, writable,
+                                append=base.startswith('a'))
+        if 'b' in mode:
+            return fileh
+        return io.TextIOWrapper(fileh, encoding=encoding or 'utf-8',
+                                errors=errors, newline=newline)
+
+    def rename(self, source, target):
+        with self.lock:
+            source_parent, source_name = self._parent(source)
+            node = source_parent.children.get(source_name)
+            if node is None:
+                raise _error(FileNotFoundError, errno.ENOENT, source)
+            target_parent, target_name = self._parent(target)
+            existing = target_parent.children.get(target_name)
+            if existing is node:
+                return
+            if existing is not None:
+                if node.is_dir and not existing.is_dir:
+                    raise _error(NotADirectoryError, errno.ENOTDIR, target)
+                if existing.is_dir and not node.is_dir:
+                    raise _error(IsADirectoryError, errno.EISDIR, target)
+                if existing.is_dir and existing.children:
+                    raise _error(OSError, errno.ENOTEMPTY, target)
+            if node.is_dir:
+                source_parts = self._parts(source)
+                if self._parts(target)[:len(source_parts)] == source_parts:
+                    raise _error(OSError, errno.EINVAL, target)
+            del source_parent.children[source_name]
+            target_parent.children[target_name] = node
+            source_parent.mtime_ns = target_parent.mtime_ns = time.time_ns()
+
+    def unlink(self, filen):
+        with self.lock:
+            parent, name = self._parent(filen)
+            node = parent.children.get(name)
+            if node is None:
+                raise _error(FileNotFoundError, errno.ENOENT, filen)
+            if node.is_dir:
+                raise _error(IsADirectoryError, errno.EISDIR, filen)
+            del parent.children[name]
+            parent.mtime_ns = time.time_ns()
+
+    def mkdir(self, directory, mode=0o777):
+        with self.lock:
+            parent, name = self._parent(directory)
+            if name in parent.children:
+                raise _error(FileExistsError, errno.EEXIST, directory)
+            parent.children[name] = _Node(stat.S_IFDIR | (mode & 0o7777), {})
+            parent.mtime_ns = time.time_ns()
+
+    def rmdir(self, directory):
+        with self.lock:
+            parent, name = self._parent(directory)
+            node = parent.children.get(name)
+            if node is None:
+                raise _error(FileNotFoundError, errno.ENOENT, directory)
+            if not node.is_dir:
+                raise _error(NotADirectoryError, errno.ENOTDIR, directory)
+            if node.children:
+                raise _error(OSError, errno.ENOTEMPTY, directory)
+            del parent.children[name]
+            parent.mtime_ns = time.time_ns()
+
+    def copy(self, source, target, backend='auto'):
+        '''Copy the contents of ``source`` to ``target``. ``backend`` is
+        ignored, and 'memory' always returned.'''
+        with self.lock:
+            source_node = self._lookup(source)
+            if source_node.is_dir:
+                raise _error(IsADirectoryError, errno.EISDIR, source)
+            parent, name = self._parent(target)
+            if parent.children.get(name) is source_node:
+                raise shutil.SameFileError(
+                    '{} and {} are the same file'.format(source, target))
+            with self.open(target, 'wb'):
+                pass
+            target_node = parent.children[name]
+            # File contents are immutable bytes, so can be shared
+            target_node.data = source_node.data
+        return 'memory'
+
+    def chmod(self, filen, mode):
+        with self.lock:
+            node = self._lookup(filen)
+            node.mode = stat.S_IFMT(node.mode) | (mode & 0o7777)
+
+    def utime(self, filen, ns=None):
+        with self.lock:
+            node = self._lookup(filen)
+            if ns is None:
+                node.atime_ns = node.mtime_ns = time.time_ns()
+            else:
+                node.atime_ns, node.mtime_ns = ns
+
+    def __repr__(self):
+        return '<MemoryFileSystem dev={}>'.format(self.device)
+
+
+LOCAL = LocalFileSystem()
+'''The LocalFileSystem, used unless another filesystem is chosen.'''
+
+_default_filesystem = LOCAL
+_FILESYSTEM = ContextVar('nosh_filesystem', default=None)
+
+
+def set_default_filesystem(filesystem):
+    '''Make ``filesystem`` the filesystem used outside any
+    use_filesystem block, in every thread. Returns the previous
+    default.'''
+    global _default_filesystem
+    previous = _default_filesystem
+    _default_filesystem = LOCAL if filesystem is None else filesystem
+    return previous
+
+
+@contextmanager
+def use_filesystem(filesystem):
+    '''Context manager making commands run within it operate on
+    ``filesystem``.'''
+    token = _FILESYSTEM.set(filesystem)
+    try:
+        yield filesystem
+    finally:
+        _FILESYSTEM.reset(token)
+
+
+def get_filesystem(filesystem=None):
+    '''Return ``filesystem``, or if it is None the filesystem set with
+    use_filesystem, or the default. Within an instrumented command call
+    it is wrapped to count the operations made, see nosh.instrumentation.
+    '''
+    if filesystem is None:
+        filesystem = _FILESYSTEM.get()
+        if filesystem is None:
+            filesystem = _default_filesystem
+    if instrumentation.current_call() is not None:
+        return instrumentation.counting(filesystem)
+    return filesystem
+
+
+def require_local(feature):
+    '''Raise UnsupportedFileSystem, naming ``feature``, unless the
+    current filesystem is a LocalFileSystem.'''
+    filesystem = _FILESYSTEM.get() or _default_filesystem
+    if not isinstance(filesystem, LocalFileSystem):
+        raise UnsupportedFileSystem(
+            '{} only works on the local filesystem, not {}'.format(
+                feature, filesystem))
+
+
+def local_only(func):
+    '''Decorator for commands that only work on the local filesystem,
+    raising UnsupportedFileSystem if another is in use.'''
+    command = inspect.unwrap(func)
+
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with instrumentation.phase(command, 'require_local') as timer:
+            require_local(func.__name__)
+            timer.done()
+            return func(*args, **kwargs)
+    return new_func
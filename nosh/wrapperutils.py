@@ -1,6 +1,7 @@
+import inspect
 from functools import wraps, partial
 from os import path
-from nosh import state
+from nosh import state, instrumentation
 
 # def require_args_satisfying_condition(condition, failure):
 #     """Decorator builder for decorators that should check the given
@@ -35,29 +36,33 @@ from nosh import state
 def require_arg_state(readable=None, writable=None,
                       kwargs_readable=None, kwargs_writable=None):
     def decorator(func):
+        command = inspect.unwrap(func)
+
         @wraps(func)
         def new_func(*fargs, **fkwargs):
-            # check for readable args
-            affected_indices = readable
-            if affected_indices is None:  # apply to all args
-                affected_indices = range(len(fargs))
-            for index, arg in enumerate(fargs):
-                if (((index in affected_indices) or
-                        ((index - len(fargs)) in affected_indices))
-                    and not state.is_readable(arg)):
-                    raise state.NotReadableError()
+            with instrumentation.phase(command, 'permissions') as timer:
+                # check for readable args
+                affected_indices = readable
+                if affected_indices is None:  # apply to all args
+                    affected_indices = range(len(fargs))
+                for index, arg in enumerate(fargs):
+                    if (((index in affected_indices) or
+                            ((index - len(fargs)) in affected_indices))
+                        and not state.is_readable(arg)):
+                        raise state.NotReadableError()
 
-            # check for writable args
-            affected_indices = writable
-            if affected_indices is None:  # apply to all args
-                affected_indices = range(len(fargs))
-            for index, arg in enumerate(fargs):
-                if (((index in affected_indices) or
-                        ((index - len(fargs)) in affected_indices))
-                    and not state.is_writable(arg)):
-                    raise state.NotWritableError()
+                # check for writable args
+                affected_indices = writable
+                if affected_indices is None:  # apply to all args
+                    affected_indices = range(len(fargs))
+                for index, arg in enumerate(fargs):
+                    if (((index in affected_indices) or
+                            ((index - len(fargs)) in affected_indices))
+                        and not state.is_writable(arg)):
+                        raise state.NotWritableError()
 
-            return func(*fargs, **fkwargs)
+                timer.done()
+                return func(*fargs, **fkwargs)
         return new_func
     return decorator
 
@@ -0,0 +1,151 @@
+import nosh as no
+import nosh.aio as noaio
+import nosh.dirutils as nodirutils
+from nosh import copyutils
+from nosh import state
+from nosh import utils as noutils
+
+from functools import wraps
+from os import path
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+FILE_NAMES = ['{}.txt'.format(i) for i in range(20)]
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.mkdir('dir1')
+                for file_name in FILE_NAMES:
+                    with open(path.join('dir1', file_name), 'w') as fileh:
+                        fileh.write(file_name)
+                return func(*args, **kwargs)
+    return new_func
+
+
+@temp_dir
+def test_cp_and_ls():
+    async def main():
+        await noaio.cp('dir1', 'dir2', recursive=True)
+        return await noaio.ls('dir2')
+
+    assert sorted(asyncio.run(main())) == sorted(FILE_NAMES)
+
+
+@temp_dir
+def test_concurrent_commands():
+    async def main():
+        await asyncio.gather(*[
+            noaio.cp(path.join('dir1', file_name),
+                     path.join('dir1', 'copy_' + file_name))
+            for file_name in FILE_NAMES])
+
+    asyncio.run(main())
+    for file_name in FILE_NAMES:
+        assert path.exists(path.join('dir1', 'copy_' + file_name))
+
+
+@temp_dir
+def test_find():
+    async def main():
+        return [result async for result in noaio.find(name='*.txt')]
+
+    assert len(asyncio.run(main())) == len(FILE_NAMES)
+
+
+@temp_dir
+def test_uses_task_state():
+    async def main():
+        with state.set_readable():
+            await noaio.ls('dir1')
+
+    with pytest.raises(state.NotReadableError):
+        asyncio.run(main())
+
+
+@temp_dir
+def test_errors_propagate():
+    async def main():
+        await noaio.cp('dir1', 'dir2')
+
+    with pytest.raises(IsADirectoryError):
+        asyncio.run(main())
+
+
+def test_check_cancelled():
+    event = threading.Event()
+    with noutils.cancel_on(event):
+        noutils.check_cancelled()
+        event.set()
+        with pytest.raises(noutils.OperationCancelled):
+            noutils.check_cancelled()
+    noutils.check_cancelled()
+
+
+@temp_dir
+def test_cancellation_between_files():
+    def slow_copy(src_fd, dst_fd, size):
+        time.sleep(0.02)
+        copyutils.BACKENDS['userspace'](src_fd, dst_fd, size)
+
+    copyutils.register_backend('slow', slow_copy)
+
+    async def main():
+        task = asyncio.ensure_future(
+            noaio.cp('dir1', 'dir2', recursive=True, backend='slow'))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+
+    try:
+        asyncio.run(main())
+    finally:
+        del copyutils.BACKENDS['slow']
+    assert 0 < len(os.listdir('dir2')) < len(FILE_NAMES)
+
+
+def test_concurrency_limit():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def task():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+
+    async def main():
+        await asyncio.gather(*[noaio.run('limited', task) for _ in range(10)])
+
+    noaio.set_concurrency('limited', 2)
+    try:
+        asyncio.run(main())
+    finally:
+        noaio.set_concurrency('limited', None)
+    assert max(peak) <= 2
+
+
+def test_set_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=1)
+    noaio.set_executor(executor)
+    try:
+        assert noaio.get_executor() is executor
+        assert asyncio.run(noaio.run('pwd', no.pwd)) == no.pwd()
+    finally:
+        noaio.set_executor(None)
+        executor.shutdown()
+    assert noaio.get_executor() is not executor
@@ -3,7 +3,10 @@ import nosh as no
 import nosh.utils as noutils
 import nosh.dirutils as nodirutils
 
+from functools import wraps
+
 from os import path
+import io
 import os
 
 import pytest
@@ -29,6 +32,7 @@ def create_example_files():
 
 def temp_dir(func):
     '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
     def new_func(*args, **kwargs):
         with nodirutils.temp_directory() as temp_dir_name:
             with nodirutils.current_directory(temp_dir_name):
@@ -96,3 +100,446 @@ class TestUntar(object):
 
         for file_name in FILE_NAMES:
             assert path.exists(path.join('extractpath', file_name))
+
+
+class TestParallelCompression(object):
+    @pytest.mark.parametrize('compress', ['gz', 'bz2'])
+    @temp_dir
+    def test_tar_threads(self, compress):
+        with open('big.txt', 'w') as fileh:
+            for i in range(200000):
+                fileh.write('line {}\n'.format(i))
+        target = 'threaded.tar.{}'.format(compress)
+        no.tar('*.txt', target, compress=compress, threads=4)
+
+        no.mkdir('extractpath')
+        no.untar(target, 'extractpath')
+        for file_name in FILE_NAMES + ['big.txt']:
+            assert path.exists(path.join('extractpath', file_name))
+        with open('big.txt') as original:
+            with open(path.join('extractpath', 'big.txt')) as extracted:
+                assert original.read() == extracted.read()
+
+    @pytest.mark.parametrize('size', [0, 10, 1024 * 1024, 3 * 1024 * 1024 + 7])
+    def test_gzip_writer(self, size):
+        import gzip
+        import io
+        import random
+        from nosh import compression
+
+        rand = random.Random(size)
+        data = bytes(rand.choice(b'abcdefgh ') for _ in range(size))
+        output = io.BytesIO()
+        with compression.ParallelGzipWriter(output, threads=3) as writer:
+            writer.write(data[:size // 3])
+            writer.write(data[size // 3:])
+        assert gzip.decompress(output.getvalue()) == data
+
+    def test_bz2_writer(self):
+        import bz2
+        import io
+        from nosh import compression
+
+        data = b'0123456789' * 300000
+        output = io.BytesIO()
+        with compression.ParallelBz2Writer(output, threads=3) as writer:
+            writer.write(data)
+        assert bz2.decompress(output.getvalue()) == data
+
+
+class TestCodecs(object):
+    @pytest.mark.parametrize('compress', [None, 'gz', 'bz2', 'xz'])
+    @temp_dir
+    def test_roundtrip(self, compress):
+        no.tar('*.txt', 'archive', compress=compress, level=1
+               if compress is not None else None)
+        names = [member.name for member in no.lstar('archive')]
+        for file_name in FILE_NAMES:
+            assert file_name in names
+
+        no.mkdir('extractpath')
+        no.untar('archive', 'extractpath')
+        with open(path.join('extractpath', 'text_file.txt')) as fileh:
+            assert fileh.read() == 'text in file'
+
+    @temp_dir
+    def test_detect_codec(self):
+        from nosh import compression
+        no.tar('*.txt', 'misnamed.tar.gz', compress='xz')
+        assert compression.detect_codec('misnamed.tar.gz').name == 'xz'
+        assert compression.detect_codec('text_file.txt') is None
+
+    @temp_dir
+    def test_xz_threads(self):
+        no.tar('*.txt', 'threaded.tar.xz', compress='xz', threads=2)
+        assert len(no.lstar('threaded.tar.xz')) == len(FILE_NAMES) + 1
+
+    @temp_dir
+    def test_invalid_codec_and_level(self):
+        with pytest.raises(ValueError):
+            no.tar('*.txt', 'archive.tar', compress='rar')
+        with pytest.raises(ValueError):
+            no.tar('*.txt', 'archive.tar', compress='gz', level=10)
+        with pytest.raises(ValueError):
+            no.lstar('example.tar.gz', compress='rar')
+
+    @temp_dir
+    def test_registered_codec(self):
+        import lzma
+        from nosh import compression
+
+        codec = compression.Codec(
+            'lzma_alone', b'\x5d\x00\x00', 6, range(0, 10),
+            open_writer=lambda fileobj, level: lzma.LZMAFile(
+                fileobj, 'wb', format=lzma.FORMAT_ALONE, preset=level),
+            open_reader=lambda fileobj: lzma.LZMAFile(
+                fileobj, 'rb', format=lzma.FORMAT_ALONE))
+        compression.register_codec(codec)
+        try:
+            no.tar('*.txt', 'archive.lzma', compress='lzma_alone')
+            assert compression.detect_codec('archive.lzma') is codec
+            assert len(no.lstar('archive.lzma')) == len(FILE_NAMES) + 1
+            no.mkdir('extractpath')
+            no.untar('archive.lzma', 'extractpath')
+            assert path.exists(path.join('extractpath', 'text_file.txt'))
+        finally:
+            del compression.CODECS['lzma_alone']
+
+
+class TestTarIndex(object):
+    @temp_dir
+    def test_index_written(self):
+        from nosh import tarindex
+        no.tar('*.txt', 'indexed.tar.gz', index=True)
+        assert path.exists(tarindex.index_path('indexed.tar.gz'))
+        entries = tarindex.load_index('indexed.tar.gz')
+        assert sorted(entry['name'] for entry in entries) == sorted(
+            FILE_NAMES + ['text_file.txt'])
+
+    @temp_dir
+    def test_lstar_from_index(self):
+        no.tar('*.txt', 'indexed.tar.gz', index=True)
+        from_index = no.lstar('indexed.tar.gz', index=True)
+        from_tarball = no.lstar('indexed.tar.gz')
+        assert ([(m.name, m.size, m.offset) for m in from_index] ==
+                [(m.name, m.size, m.offset) for m in from_tarball])
+
+    @temp_dir
+    def test_lstar_builds_index(self):
+        from nosh import tarindex
+        assert tarindex.load_index('example.tar.gz') is None
+        no.lstar('example.tar.gz', index=True)
+        assert tarindex.load_index('example.tar.gz') is not None
+
+    @temp_dir
+    def test_stale_index_ignored(self):
+        from nosh import tarindex
+        no.tar('*.txt', 'indexed.tar', compress=None, index=True)
+        os.remove('indexed.tar')
+        no.tar('0.txt', 'indexed.tar', compress=None)
+        assert tarindex.load_index('indexed.tar') is None
+        assert [m.name for m in no.lstar('indexed.tar', index=True)] == [
+            '0.txt']
+
+    @pytest.mark.parametrize('index', [False, True])
+    @temp_dir
+    def test_untar_members(self, index):
+        no.tar('*.txt', 'indexed.tar.gz', index=index)
+        no.mkdir('extractpath')
+        no.untar('indexed.tar.gz', 'extractpath',
+                 members=['text_file.txt', '3.txt'], index=index)
+        assert sorted(os.listdir('extractpath')) == ['3.txt', 'text_file.txt']
+        with open(path.join('extractpath', 'text_file.txt')) as fileh:
+            assert fileh.read() == 'text in file'
+
+    @pytest.mark.parametrize('index', [False, True])
+    @temp_dir
+    def test_untar_missing_member(self, index):
+        no.mkdir('extractpath')
+        with pytest.raises(KeyError):
+            no.untar('example.tar.gz', 'extractpath',
+                     members=['not_present.txt'], index=index)
+
+
+class TestSelectiveUntar(object):
+    @temp_dir
+    def test_lstar_stream(self):
+        members = no.lstar('example.tar.gz', stream=True)
+        assert not isinstance(members, list)
+        assert sorted(m.name for m in members) == sorted(
+            m.name for m in no.lstar('example.tar.gz'))
+
+    @temp_dir
+    def test_lstar_stream_errors_eagerly(self):
+        with pytest.raises(FileNotFoundError):
+            no.lstar('not_present.tar.gz', stream=True)
+
+    @pytest.mark.parametrize('index', [False, True])
+    @temp_dir
+    def test_include_exclude(self, index):
+        no.tar('*.txt', 'dir1', 'archive.tar.gz', index=index)
+        no.mkdir('extractpath')
+        no.untar('archive.tar.gz', 'extractpath', include=['[0-2].txt', 'dir1'],
+                 exclude='1.txt', index=index)
+        assert sorted(os.listdir('extractpath')) == ['0.txt', '2.txt', 'dir1']
+        assert os.listdir(path.join('extractpath', 'dir1')) == ['dir_file.txt']
+
+    @temp_dir
+    def test_exclude_only(self):
+        no.mkdir('extractpath')
+        no.untar('example.tar.gz', 'extractpath', exclude='*.txt')
+        assert os.listdir('extractpath') == []
+
+    @temp_dir
+    def test_directory_mtime_preserved(self):
+        os.utime('dir1', (0, 0))
+        no.tar('dir1', 'archive.tar', compress=None)
+        no.mkdir('extractpath')
+        no.untar('archive.tar', 'extractpath', include='dir1')
+        assert os.stat(path.join('extractpath', 'dir1')).st_mtime == 0
+
+    @temp_dir
+    def test_stops_reading(self, monkeypatch):
+        import tarfile
+        no.tar('*.txt', 'archive.tar', compress=None)
+        first = no.lstar('archive.tar')[0].name
+
+        read = []
+        original_next = tarfile.TarFile.next
+
+        def next(self):
+            info = original_next(self)
+            read.append(info)
+            return info
+        monkeypatch.setattr(tarfile.TarFile, 'next', next)
+
+        no.mkdir('extractpath')
+        no.untar('archive.tar', 'extractpath', members=[first])
+        assert os.listdir('extractpath') == [first]
+        # The first member is read when the tarball is opened
+        assert len(read) <= 2
+
+    @temp_dir
+    def test_hardlink_target_not_extracted(self):
+        import tarfile
+        os.link('text_file.txt', 'linked.txt')
+        no.tar('text_file.txt', 'linked.txt', 'archive.tar.gz')
+        no.mkdir('extractpath')
+        no.untar('archive.tar.gz', 'extractpath', exclude='[0-9].txt')
+        with open(path.join('extractpath', 'linked.txt')) as fileh:
+            assert fileh.read() == 'text in file'
+        no.mkdir('extractpath2')
+        with pytest.raises(tarfile.ExtractError):
+            no.untar('archive.tar.gz', 'extractpath2', members=['linked.txt'])
+
+
+def _create_tree():
+    no.mkdir('tree')
+    for i in range(4):
+        directory = path.join('tree', 'sub{}'.format(i))
+        os.makedirs(path.join(directory, 'deeper'))
+        for j in range(10):
+            with open(path.join(directory, '{}.dat'.format(j)), 'wb') as fileh:
+                fileh.write(bytes([i, j]) * (j * 1000))
+        with open(path.join(directory, 'deeper', 'script.sh'), 'w') as fileh:
+            fileh.write('#!/bin/sh\n')
+        os.chmod(path.join(directory, 'deeper', 'script.sh'), 0o750)
+    os.symlink('0.dat', path.join('tree', 'sub0', 'link.dat'))
+    os.link(path.join('tree', 'sub1', '1.dat'),
+            path.join('tree', 'sub1', 'hard.dat'))
+    os.utime(path.join('tree', 'sub2'), (0, 0))
+
+
+def _assert_same_tree(source, extracted):
+    for dirpath, dirnames, filenames in os.walk(source):
+        other = path.join(extracted, dirpath)
+        assert sorted(os.listdir(other)) == sorted(dirnames + filenames)
+        for filen in filenames:
+            original = path.join(dirpath, filen)
+            copy = path.join(other, filen)
+            assert path.islink(original) == path.islink(copy)
+            assert os.stat(original).st_mode == os.stat(copy).st_mode
+            with open(original, 'rb') as fileh1, open(copy, 'rb') as fileh2:
+                assert fileh1.read() == fileh2.read()
+
+
+class TestParallelExtraction(object):
+    @pytest.mark.parametrize('compress', [None, 'gz', 'xz'])
+    @pytest.mark.parametrize('index', [False, True])
+    @temp_dir
+    def test_untar_workers(self, compress, index):
+        _create_tree()
+        no.tar('tree', 'tree.tar', compress=compress, index=index)
+        no.mkdir('extractpath')
+        no.untar('tree.tar', 'extractpath', workers=4, index=index)
+        _assert_same_tree('tree', 'extractpath')
+        assert os.stat(path.join('extractpath', 'tree', 'sub2')).st_mtime == 0
+
+    @temp_dir
+    def test_untar_workers_large_member(self, monkeypatch):
+        from nosh import archives
+        monkeypatch.setattr(archives, 'PARALLEL_WRITE_MAX', 1000)
+        monkeypatch.setattr(archives, 'PARALLEL_READ_SIZE', 1000)
+        _create_tree()
+        for compress in (None, 'gz'):
+            no.tar('tree', 'tree.tar', compress=compress)
+            no.mkdir('extractpath')
+            no.untar('tree.tar', 'extractpath', workers=3)
+            _assert_same_tree('tree', 'extractpath')
+            no.rm('tree.tar', 'extractpath', recursive=True)
+
+    @temp_dir
+    def test_untar_workers_selection(self):
+        _create_tree()
+        no.tar('tree', 'tree.tar.gz')
+        no.mkdir('extractpath')
+        no.untar('tree.tar.gz', 'extractpath', include='tree/sub3',
+                 exclude='*.sh', workers=4)
+        assert os.listdir(path.join('extractpath', 'tree')) == ['sub3']
+        assert os.listdir(path.join('extractpath', 'tree', 'sub3',
+                                    'deeper')) == []
+
+    @pytest.mark.parametrize('workers', [1, 4])
+    @temp_dir
+    def test_unzip(self, workers):
+        import zipfile
+        _create_tree()
+        os.utime(path.join('tree', 'sub2'))  # zip can't store 1970
+        with zipfile.ZipFile('tree.zip', 'w', zipfile.ZIP_DEFLATED) as ziph:
+            for dirpath, dirnames, filenames in os.walk('tree'):
+                ziph.write(dirpath)
+                for filen in filenames:
+                    if not path.islink(path.join(dirpath, filen)):
+                        ziph.write(path.join(dirpath, filen))
+        no.mkdir('extractpath')
+        no.unzip('tree.zip', 'extractpath', workers=workers)
+        os.remove(path.join('tree', 'sub0', 'link.dat'))
+        _assert_same_tree('tree', 'extractpath')
+
+    @temp_dir
+    def test_unzip_members(self):
+        no.zip('1.txt', 'text_file.txt', path.join('dir1', 'dir_file.txt'),
+               'archive.zip')
+        no.mkdir('extractpath')
+        no.unzip('archive.zip', 'extractpath', workers=2,
+                 members=['text_file.txt', 'dir1/dir_file.txt'])
+        assert sorted(os.listdir('extractpath')) == ['dir1', 'text_file.txt']
+        assert os.listdir(path.join('extractpath', 'dir1')) == ['dir_file.txt']
+
+        with pytest.raises(KeyError):
+            no.unzip('archive.zip', 'extractpath', members=['not_present'])
+
+    @temp_dir
+    def test_unzip_errors(self):
+        with pytest.raises(FileNotFoundError):
+            no.unzip('not_present.zip')
+        no.zip('1.txt', 'archive.zip')
+        with pytest.raises(FileNotFoundError):
+            no.unzip('archive.zip', 'not_present_dir')
+
+
+class TestZip(object):
+    @pytest.mark.parametrize('compress', [None, 'deflate', 'bz2', 'xz'])
+    @temp_dir
+    def test_compress(self, compress):
+        import zipfile
+        with open('big.txt', 'w') as fileh:
+            fileh.write('compressible ' * 10000)
+        no.zip('big.txt', 'archive.zip', compress=compress, level=None)
+        with zipfile.ZipFile('archive.zip') as ziph:
+            info = ziph.getinfo('big.txt')
+            assert info.compress_type == no.archives.ZIP_METHODS[compress]
+            assert ziph.read('big.txt') == b'compressible ' * 10000
+
+    @temp_dir
+    def test_invalid_compress(self):
+        with pytest.raises(ValueError):
+            no.zip('1.txt', 'archive.zip', compress='rar')
+
+    @temp_dir
+    def test_recursive(self):
+        import zipfile
+        _create_tree()
+        os.utime(path.join('tree', 'sub2'))
+        no.zip('tree', 'flat.zip')
+        with zipfile.ZipFile('flat.zip') as ziph:
+            assert ziph.namelist() == ['tree/']
+        no.zip('tree', 'archive.zip', recursive=True)
+        no.mkdir('extractpath')
+        no.unzip('archive.zip', 'extractpath')
+        os.remove(path.join('tree', 'sub0', 'link.dat'))
+        os.remove(path.join('extractpath', 'tree', 'sub0', 'link.dat'))
+        _assert_same_tree('tree', 'extractpath')
+
+    @pytest.mark.parametrize('precompress', [True, False])
+    @pytest.mark.parametrize('compress', [None, 'deflate', 'xz'])
+    @temp_dir
+    def test_workers(self, compress, precompress, monkeypatch):
+        import zipfile
+        from nosh import archives
+        monkeypatch.setattr(archives, 'PARALLEL_ZIP_MAX', 5000)
+        if not precompress:
+            monkeypatch.setattr(archives, 'PRECOMPRESS_VERSIONS',
+                                ((2, 0), (2, 7)))
+        with zipfile.ZipFile(io.BytesIO(), 'w') as ziph:
+            assert archives._can_precompress(ziph) == precompress
+        _create_tree()
+        os.utime(path.join('tree', 'sub2'))
+        no.zip('tree', 'serial.zip', recursive=True, compress=compress)
+        no.zip('tree', 'parallel.zip', recursive=True, compress=compress,
+               workers=4)
+        with zipfile.ZipFile('serial.zip') as serial, \
+                zipfile.ZipFile('parallel.zip') as parallel:
+            assert parallel.testzip() is None
+            assert serial.namelist() == parallel.namelist()
+            for name in serial.namelist():
+                assert serial.read(name) == parallel.read(name)
+                assert (serial.getinfo(name).external_attr ==
+                        parallel.getinfo(name).external_attr)
+
+    @pytest.mark.parametrize('precompress', [True, False])
+    @pytest.mark.parametrize('workers', [1, 3])
+    @temp_dir
+    def test_stream_to_fileobj(self, workers, precompress, monkeypatch):
+        import zipfile
+        from nosh import archives
+        if not precompress:
+            monkeypatch.setattr(archives, 'PRECOMPRESS_VERSIONS',
+                                ((2, 0), (2, 7)))
+
+        class Unseekable(io.RawIOBase):
+            def __init__(self):
+                self.data = bytearray()
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                self.data.extend(data)
+                return len(data)
+
+        output = Unseekable()
+        no.zip('*.txt', output, workers=workers)
+        with zipfile.ZipFile(io.BytesIO(bytes(output.data))) as ziph:
+            assert ziph.testzip() is None
+            assert ziph.read('text_file.txt') == b'text in file'
+            assert len(ziph.namelist()) == len(FILE_NAMES) + 1
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    @temp_dir
+    def test_unzip_strips_special_bits(self, workers):
+        import stat
+        import zipfile
+        special = {'setuid': stat.S_ISUID | stat.S_ISGID,
+                   'sticky': stat.S_ISVTX}
+        with zipfile.ZipFile('special.zip', 'w') as ziph:
+            for name, bits in special.items():
+                info = zipfile.ZipInfo(name)
+                info.create_system = 3
+                info.external_attr = (stat.S_IFREG | bits | 0o755) << 16
+                ziph.writestr(info, b'data')
+        no.mkdir('out')
+        no.unzip('special.zip', 'out', workers=workers)
+        for name in special:
+            mode = os.stat(path.join('out', name)).st_mode
+            assert stat.S_IMODE(mode) == 0o755
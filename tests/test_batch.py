@@ -0,0 +1,141 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import batch
+from nosh import state
+
+from functools import wraps
+from os import path
+import os
+
+import pytest
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.mkdir('dir1')
+                for filen in ('a.txt', 'b.txt', path.join('dir1', 'c.txt')):
+                    with open(filen, 'w') as fileh:
+                        fileh.write(filen)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def read(filen):
+    with open(filen) as fileh:
+        return fileh.read()
+
+
+def tree():
+    return sorted(path.join(dirpath, name)
+                  for dirpath, dirnames, filenames in os.walk('.')
+                  for name in dirnames + filenames)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+@temp_dir
+def test_plan(workers):
+    with no.plan(workers=workers) as plan:
+        plan.mkdir('build')
+        plan.cp('*.txt', 'build')
+        plan.cp('dir1', 'build', recursive=True)
+        plan.mv(path.join('build', 'a.txt'), path.join('build', 'moved.txt'))
+        plan.rm('b.txt')
+        plan.mkdir(path.join('build', 'deeper', 'still'), parents=True)
+    assert tree() == sorted([
+        './a.txt', './build', './build/b.txt', './build/deeper',
+        './build/deeper/still', './build/dir1', './build/dir1/c.txt',
+        './build/moved.txt', './dir1', './dir1/c.txt'])
+    assert read(path.join('build', 'moved.txt')) == 'a.txt'
+
+
+@temp_dir
+def test_validation_reports_every_problem():
+    before = tree()
+    plan = no.plan()
+    plan.mkdir('build')
+    plan.cp('not_present.txt', 'build')
+    plan.rm('dir1')
+    plan.mv('a.txt', 'b.txt', 'c.txt')
+    with pytest.raises(batch.PlanError) as error:
+        plan.run()
+    assert [type(problem) for problem in error.value.problems] == [
+        FileNotFoundError, IsADirectoryError, NotADirectoryError]
+    assert tree() == before
+
+
+@temp_dir
+def test_validation_follows_earlier_operations():
+    plan = no.plan()
+    plan.mv('dir1', 'renamed')
+    plan.cp(path.join('renamed', 'c.txt'), 'copy.txt')
+    plan.rm(path.join('dir1', 'c.txt'))
+    with pytest.raises(batch.PlanError) as error:
+        plan.validate()
+    assert len(error.value.problems) == 1
+    assert 'dir1' in str(error.value.problems[0])
+
+
+@temp_dir
+def test_permissions():
+    plan = no.plan().cp('a.txt', path.join('dir1', 'a.txt'))
+    with state.set_writable(path.abspath('elsewhere')):
+        with pytest.raises(batch.PlanError) as error:
+            plan.validate()
+    assert isinstance(error.value.problems[0], state.NotWritableError)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+@temp_dir
+def test_rollback(workers, monkeypatch):
+    before = {filen: read(filen) for filen in tree() if path.isfile(filen)}
+
+    original = batch._run_operation
+
+    def failing(operation, journal):
+        if operation.target and operation.target.endswith('fail.txt'):
+            raise OSError('injected failure')
+        return original(operation, journal)
+    monkeypatch.setattr(batch, '_run_operation', failing)
+
+    plan = no.plan(workers=workers)
+    plan.mkdir('build')
+    plan.cp('a.txt', 'b.txt')  # overwrites b.txt
+    plan.cp('dir1', 'build', recursive=True)
+    plan.rm('a.txt')
+    plan.mv(path.join('build', 'dir1'), 'moved')
+    plan.cp('moved', 'fail.txt', recursive=True)
+    with pytest.raises(batch.PlanError) as error:
+        plan.run()
+    assert str(error.value.problems[0]) == 'injected failure'
+
+    assert {filen: read(filen) for filen in tree()
+            if path.isfile(filen)} == before
+    assert tree() == sorted(list(before) + ['./dir1'])
+
+
+def test_levels():
+    Operation = batch.Operation
+    operations = [
+        Operation('mkdir', None, '/a', False),
+        Operation('mkdir', None, '/b', False),
+        Operation('cp', '/src/x', '/a/x', False),
+        Operation('cp', '/src/y', '/b/y', False),
+        Operation('rm', '/src', None, True),
+        Operation('mkdir', None, '/c', False)]
+    levels = batch.assign_levels(operations)
+    assert levels == [
+        [operations[0], operations[1], operations[5]],
+        [operations[2], operations[3]],
+        [operations[4]]]
+
+
+@temp_dir
+def test_plan_runs_once():
+    plan = no.plan().mkdir('build')
+    plan.run()
+    with pytest.raises(ValueError):
+        plan.mkdir('other')
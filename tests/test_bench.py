@@ -0,0 +1,61 @@
+from nosh import bench
+import nosh.dirutils as nodirutils
+
+from os import path
+import json
+import os
+
+
+def test_run():
+    with nodirutils.temp_directory() as temp_dir_name:
+        results = bench.run(temp_dir_name, scale=0.01, repeat=1,
+                            only=['cp/*', 'untar/small', 'overhead/ls',
+                                  'state/is_readable/1'])
+    names = [record['name'] for record in results]
+    assert names == ['cp/small', 'untar/small', 'cp/huge', 'cp/deep',
+                     'cp/wide', 'overhead/ls', 'state/is_readable/1']
+    cp_small = results[0]
+    assert cp_small['files'] == 250 + 2
+    assert cp_small['bytes'] == 250 * 1024
+    assert cp_small['files_per_second'] > 0
+    assert results[-2]['overhead_seconds'] is not None
+
+
+def test_make_tree():
+    with nodirutils.temp_directory() as temp_dir_name:
+        root = path.join(temp_dir_name, 'deep')
+        size = bench.make_tree(root, 'deep', scale=0.05)
+        assert size == (12, 4, 12 * 4096)
+        assert path.isdir(path.join(root, 'level0', 'level1', 'level2'))
+
+
+def test_save_and_compare():
+    old = [bench.result('cp/small', 1.0), bench.result('rm/small', 1.0),
+           bench.result('gone', 1.0)]
+    new = [bench.result('cp/small', 1.5), bench.result('rm/small', 0.95),
+           bench.result('added', 1.0)]
+    with nodirutils.temp_directory() as temp_dir_name:
+        filen = path.join(temp_dir_name, 'results.json')
+        bench.save(filen, old, scale=1.0)
+        with open(filen) as fileh:
+            assert json.load(fileh)['settings'] == {'scale': 1.0}
+        assert bench.load(filen) == old
+    assert bench.compare(old, new) == [
+        ('cp/small', 1.0, 1.5, 1.5, 'slower'),
+        ('rm/small', 1.0, 0.95, 0.95, '')]
+
+
+def test_main(capsys):
+    with nodirutils.temp_directory() as temp_dir_name:
+        first = path.join(temp_dir_name, 'first.json')
+        second = path.join(temp_dir_name, 'second.json')
+        work = path.join(temp_dir_name, 'work')
+        bench.main(['--scale', '0.01', '--repeat', '1', '--only',
+                    'ls/wide', '--output', first, '--dir', work])
+        assert os.listdir(work)
+        bench.main(['--scale', '0.01', '--repeat', '1', '--only',
+                    'ls/wide', '--output', second, '--compare', first])
+        assert [record['name'] for record in bench.load(second)] == [
+            'ls/wide']
+    output = capsys.readouterr().out
+    assert output.count('ls/wide') == 3
@@ -0,0 +1,159 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import cache
+from nosh import hashing
+
+from functools import wraps
+from os import path
+import hashlib
+import os
+
+import pytest
+
+CONTENTS = b'some file contents\n' * 1000
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                with open('file.bin', 'wb') as fileh:
+                    fileh.write(CONTENTS)
+                return func(*args, **kwargs)
+    return new_func
+
+
+@pytest.fixture
+def counted_reads(monkeypatch):
+    reads = []
+    original = hashing.file_digest
+
+    def file_digest(filen, *args, **kwargs):
+        reads.append(filen)
+        return original(filen, *args, **kwargs)
+    monkeypatch.setattr(hashing, 'file_digest', file_digest)
+    return reads
+
+
+@temp_dir
+def test_persistent(counted_reads):
+    with cache.open_cache('digests.sqlite') as digests:
+        digest = digests.digest('file.bin')
+    assert digest == hashlib.sha256(CONTENTS).hexdigest()
+
+    with cache.open_cache('digests.sqlite') as digests:
+        assert len(digests) == 1
+        assert digests.digest('file.bin') == digest
+    assert counted_reads == ['file.bin']
+
+
+@temp_dir
+def test_changed_file_rehashed(counted_reads):
+    with cache.open_cache('digests.sqlite') as digests:
+        digests.digest('file.bin')
+        stat_result = os.stat('file.bin')
+        with open('file.bin', 'wb') as fileh:
+            fileh.write(CONTENTS[::-1])
+        os.utime('file.bin', ns=(stat_result.st_mtime_ns + 10 ** 9, ) * 2)
+        assert digests.digest('file.bin') == hashlib.sha256(
+            CONTENTS[::-1]).hexdigest()
+    assert counted_reads == ['file.bin', 'file.bin']
+
+
+@pytest.mark.parametrize('make_cache', [
+    lambda: hashing.HashCache(max_entries=10),
+    lambda: cache.open_cache(':memory:', max_entries=10)])
+def test_lru_expiry(make_cache):
+    digests = make_cache()
+    keys = [(1, inode, 100, 0, 'sha256', None) for inode in range(30)]
+    for key in keys[:10]:
+        digests.store(key, 'digest')
+    # Using the first key makes it the most recently used
+    assert digests.lookup(keys[0]) == 'digest'
+    for key in keys[10:15]:
+        digests.store(key, 'digest')
+    assert len(digests) <= 10
+    assert digests.lookup(keys[0]) == 'digest'
+    assert digests.lookup(keys[1]) is None
+    assert digests.lookup(keys[14]) == 'digest'
+
+
+def test_restore_not_counted(monkeypatch):
+    prunes = []
+    monkeypatch.setattr(cache.SqliteHashCache, '_prune',
+                        lambda self: prunes.append(self._count))
+    digests = cache.open_cache(':memory:', max_entries=10)
+    keys = [(1, inode, 100, 0, 'sha256', None) for inode in range(10)]
+    for _ in range(5):
+        for key in keys:
+            digests.store(key, 'digest')
+    assert digests._count == len(digests) == 10
+    assert prunes == []
+    digests.store(keys[0], 'other')
+    assert digests.lookup(keys[0]) == 'other'
+
+
+def test_large_inode_numbers():
+    digests = cache.open_cache(':memory:')
+    key = (2 ** 64 - 1, 2 ** 63, 100, 0, 'sha256', None)
+    digests.store(key, 'digest')
+    assert digests.lookup(key) == 'digest'
+
+
+@temp_dir
+def test_use_cache(counted_reads):
+    digests = hashing.HashCache()
+    with cache.use_cache(digests):
+        assert cache.get_cache() is digests
+        no.checksum('file.bin')
+        no.checksum('file.bin')
+    assert cache.get_cache() is not digests
+    assert counted_reads == [path.abspath('file.bin')]
+    assert len(digests) == 1
+
+
+@temp_dir
+def test_checksum():
+    no.mkdir('dir')
+    for name in ('b', 'a'):
+        with open(path.join('dir', name), 'w') as fileh:
+            fileh.write(name)
+    results = no.checksum('file.bin', 'dir', recursive=True,
+                          algorithm='md5', workers=2)
+    assert results == [
+        (path.abspath('file.bin'), hashlib.md5(CONTENTS).hexdigest()),
+        (path.abspath(path.join('dir', 'a')), hashlib.md5(b'a').hexdigest()),
+        (path.abspath(path.join('dir', 'b')), hashlib.md5(b'b').hexdigest())]
+
+    with pytest.raises(IsADirectoryError):
+        no.checksum('dir')
+    with pytest.raises(FileNotFoundError):
+        no.checksum('not_present', cache=hashing.HashCache())
+
+
+@temp_dir
+def test_cp_verify(monkeypatch):
+    from nosh import copyutils
+    results = no.cp('file.bin', 'copy.bin', verify=True)
+    assert results[0].error is None
+
+    def corrupting_copy(source, target, backend='auto'):
+        with open(copyutils.file_target(source, target), 'wb') as fileh:
+            fileh.write(b'corrupt')
+        return 'corrupting'
+    monkeypatch.setattr(copyutils, 'copy', corrupting_copy)
+    with pytest.raises(copyutils.VerificationError):
+        no.cp('file.bin', 'copy2.bin', verify=True)
+
+
+@temp_dir
+def test_sync_checksum_uses_cache(counted_reads):
+    digests = hashing.HashCache()
+    no.sync('file.bin', 'copy.bin')
+    summary = no.sync('file.bin', 'copy.bin', checksum=True, cache=digests)
+    assert summary.skipped == [path.abspath('copy.bin')]
+    assert len(counted_reads) == 2
+    no.sync('file.bin', 'copy.bin', checksum=True, cache=digests)
+    assert len(counted_reads) == 2
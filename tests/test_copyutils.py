@@ -0,0 +1,125 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import copyutils
+
+from functools import wraps
+from os import path
+import os
+
+import pytest
+
+CONTENTS = b'some file contents\n' * 10000
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                with open('source.bin', 'wb') as fileh:
+                    fileh.write(CONTENTS)
+                os.chmod('source.bin', 0o640)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def read(filen):
+    with open(filen, 'rb') as fileh:
+        return fileh.read()
+
+
+@temp_dir
+def test_auto_backend():
+    backend = copyutils.copyfile('source.bin', 'target.bin')
+    assert backend in copyutils.BACKENDS
+    assert read('target.bin') == CONTENTS
+
+
+@pytest.mark.parametrize('backend', ['copy_file_range', 'sendfile',
+                                     'userspace'])
+@temp_dir
+def test_explicit_backend(backend):
+    if backend == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+        pytest.skip('os.copy_file_range is not available')
+    if backend == 'sendfile' and not hasattr(os, 'sendfile'):
+        pytest.skip('os.sendfile is not available')
+    assert copyutils.copyfile('source.bin', 'target.bin',
+                              backend=backend) == backend
+    assert read('target.bin') == CONTENTS
+
+
+@pytest.mark.parametrize('backend', ['copy_file_range', 'sendfile',
+                                     'userspace'])
+@temp_dir
+def test_size_is_only_a_hint(backend, monkeypatch):
+    # e.g. a file that grew after it was statted
+    if backend == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+        pytest.skip('os.copy_file_range is not available')
+    if backend == 'sendfile' and not hasattr(os, 'sendfile'):
+        pytest.skip('os.sendfile is not available')
+    fstat = os.fstat
+
+    def empty_fstat(fd):
+        values = list(fstat(fd))
+        values[6] = 0  # st_size
+        return os.stat_result(values)
+
+    monkeypatch.setattr(os, 'fstat', empty_fstat)
+    assert copyutils.copyfile('source.bin', 'target.bin',
+                              backend=backend) == backend
+    assert read('target.bin') == CONTENTS
+
+
+@pytest.mark.skipif(not path.exists('/proc/cpuinfo'),
+                    reason='/proc/cpuinfo is not available')
+@temp_dir
+def test_proc_file():
+    assert os.stat('/proc/cpuinfo').st_size == 0
+    copyutils.copyfile('/proc/cpuinfo', 'cpuinfo')
+    assert read('cpuinfo') and read('cpuinfo') == read('/proc/cpuinfo')
+    no.cp('/proc/cpuinfo', 'cpuinfo2')
+    assert read('cpuinfo2') == read('cpuinfo')
+
+
+@temp_dir
+def test_fallback_after_unsupported():
+    def half_copy_then_fail(src_fd, dst_fd, size):
+        os.write(dst_fd, os.read(src_fd, size // 2))
+        raise copyutils.BackendUnsupported('not here')
+
+    copyutils.register_backend('failing', half_copy_then_fail,
+                               before='reflink')
+    try:
+        assert list(copyutils.BACKENDS)[0] == 'failing'
+        assert copyutils.copyfile('source.bin', 'target.bin') != 'failing'
+        assert read('target.bin') == CONTENTS
+    finally:
+        del copyutils.BACKENDS['failing']
+
+
+@temp_dir
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        copyutils.copyfile('source.bin', 'target.bin', backend='carrier_pigeon')
+
+
+@temp_dir
+def test_copy_keeps_mode():
+    os.mkdir('dir1')
+    copyutils.copy('source.bin', 'dir1', backend='userspace')
+    assert read(path.join('dir1', 'source.bin')) == CONTENTS
+    assert os.stat(path.join('dir1', 'source.bin')).st_mode & 0o777 == 0o640
+
+
+@temp_dir
+def test_cp_reports_backend():
+    results = no.cp('source.bin', 'target.bin', backend='userspace')
+    assert [result.backend for result in results] == ['userspace']
+
+
+@temp_dir
+def test_mv_reports_rename():
+    results = no.mv('source.bin', 'target.bin')
+    assert [result.backend for result in results] == ['rename']
+    assert read('target.bin') == CONTENTS
@@ -0,0 +1,158 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import copyutils
+from nosh import dedupeutils
+from nosh import hashing
+
+from functools import wraps
+from os import path
+import os
+
+import pytest
+
+SMALL = b'small file\n'
+LARGE = b'large file contents\n' * 10000
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                for filen, contents in [
+                        ('small1', SMALL), ('small2', SMALL),
+                        ('large1', LARGE), ('large2', LARGE),
+                        # Same size and start as large1, different end
+                        ('large3', LARGE[:-1] + b'!'),
+                        ('unique', b'unique'), ('empty1', b''),
+                        ('empty2', b'')]:
+                    with open(filen, 'wb') as fileh:
+                        fileh.write(contents)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def all_files():
+    return sorted(os.listdir('.'))
+
+
+@temp_dir
+def test_find_duplicates():
+    groups = dedupeutils.find_duplicates(all_files())
+    assert sorted(groups) == [['large1', 'large2'], ['small1', 'small2']]
+
+
+@temp_dir
+def test_hard_links_count_once():
+    os.link('small1', 'small1_link')
+    groups = dedupeutils.find_duplicates(all_files())
+    assert ['small1', 'small2'] in groups
+
+
+@temp_dir
+def test_staged_hashing(monkeypatch):
+    reads = []
+    original = hashing.file_digest
+
+    def file_digest(filen, algorithm=hashing.DEFAULT_ALGORITHM, limit=None):
+        reads.append((filen, limit))
+        return original(filen, algorithm, limit)
+    monkeypatch.setattr(hashing, 'file_digest', file_digest)
+
+    cache = hashing.HashCache()
+    dedupeutils.find_duplicates(all_files(), cache=cache)
+    # unique and the empty files are never read, the small files are
+    # read once in full and the large ones partially then in full
+    assert sorted(reads, key=repr) == sorted(
+        [('small1', None), ('small2', None)] +
+        [(filen, hashing.PARTIAL_HASH_SIZE)
+         for filen in ('large1', 'large2', 'large3')] +
+        [('large1', None), ('large2', None), ('large3', None)], key=repr)
+
+    del reads[:]
+    dedupeutils.find_duplicates(all_files(), cache=cache)
+    assert reads == []
+
+    # Only the changed file is read again
+    mtime_ns = os.stat('large2').st_mtime_ns
+    with open('large2', 'wb') as fileh:
+        fileh.write(LARGE[:-1] + b'?')
+    os.utime('large2', ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    assert dedupeutils.find_duplicates(all_files(), cache=cache) == [
+        ['small1', 'small2']]
+    assert reads == [('large2', hashing.PARTIAL_HASH_SIZE), ('large2', None)]
+
+
+@temp_dir
+def test_partial_digest():
+    assert (hashing.file_digest('large1', limit=100) ==
+            hashing.file_digest('large3', limit=100))
+    assert hashing.file_digest('large1') != hashing.file_digest('large3')
+
+
+@temp_dir
+def test_link_duplicates_skips_changed():
+    groups = dedupeutils.find_duplicate_stats(['small1', 'small2'])
+    with open('small2', 'ab') as fileh:
+        fileh.write(b'changed')
+    summary = dedupeutils.link_duplicates(groups)
+    assert summary.linked == []
+    assert len(summary.errors) == 1
+    assert not path.samefile('small1', 'small2')
+
+
+def stale_rewrite(filen, contents):
+    '''Rewrite ``filen`` without changing its size, mtime or inode, as a
+    write within one mtime tick would.'''
+    stat_result = os.stat(filen)
+    with open(filen, 'r+b') as fileh:
+        fileh.write(contents)
+    os.utime(filen, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+    assert hashing.stat_key(os.stat(filen)) == hashing.stat_key(stat_result)
+
+
+@temp_dir
+def test_link_duplicates_compares_bytes():
+    cache = hashing.HashCache()
+    dedupeutils.find_duplicates(all_files(), cache=cache)
+    stale_rewrite('small2', SMALL.upper())
+    groups = dedupeutils.find_duplicate_stats(['small1', 'small2'],
+                                              cache=cache)
+    assert len(groups) == 1  # the cached digest is stale
+
+    summary = dedupeutils.link_duplicates(groups)
+    assert summary.linked == []
+    assert len(summary.errors) == 1
+    assert not path.samefile('small1', 'small2')
+    with open('small2', 'rb') as fileh:
+        assert fileh.read() == SMALL.upper()
+
+
+@temp_dir
+def test_copy_deduplicated_compares_bytes():
+    cache = hashing.HashCache()
+    dedupeutils.find_duplicates(all_files(), cache=cache)
+    stale_rewrite('large2', LARGE[:-1] + b'?')
+    os.mkdir('out')
+    results = dedupeutils.copy_deduplicated(
+        [([('large1', 'out'), ('large2', 'out')], copyutils.copy2)], cache=cache)
+    assert [result.error for result in results] == [None, None]
+    assert not path.samefile(path.join('out', 'large1'),
+                             path.join('out', 'large2'))
+    with open(path.join('out', 'large2'), 'rb') as fileh:
+        assert fileh.read() == LARGE[:-1] + b'?'
+
+
+@temp_dir
+def test_same_contents():
+    assert dedupeutils.same_contents('large1', 'large2')
+    assert dedupeutils.same_contents('empty1', 'empty2')
+    assert not dedupeutils.same_contents('large1', 'large3')
+    assert not dedupeutils.same_contents('small1', 'empty1')
+
+
+@temp_dir
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        dedupeutils.link_file('small1', 'small2', mode='symlink')
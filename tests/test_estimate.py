@@ -0,0 +1,111 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import estimate
+
+from functools import wraps
+from os import path
+import os
+
+import pytest
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.makedirs(path.join('dir1', 'sub'))
+                for filen, size in (('a.txt', 10), ('b.txt', 20),
+                                    (path.join('dir1', 'c.txt'), 30),
+                                    (path.join('dir1', 'sub', 'd.txt'), 40)):
+                    with open(filen, 'wb') as fileh:
+                        fileh.write(b'x' * size)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def tree():
+    return sorted(path.join(dirpath, name)
+                  for dirpath, dirnames, filenames in os.walk('.')
+                  for name in dirnames + filenames)
+
+
+@temp_dir
+def test_measure():
+    os.symlink('a.txt', path.join('dir1', 'link'))
+    assert estimate.measure('dir1') == estimate.Size(3, 2, 70)
+    assert estimate.measure('dir1', recursive=False) == estimate.Size(0, 1, 0)
+    assert estimate.measure('a.txt') == estimate.Size(1, 0, 10)
+    assert estimate.measure('missing') == estimate.Size(0, 0, 0)
+
+
+@temp_dir
+def test_cp_dry_run():
+    before = tree()
+    report = no.cp('*.txt', 'dir1', 'dir1/sub', recursive=True, dry_run=True)
+    assert tree() == before
+    assert report.command == 'cp'
+    assert sorted((op.action, path.basename(op.target))
+                  for op in report.operations) == [
+                      ('copy', 'a.txt'), ('copy', 'b.txt'), ('copy', 'dir1')]
+    assert (report.files, report.directories, report.bytes) == (4, 2, 100)
+    assert not report.cross_device
+    assert report.seconds > 0
+    assert report.problems == []
+
+
+@temp_dir
+def test_dry_run_problems():
+    report = no.cp('dir1', 'a.txt', 'b.txt', dry_run=True)
+    assert len(report.problems) == 2
+    report = no.rm('dir1', dry_run=True)
+    assert report.operations == []
+    assert 'Is a directory' in report.problems[0]
+    assert no.mkdir('dir1', dry_run=True).problems
+    assert no.mkdir('x/y', dry_run=True).problems
+    assert len(no.mkdir('x/y', parents=True, dry_run=True).operations) == 2
+
+
+@temp_dir
+def test_mv_and_rm_dry_run():
+    before = tree()
+    report = no.mv('dir1', 'moved', dry_run=True)
+    assert [op.action for op in report.operations] == ['rename']
+    assert report.files == 2
+    report = no.rm('*.txt', 'dir1', recursive=True, dry_run=True)
+    assert (report.files, report.directories, report.bytes) == (4, 2, 100)
+    assert tree() == before
+
+
+@temp_dir
+def test_archive_dry_runs():
+    report = no.tar('a.txt', 'dir1', 'out.tar.gz', dry_run=True)
+    assert not path.exists('out.tar.gz')
+    assert (report.files, report.bytes) == (3, 80)
+    no.tar('a.txt', 'dir1', 'out.tar.gz')
+    assert no.tar('a.txt', 'out.tar.gz', dry_run=True).problems
+
+    os.mkdir('extracted')
+    report = no.untar('out.tar.gz', 'extracted', include='dir1/sub',
+                      dry_run=True)
+    assert os.listdir('extracted') == []
+    assert (report.files, report.directories, report.bytes) == (1, 1, 40)
+    report = no.untar('out.tar.gz', 'extracted', members=['nope'],
+                      dry_run=True)
+    assert report.problems
+
+    report = no.zip('a.txt', 'dir1', 'out.zip', recursive=True, dry_run=True)
+    assert not path.exists('out.zip')
+    assert (report.files, report.directories, report.bytes) == (3, 2, 80)
+    no.zip('a.txt', 'dir1', 'out.zip', recursive=True)
+    report = no.unzip('out.zip', 'extracted', dry_run=True)
+    assert os.listdir('extracted') == []
+    assert (report.files, report.directories, report.bytes) == (3, 2, 80)
+
+
+def test_cost():
+    assert estimate.cost('rename', 100, 10 ** 9) == estimate.RATES['rename'][0] * 100
+    assert estimate.compression_cost(None, 10 ** 9) == 0
+    assert (estimate.compression_cost('gz', 10 ** 6, threads=2) ==
+            pytest.approx(estimate.compression_cost('gz', 10 ** 6) / 2))
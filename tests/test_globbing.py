@@ -0,0 +1,80 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import globbing
+
+from functools import wraps
+from os import path
+import glob
+import os
+
+import pytest
+
+FILE_NAMES = ['{}.txt'.format(i) for i in range(5)] + [
+    '0.log', '1.log', '0.csv', '.hidden.txt']
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                for dir_name in ('dir1', path.join('dir1', 'sub'), 'dir2'):
+                    os.mkdir(dir_name)
+                for dir_name in ('', 'dir1', path.join('dir1', 'sub')):
+                    for file_name in FILE_NAMES:
+                        with open(path.join(dir_name, file_name), 'w'):
+                            pass
+                return func(*args, **kwargs)
+    return new_func
+
+
+@pytest.mark.parametrize('pattern', [
+    '*.txt', '[1-3].*', '?.log', '*', 'dir*', '*/*.txt', '*/*/*.log',
+    '.*', 'dir1/sub/*.csv', 'not_here*', 'dir1/*/0.txt'])
+@temp_dir
+def test_matches_glob(pattern):
+    assert sorted(globbing.glob(pattern)) == sorted(glob.glob(pattern))
+    absolute = path.abspath(pattern)
+    assert sorted(globbing.glob(absolute)) == sorted(glob.glob(absolute))
+
+
+@temp_dir
+def test_recursive():
+    assert sorted(globbing.glob('**/*.log')) == sorted(
+        glob.glob('**/*.log', recursive=True))
+    assert sorted(globbing.glob('dir1/**/0.csv')) == sorted(
+        glob.glob('dir1/**/0.csv', recursive=True))
+
+
+def test_expand_braces():
+    assert globbing.expand_braces('a{b,c{d,e}}f') == ['abf', 'acdf', 'acef']
+    assert globbing.expand_braces('a{b}c') == ['a{b}c']
+    assert globbing.expand_braces('{a,b}{c,d}') == ['ac', 'ad', 'bc', 'bd']
+    assert globbing.has_magic('{a,b}')
+    assert not globbing.has_magic('{a}')
+
+
+@temp_dir
+def test_braces():
+    assert sorted(globbing.glob('*.{log,csv}')) == [
+        '0.csv', '0.log', '1.log']
+
+
+@temp_dir
+def test_expand_globs_keeps_pattern_order():
+    assert globbing.expand_globs(['*.log', '*.csv', '0.*']) == (
+        sorted(glob.glob('*.log'), key=os.listdir().index) + ['0.csv'] +
+        [f for f in os.listdir() if f.startswith('0.')])
+
+
+@temp_dir
+def test_expand_args():
+    assert globbing.expand_args(['not_here.txt', '*.csv', 'dir1']) == [
+        'not_here.txt', '0.csv', 'dir1']
+
+
+@temp_dir
+def test_cp_many_patterns():
+    no.cp('*.log', '*.csv', 'dir2')
+    assert sorted(os.listdir('dir2')) == ['0.csv', '0.log', '1.log']
@@ -0,0 +1,124 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import instrumentation, vfs
+
+from functools import wraps
+from os import path
+import json
+import os
+
+import pytest
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.makedirs(path.join('dir1', 'sub'))
+                for filen, size in (('a.txt', 10), ('b.txt', 20),
+                                    (path.join('dir1', 'c.txt'), 30),
+                                    (path.join('dir1', 'sub', 'd.txt'), 40)):
+                    with open(filen, 'wb') as fileh:
+                        fileh.write(b'x' * size)
+                return func(*args, **kwargs)
+    return new_func
+
+
+@temp_dir
+def test_records_phases_and_operations():
+    with no.instrument() as recorder:
+        no.cp('dir1', 'dir2', recursive=True)
+        no.ls('.')
+    cp_record, ls_record = recorder.records
+    assert cp_record.command == 'cp'
+    assert set(cp_record.phases) == {'require_args', 'expand_paths',
+                                     'permissions', 'run'}
+    assert sum(cp_record.phases.values()) == pytest.approx(cp_record.seconds)
+    assert cp_record.operations['copy'] == 2
+    assert cp_record.bytes == 70
+    assert cp_record.files >= 2
+    assert cp_record.error is None
+    assert ls_record.command == 'ls'
+    assert 'require_args' not in ls_record.phases
+
+    summary = recorder.summary()
+    assert summary['cp']['calls'] == 1
+    assert summary['cp']['bytes'] == 70
+    assert json.loads(json.dumps(recorder.to_dicts()))[0]['command'] == 'cp'
+
+
+@temp_dir
+def test_records_errors_and_dry_runs():
+    with no.instrument() as recorder:
+        with pytest.raises(FileNotFoundError):
+            no.rm('missing')
+        no.mv('a.txt', 'moved.txt', dry_run=True)
+    rm_record, mv_record = recorder.records
+    assert rm_record.error == 'FileNotFoundError'
+    assert 'dry_run' in mv_record.phases
+    assert mv_record.files == 0
+    assert path.exists('a.txt')
+    assert recorder.summary()['rm']['errors'] == 1
+
+
+@temp_dir
+def test_workers_are_counted():
+    with no.instrument() as recorder:
+        no.cp('dir1', 'dir2', recursive=True, workers=4)
+    record, = recorder.records
+    assert record.operations['copy'] == 2
+    assert record.bytes == 70
+
+
+def test_memory_filesystem():
+    fs = vfs.MemoryFileSystem()
+    with vfs.use_filesystem(fs), no.instrument() as recorder:
+        no.mkdir('/dir')
+        no.touch('/dir/file')
+        with pytest.raises(vfs.UnsupportedFileSystem):
+            no.tar('/dir', '/dir.tar')
+    mkdir_record, touch_record, tar_record = recorder.records
+    assert mkdir_record.operations['mkdir'] == 1
+    assert touch_record.operations['open'] == 1
+    assert tar_record.error == 'UnsupportedFileSystem'
+    assert 'require_local' in tar_record.phases
+
+
+@temp_dir
+def test_hooks():
+    records = []
+    instrumentation.add_hook(records.append)
+    try:
+        no.touch('new.txt')
+    finally:
+        instrumentation.remove_hook(records.append)
+    no.touch('other.txt')
+    assert [record.command for record in records] == ['touch']
+    assert records[0].operations['open'] == 1
+
+
+@temp_dir
+def test_failing_hooks():
+    def hook(record):
+        raise ValueError('metrics are down')
+    instrumentation.add_hook(hook)
+    try:
+        with pytest.warns(RuntimeWarning, match='metrics are down'):
+            no.touch('new.txt')
+        assert path.exists('new.txt')
+        # The command's own error is the one raised
+        with pytest.warns(RuntimeWarning):
+            with pytest.raises(FileNotFoundError):
+                no.rm('missing.txt')
+    finally:
+        instrumentation.remove_hook(hook)
+
+
+@temp_dir
+def test_disabled():
+    no.cp('a.txt', 'c.txt')
+    assert instrumentation.current_call() is None
+    assert vfs.get_filesystem() is vfs.LOCAL
+    assert instrumentation.phase(no.cp, 'run') is instrumentation._NULL_PHASE
@@ -0,0 +1,154 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import archives, estimate, progress
+
+from functools import wraps
+from os import path
+import io
+import os
+import time
+
+import pytest
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.makedirs(path.join('dir1', 'sub'))
+                for filen, size in (('a.txt', 10), ('b.txt', 20),
+                                    (path.join('dir1', 'c.txt'), 30),
+                                    (path.join('dir1', 'sub', 'd.txt'), 40)):
+                    with open(filen, 'wb') as fileh:
+                        fileh.write(b'x' * size)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def last_report(command, *args, **kwargs):
+    reports = []
+    command(*args, progress=reports.append, **kwargs)
+    assert reports[-1].finished
+    assert not any(report.finished for report in reports[:-1])
+    return reports[-1]
+
+
+@temp_dir
+@pytest.mark.parametrize('workers', [1, 4])
+def test_cp_and_rm(workers):
+    report = last_report(no.cp, 'dir1', 'dir2', recursive=True,
+                         workers=workers)
+    assert (report.files, report.files_total) == (2, 2)
+    assert (report.bytes, report.bytes_total) == (70, 70)
+    assert report.command == 'cp'
+    assert report.eta == 0
+
+    report = last_report(no.rm, 'dir2', recursive=True, workers=workers)
+    assert (report.files, report.files_total) == (2, 2)
+    assert report.bytes_total is None
+    assert not path.exists('dir2')
+
+
+@temp_dir
+def test_mv():
+    report = last_report(no.mv, 'dir1', 'moved')
+    assert (report.files, report.bytes) == (2, 70)
+    assert path.exists(path.join('moved', 'sub', 'd.txt'))
+
+
+@temp_dir
+def test_archives():
+    report = last_report(no.tar, 'dir1', 'dir1.tar.gz', index=True)
+    assert (report.files, report.bytes) == (2, 70)
+    os.mkdir('out')
+    report = last_report(no.untar, 'dir1.tar.gz', 'out')
+    assert (report.files, report.files_total) == (2, 2)
+    assert report.bytes == report.bytes_total == 70
+
+    report = last_report(no.zip, 'dir1', 'dir1.zip', recursive=True)
+    assert (report.files, report.bytes) == (2, 70)
+    os.mkdir('out2')
+    report = last_report(no.unzip, 'dir1.zip', 'out2', workers=2)
+    assert (report.files, report.bytes) == (2, 70)
+
+
+@temp_dir
+def test_untar_without_index(monkeypatch):
+    no.tar('dir1', 'dir1.tar.gz')
+    scans = []
+    lstar = archives._lstar
+
+    def counted_lstar(*args):
+        scans.append(args)
+        return lstar(*args)
+    monkeypatch.setattr(archives, '_lstar', counted_lstar)
+    os.mkdir('out')
+    # No dry run decompressing the tarball before it is extracted
+    report = last_report(no.untar, 'dir1.tar.gz', 'out')
+    assert scans == []
+    assert (report.files, report.files_total) == (2, None)
+    assert (report.bytes, report.bytes_total) == (70, None)
+    assert path.exists(path.join('out', 'dir1', 'sub', 'd.txt'))
+
+
+@temp_dir
+def test_dry_run_ignores_progress():
+    reports = []
+    result = no.cp('a.txt', 'c.txt', dry_run=True, progress=reports.append)
+    assert result.files == 1
+    assert reports == []
+
+
+def test_reports_from_thread():
+    reports = []
+    with progress.Progress(reports.append, 'test', files_total=4,
+                           bytes_total=400, interval=0.01):
+        progress.advance(1, 100)
+        time.sleep(0.1)
+        assert progress.active()
+    assert not progress.active()
+    progress.advance(1, 100)  # no effect outside
+
+    assert len(reports) > 2
+    report = reports[-2]
+    assert (report.files, report.bytes) == (1, 100)
+    assert not report.finished
+    assert report.stalled > 0.05
+    # A quarter done in about 0.1s, so about 0.3s to go
+    assert 0.2 < report.eta < 1
+    assert reports[-1].finished
+
+
+def test_complete():
+    operations = [
+        estimate.PlannedOperation(action, '/a', None, 3, 1, 300, False, 0)
+        for action in ('copy', 'remove')]
+    tracker = progress.Progress(None, 'mv', 10, 1000, operations)
+    tracker.complete('/b')
+    assert tracker.files == 0
+    tracker.complete('/a', 'remove')
+    assert (tracker.files, tracker.bytes) == (3, 300)
+    tracker.complete('/a')
+    assert (tracker.files, tracker.bytes) == (9, 900)
+
+
+def test_progress_bar():
+    bar = progress.ProgressBar(file=io.StringIO(), width=10, stall_after=5)
+    report = progress.ProgressReport(
+        'cp', 50, 100, 500e6, 1e9, 10., 5., 50e6, 10., 1., False)
+    assert bar.format(report) == (
+        'cp [#####.....]  50%  50/100 files  500.0 MB/1.0 GB  '
+        '50.0 MB/s  ETA 0:00:10')
+    assert bar.format(report._replace(stalled=75.)).endswith(
+        'stalled for 0:01:15')
+    assert bar.format(report._replace(bytes_total=None, bytes=0)) == (
+        'cp [#####.....]  50%  50/100 files  5 files/s  ETA 0:00:10')
+
+    bar(report)
+    bar(report._replace(finished=True, files=100, bytes=1e9))
+    output = bar.file.getvalue()
+    assert output.startswith('\rcp [#####.....]')
+    assert output.endswith('\rcp [##########] 100%  100/100 files  '
+                           '1.0 GB/1.0 GB  50.0 MB/s  in 0:00:10  \n')
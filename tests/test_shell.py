@@ -2,8 +2,12 @@ import nosh as no
 import nosh.utils as noutils
 import nosh.dirutils as nodirutils
 from nosh import state
+from nosh import entries
 
 from os import path
+from unittest import mock
+import contextlib
+import io
 import os
 
 import pytest
@@ -151,6 +155,39 @@ class TestCp(object):
         assert path.exists(path.join('new_dir', '1.txt'))
         assert path.exists(path.join('new_dir', '2.txt'))
 
+    @temp_dir
+    def test_cp_dir_recursive_workers(self):
+        no.mkdir(path.join('dir1', 'nested', 'deeper'), parents=True)
+        for i in range(20):
+            no.touch(path.join('dir1', 'nested', 'deeper', '{}.txt'.format(i)))
+        no.cp('*.txt', 'dir1')
+
+        results = no.cp('dir1', 'new_dir', recursive=True, workers=4)
+
+        assert all(result.error is None for result in results)
+        assert path.exists(path.join('new_dir', '1.txt'))
+        for i in range(20):
+            assert path.exists(path.join(
+                'new_dir', 'nested', 'deeper', '{}.txt'.format(i)))
+
+    @temp_dir
+    def test_cp_dir_recursive_workers_errors(self):
+        no.cp('*.txt', 'dir1')
+        os.symlink('not_here.txt', path.join('dir1', 'broken_link.txt'))
+
+        with pytest.raises(FileNotFoundError):
+            no.cp('dir1', 'new_dir', recursive=True, workers=4)
+        # the other files are still copied
+        assert path.exists(path.join('new_dir', '1.txt'))
+
+        results = no.cp('dir1', 'new_dir2', recursive=True, workers=4,
+                        ignore_errors=True)
+        failures = [result for result in results if result.error is not None]
+        assert len(failures) == 1
+        assert failures[0].source == path.abspath(
+            path.join('dir1', 'broken_link.txt'))
+        assert path.exists(path.join('new_dir2', '1.txt'))
+
     @temp_dir
     def test_cp_source_not_readable(self):
         with state.set_readable():
@@ -168,6 +205,95 @@ class TestCp(object):
                 
 
 
+class TestSync(object):
+    @temp_dir
+    def test_sync_new_target(self):
+        no.cp('*.txt', 'dir1')
+        summary = no.sync('dir1', 'new_dir')
+        assert path.exists(path.join('new_dir', 'dir1', 'text_file.txt'))
+        assert len(summary.copied) == len(FILE_NAMES) + 1
+        assert summary.bytes_transferred == len('text in file')
+
+    @temp_dir
+    def test_sync_skips_unchanged(self):
+        no.cp('*.txt', 'dir1')
+        no.sync('dir1', 'new_dir')
+
+        with open(path.join('dir1', 'text_file.txt'), 'w') as fileh:
+            fileh.write('changed text in file')
+        summary = no.sync('dir1', 'new_dir')
+
+        assert summary.copied == [(
+            path.abspath(path.join('dir1', 'text_file.txt')),
+            path.abspath(path.join('new_dir', 'dir1', 'text_file.txt')))]
+        assert len(summary.skipped) == len(FILE_NAMES)
+        assert summary.bytes_transferred == len('changed text in file')
+        assert summary.bytes_skipped == 0
+        with open(path.join('new_dir', 'dir1', 'text_file.txt')) as fileh:
+            assert fileh.read() == 'changed text in file'
+
+    @temp_dir
+    def test_sync_checksum(self):
+        no.sync('text_file.txt', 'copy.txt')
+        with open('text_file.txt', 'w') as fileh:
+            fileh.write('TEXT IN FILE')
+        os.utime('text_file.txt', ns=(os.stat('copy.txt').st_atime_ns,
+                                      os.stat('copy.txt').st_mtime_ns))
+
+        assert no.sync('text_file.txt', 'copy.txt').skipped
+        summary = no.sync('text_file.txt', 'copy.txt', checksum=True)
+        assert len(summary.copied) == 1
+        with open('copy.txt') as fileh:
+            assert fileh.read() == 'TEXT IN FILE'
+
+    @temp_dir
+    def test_sync_delete(self):
+        no.cp('*.txt', 'dir1')
+        no.sync('dir1', 'dir2')
+        no.touch(path.join('dir2', 'dir1', 'extra.txt'))
+        no.mkdir(path.join('dir2', 'dir1', 'extra_dir'))
+
+        summary = no.sync('dir1', 'dir2')
+        assert not summary.deleted
+        assert path.exists(path.join('dir2', 'dir1', 'extra.txt'))
+
+        summary = no.sync('dir1', 'dir2', delete=True)
+        assert len(summary.deleted) == 2
+        assert not path.exists(path.join('dir2', 'dir1', 'extra.txt'))
+        assert not path.exists(path.join('dir2', 'dir1', 'extra_dir'))
+
+    @temp_dir
+    def test_sync_delete_symlinked_dir(self):
+        no.touch(path.join('dir2', 'kept.txt'))
+        no.sync('dir1', 'target')
+        os.symlink(path.abspath('dir2'), path.join('target', 'dir1', 'link'))
+        # A file in the source where the target has a linked directory
+        no.touch(path.join('dir1', 'replaced'))
+        os.symlink(path.abspath('dir2'),
+                   path.join('target', 'dir1', 'replaced'))
+
+        summary = no.sync('dir1', 'target', delete=True)
+        assert summary.errors == []
+        assert sorted(os.listdir(path.join('target', 'dir1'))) == [
+            'replaced']
+        assert not path.islink(path.join('target', 'dir1', 'replaced'))
+        # The linked directory itself is untouched
+        assert os.listdir('dir2') == ['kept.txt']
+
+    @temp_dir
+    def test_sync_dry_run(self):
+        no.cp('*.txt', 'dir1')
+        summary = no.sync('dir1', 'new_dir', dry_run=True)
+        assert not path.exists('new_dir')
+        assert len(summary.copied) == len(FILE_NAMES) + 1
+
+    @temp_dir
+    def test_sync_target_not_writable(self):
+        with state.set_writable():
+            with pytest.raises(state.NotWritableError):
+                no.sync('dir1', 'dir2')
+
+
 class TestLs(object):
     @temp_dir
     def test_ls(self):
@@ -190,6 +316,53 @@ class TestLs(object):
 
         assert len(no.ls('[1-2].txt', '3.txt')) == 3
 
+    @temp_dir
+    def test_ls_long(self):
+        filens = os.listdir()
+        entries = no.ls(long=True)
+        assert [entry.name for entry in entries] == filens
+
+        by_name = {entry.name: entry for entry in entries}
+        assert by_name['dir1'].is_dir()
+        assert not by_name['dir1'].is_file()
+        assert by_name['text_file.txt'].is_file()
+        assert by_name['text_file.txt'].size == len('text in file')
+
+    @temp_dir
+    def test_ls_entries_file(self):
+        entries = no.ls_entries('text_file.txt')
+        assert len(entries) == 1
+        assert entries[0].path == path.abspath('text_file.txt')
+        assert entries[0].is_file()
+
+    @temp_dir
+    def test_ls_sort(self):
+        with open('big.txt', 'w') as fileh:
+            fileh.write('a' * 100)
+        os.utime('1.txt', (0, 0))
+
+        assert no.ls(sort='name') == sorted(os.listdir())
+        assert no.ls(sort='name', reverse=True) == sorted(
+            os.listdir(), reverse=True)
+        assert no.ls('*.txt', sort='size', reverse=True)[0] == path.abspath(
+            'big.txt')
+        assert no.ls_entries(sort='mtime')[0].name == '1.txt'
+
+        with pytest.raises(ValueError):
+            no.ls(sort='colour')
+
+    @temp_dir
+    def test_ls_sort_dangling_symlink(self):
+        os.symlink('missing.txt', 'dangling')
+        names = sorted(os.listdir())
+        for sort in ('name', 'size', 'mtime'):
+            assert sorted(no.ls(sort=sort)) == names
+        entry, = no.ls_entries('dangling')
+        assert entry.is_symlink()
+        assert entry.size == os.lstat('dangling').st_size
+        with pytest.raises(FileNotFoundError):
+            entries.Entry.from_path('missing.txt').stat()
+
     @temp_dir
     def test_require_readable_args(self):
         no.ls()
@@ -204,6 +377,76 @@ class TestLs(object):
                 print(no.ls('/home'))
 
         
+class TestFind(object):
+    @temp_dir
+    def test_find_all(self):
+        no.touch(path.join('dir1', 'nested.txt'))
+        found = list(no.find())
+        assert path.abspath('.') in found
+        assert path.abspath('1.txt') in found
+        assert path.abspath(path.join('dir1', 'nested.txt')) in found
+        assert len(found) == len(FILE_NAMES) + len(DIR_NAMES) + 3
+
+    @temp_dir
+    def test_find_is_lazy(self):
+        results = no.find()
+        assert next(results) == path.abspath('.')
+
+    @temp_dir
+    def test_find_name_and_type(self):
+        no.mkdir(path.join('dir1', 'sub.txt'))
+        no.touch(path.join('dir1', 'nested.txt'))
+        found = set(no.find('.', name='*.txt', type='f'))
+        assert path.abspath(path.join('dir1', 'nested.txt')) in found
+        assert path.abspath(path.join('dir1', 'sub.txt')) not in found
+        assert set(no.find(type='d')) == {
+            path.abspath(p) for p in ('.', 'dir1', 'dir2',
+                                      path.join('dir1', 'sub.txt'))}
+
+    @temp_dir
+    def test_find_size_and_newer(self):
+        os.utime('1.txt', (0, 0))
+        assert list(no.find(size='+0', type='f')) == [
+            path.abspath('text_file.txt')]
+        assert list(no.find(size=len('text in file'))) == [
+            path.abspath('text_file.txt')]
+        assert path.abspath('1.txt') not in set(no.find(newer=1))
+        assert path.abspath('2.txt') in set(no.find(newer=1))
+        assert path.abspath('2.txt') not in set(no.find(newer='2.txt'))
+
+    @temp_dir
+    def test_find_depth_and_prune(self):
+        no.mkdir(path.join('dir1', 'a', 'b'), parents=True)
+        no.touch(path.join('dir1', 'a', 'b', 'deep.txt'))
+        assert set(no.find(maxdepth=1, type='d')) == {
+            path.abspath(p) for p in ('.', 'dir1', 'dir2')}
+        assert set(no.find(mindepth=3, type='d')) == {
+            path.abspath(path.join('dir1', 'a', 'b'))}
+        assert not list(no.find(name='deep.txt', prune='a'))
+        assert not list(no.find(name='deep.txt',
+                                prune=lambda entry: entry.name == 'b'))
+
+    @temp_dir
+    def test_find_workers(self):
+        for i in range(10):
+            no.mkdir(path.join('dir1', str(i), 'sub'), parents=True)
+            no.touch(path.join('dir1', str(i), 'sub', 'file.txt'))
+        found = set(no.find(name='file.txt', workers=4))
+        assert found == set(no.find(name='file.txt'))
+        assert len(found) == 10
+
+    @temp_dir
+    def test_find_long(self):
+        found = list(no.find(name='text_file.txt', long=True))
+        assert found[0].size == len('text in file')
+
+    @temp_dir
+    def test_find_not_readable(self):
+        with state.set_readable():
+            with pytest.raises(state.NotReadableError):
+                no.find()
+
+
 class TestRm(object):
     @temp_dir
     def test_rm_file(self):
@@ -240,6 +483,59 @@ class TestRm(object):
         no.rm('dir1', recursive=True)
         assert not path.exists('dir1')
 
+    @temp_dir
+    def test_rm_dir_workers(self):
+        for i in range(10):
+            no.mkdir(path.join('dir1', str(i), 'sub'), parents=True)
+            no.touch(path.join('dir1', str(i), 'sub', 'file.txt'))
+            no.touch(path.join('dir1', str(i), 'file.txt'))
+        os.symlink(path.abspath('dir2'), path.join('dir1', 'link'))
+        no.touch(path.join('dir2', 'kept.txt'))
+
+        assert no.rm('dir1', recursive=True, workers=4) == []
+        assert not path.exists('dir1')
+        # symlinked directories are not followed
+        assert path.exists(path.join('dir2', 'kept.txt'))
+
+    @temp_dir
+    def test_rm_dir_background(self):
+        from nosh import treeutils
+        no.mkdir(path.join('dir1', 'sub'))
+        no.touch(path.join('dir1', 'sub', 'file.txt'))
+
+        no.rm('dir1', recursive=True, background=True)
+        assert not path.exists('dir1')
+        assert treeutils.wait_for_background_removals(timeout=10)
+        assert sorted(os.listdir()) == sorted(
+            ['dir2', 'text_file.txt'] + FILE_NAMES)
+
+    @temp_dir
+    def test_rm_dir_background_symlink(self):
+        os.symlink('dir1', 'link')
+        with pytest.raises(OSError):
+            no.rm('link', recursive=True, background=True)
+        assert path.islink('link')
+        assert path.isdir('dir1')
+
+    @temp_dir
+    def test_rm_dir_background_errors_printed(self):
+        from nosh import treeutils
+
+        def remove_tree(root, workers=None):
+            raise OSError('disk on fire')
+        output = io.StringIO()
+        with mock.patch.object(treeutils, 'remove_tree', remove_tree), \
+                contextlib.redirect_stdout(output):
+            no.rm('dir1', recursive=True, background=True)
+            assert treeutils.wait_for_background_removals(timeout=10)
+        assert 'disk on fire' in output.getvalue()
+
+    @temp_dir
+    def test_rm_dir_background_parent_not_writable(self):
+        with state.set_writable(path.abspath('dir1')):
+            no.rm('dir1', recursive=True, background=True)
+        assert not path.exists('dir1')
+
     @temp_dir
     def test_rm_no_args(self):
         with pytest.raises(ValueError):
@@ -311,3 +607,77 @@ class TestMv(object):
         with state.set_writable():
             with pytest.raises(state.NotWritableError):
                 no.mv('0.txt', 'target.txt')
+
+
+def _reflink_supported():
+    from nosh import copyutils
+    with open('reflink_source', 'w') as fileh:
+        fileh.write('contents')
+    try:
+        copyutils.copyfile('reflink_source', 'reflink_target',
+                           backend='reflink')
+    except OSError:
+        return False
+    finally:
+        for filen in ('reflink_source', 'reflink_target'):
+            if path.exists(filen):
+                os.remove(filen)
+    return True
+
+
+class TestDedupe(object):
+    @temp_dir
+    def test_dedupe(self):
+        for dir_name in DIR_NAMES:
+            with open(path.join(dir_name, 'copy.txt'), 'w') as fileh:
+                fileh.write('text in file')
+        summary = no.dedupe('.')
+        assert len(summary.linked) == 2
+        assert summary.bytes_saved == 2 * len('text in file')
+        assert path.samefile(path.join('dir1', 'copy.txt'),
+                             path.join('dir2', 'copy.txt'))
+        assert path.samefile('text_file.txt', path.join('dir1', 'copy.txt'))
+
+        assert no.dedupe('.').linked == []
+
+    @temp_dir
+    def test_dedupe_dry_run(self):
+        no.cp('text_file.txt', path.join('dir1', 'copy.txt'))
+        summary = no.dedupe('.', dry_run=True)
+        assert len(summary.linked) == 1
+        assert not path.samefile('text_file.txt', path.join('dir1', 'copy.txt'))
+
+    @temp_dir
+    def test_dedupe_reflink(self):
+        if not _reflink_supported():
+            pytest.skip('The filesystem does not support reflinks')
+        no.cp('text_file.txt', path.join('dir1', 'copy.txt'))
+        summary = no.dedupe('.', mode='reflink')
+        assert len(summary.linked) == 1
+        assert not path.samefile('text_file.txt', path.join('dir1', 'copy.txt'))
+
+    @temp_dir
+    def test_cp_dedupe(self):
+        for dir_name in DIR_NAMES:
+            with open(path.join(dir_name, 'copy.txt'), 'w') as fileh:
+                fileh.write('text in file')
+        no.mkdir('target')
+        results = no.cp('text_file.txt', 'dir1', 'dir2', 'target',
+                        recursive=True, dedupe='hardlink')
+        assert [result.error for result in results
+                if result.error is not None] == []
+        assert sorted(result.backend for result in results
+                      if result.backend == 'hardlink') == ['hardlink'] * 2
+        copies = [path.join('target', 'text_file.txt'),
+                  path.join('target', 'dir1', 'copy.txt'),
+                  path.join('target', 'dir2', 'copy.txt')]
+        for copy in copies:
+            with open(copy) as fileh:
+                assert fileh.read() == 'text in file'
+            assert path.samefile(copy, copies[0])
+        assert not path.samefile('text_file.txt', copies[0])
+
+    @temp_dir
+    def test_cp_dedupe_invalid(self):
+        with pytest.raises(ValueError):
+            no.cp('text_file.txt', 'dir1', dedupe='symlink')
@@ -89,3 +89,120 @@ def test_is_writable():
     with state.set_writable('/foo/bar'):
         assert state.is_writable('/foo/bar/file.txt')
     assert state.is_writable('/foo/bar/file.txt')
+
+def test_path_index():
+    examples = [
+        ('/', ['/']),
+        ('/foo/bar', ['/foo']),
+        ('/foo/bar', ['/foo/bar/']),
+        ('/foo/bar/cow', ['/foo/bar', '/foo']),
+        ('/', []),
+        ('/', ['/foo']),
+        ('/foo/bar', ['/foo/bar/cow']),
+        ('/foo/bar', ['/foo/bare']),
+        ('/foo/bar', ['/foo/ba']),
+        ('/foo/bar/../cow', ['/foo/bar']),
+        ('/foo/bar/../cow', ['/foo/cow']),
+        ('relative/path', ['/']),
+    ]
+    for path, start_paths in examples:
+        index = state.PathIndex(start_paths)
+        assert index.contains(path) == state.is_subpath(path, start_paths)
+        # and again, from the cache
+        assert index.contains(path) == state.is_subpath(path, start_paths)
+
+def test_path_index_relative_roots():
+    index = state.PathIndex(['foo'])
+    assert index.contains('foo/bar')
+    assert not index.contains('bar')
+
+def test_path_index_many_roots():
+    roots = ['/root{}/dir'.format(i) for i in range(5000)]
+    index = state.PathIndex(roots)
+    assert index.contains('/root4999/dir/file.txt')
+    assert not index.contains('/root4999/file.txt')
+
+@check_begin_end_default
+def test_index_restored():
+    with state.set_readable('/foo'):
+        assert not state.is_readable('/bar/file.txt')
+        with state.push_readable('/bar'):
+            assert state.is_readable('/bar/file.txt')
+        assert not state.is_readable('/bar/file.txt')
+    assert state.is_readable('/bar/file.txt')
+
+@check_begin_end_default
+def test_state_restored_after_exception():
+    try:
+        with state.set_valid(*EXAMPLE_PATHS):
+            with state.push_readable('/other'):
+                raise RuntimeError()
+    except RuntimeError:
+        pass
+
+@check_begin_end_default
+def test_threads_have_separate_state():
+    import threading
+    entered = threading.Barrier(2)
+    seen = {}
+
+    def worker(name, paths):
+        with state.set_readable(*paths):
+            entered.wait()
+            seen[name] = state.get_readable()
+            entered.wait()
+
+    threads = [threading.Thread(target=worker, args=('a', ['/a'])),
+               threading.Thread(target=worker, args=('b', ['/b', '/c']))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == {'a': {'/a'}, 'b': {'/b', '/c'}}
+
+@check_begin_end_default
+def test_tasks_have_separate_state():
+    import asyncio
+
+    async def task(paths):
+        with state.set_writable(*paths):
+            await asyncio.sleep(0.01)
+            return state.is_writable('/a/file.txt')
+
+    async def main():
+        return await asyncio.gather(task(['/a']), task(['/b']))
+
+    assert asyncio.run(main()) == [True, False]
+
+@check_begin_end_default
+def test_default_applies_to_bare_threads():
+    import threading
+    seen = {}
+
+    def worker():
+        seen['etc'] = state.is_writable('/etc/x')
+        seen['sandbox'] = state.is_writable('/sandbox/x')
+        seen['readable'] = state.is_readable('/etc/x')
+
+    previous = state.set_default_writable('/sandbox')
+    try:
+        assert state.get_writable() == {'/sandbox'}
+        with state.set_writable('/sandbox/sub'):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        # push_writable and set_writable still apply on top of it
+        with state.push_writable('/other'):
+            assert state.get_writable() == {'/sandbox', '/other'}
+    finally:
+        state.set_default_writable(*previous)
+    assert seen == {'etc': False, 'sandbox': True, 'readable': True}
+
+@check_begin_end_default
+def test_set_default_valid():
+    previous = state.set_default_valid('/a')
+    try:
+        assert state.get_readable() == state.get_writable() == {'/a'}
+    finally:
+        state.set_default_readable(*previous[0])
+        state.set_default_writable(*previous[1])
@@ -0,0 +1,104 @@
+import nosh as no
+import nosh.dirutils as nodirutils
+from nosh import throttle
+
+from functools import wraps
+from os import path
+import os
+import time
+
+import pytest
+
+
+def temp_dir(func):
+    '''Decorator to carry out tests in a py.test temp dir.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        with nodirutils.temp_directory() as temp_dir_name:
+            with nodirutils.current_directory(temp_dir_name):
+                os.mkdir('dir1')
+                for index in range(10):
+                    with open(path.join('dir1', str(index)), 'wb') as fileh:
+                        fileh.write(b'x' * 1000)
+                return func(*args, **kwargs)
+    return new_func
+
+
+def test_token_bucket():
+    bucket = throttle.TokenBucket(100, 10)
+    assert bucket.take(10) == 0
+    # Overdrawn by 10, so 0.1s until back in credit
+    assert bucket.take(10) == pytest.approx(0.1, abs=0.01)
+    assert bucket.take(10) == pytest.approx(0.2, abs=0.01)
+    with pytest.raises(ValueError):
+        throttle.TokenBucket(0, 10)
+
+
+def test_burst():
+    limits = throttle.Throttle(files_per_second=10, burst=0.5)
+    assert limits.wait(files=5) == 0
+    assert limits.wait(files=1) > 0
+    assert limits.throttled > 0
+    assert throttle.Throttle().wait(files=100, nbytes=10 ** 9) == 0
+
+
+@temp_dir
+def test_files_per_second():
+    limits = throttle.Throttle(files_per_second=50, burst=0.02)
+    start = time.monotonic()
+    no.cp('dir1', 'dir2', recursive=True, throttle=limits)
+    # One file at once, then 9 more at 50 per second
+    assert time.monotonic() - start >= 0.15
+    assert 0.15 <= limits.throttled < 1
+    assert len(os.listdir('dir2')) == 10
+
+    throttled = limits.throttled
+    no.rm('dir2', recursive=True, throttle=limits)
+    assert limits.throttled > throttled
+    assert not path.exists('dir2')
+
+
+@temp_dir
+def test_bytes_per_second():
+    with open('big', 'wb') as fileh:
+        fileh.write(b'x' * 100000)
+    limits = throttle.Throttle(bytes_per_second=500000, burst=0.1)
+    for backend in ('copy_file_range', 'sendfile', 'userspace'):
+        try:
+            no.cp('big', backend, backend=backend, throttle=limits)
+        except OSError:  # backend not supported here
+            continue
+        # 50000 bytes of burst, the other 50000 take 0.1s
+        assert limits.throttled >= 0.08
+        break
+    else:
+        pytest.skip('No byte-copying backend is supported')
+
+
+@temp_dir
+def test_archives():
+    limits = throttle.Throttle(files_per_second=50, burst=0.02)
+    no.tar('dir1', 'dir1.tar', compress=None, throttle=limits)
+    assert limits.throttled >= 0.15
+    os.mkdir('out')
+    throttled = limits.throttled
+    no.untar('dir1.tar', 'out', throttle=limits)
+    assert limits.throttled >= throttled + 0.15
+    assert len(os.listdir(path.join('out', 'dir1'))) == 10
+
+
+@temp_dir
+def test_default_throttle():
+    limits = throttle.Throttle(files_per_second=50, burst=0.02)
+    previous = throttle.set_default_throttle(limits)
+    try:
+        assert throttle.get_throttle() is limits
+        with no.instrument() as recorder:
+            no.cp('dir1', 'dir2', recursive=True)
+        with throttle.use_throttle(throttle.Throttle()):
+            no.cp('dir1', 'dir3', recursive=True)
+    finally:
+        throttle.set_default_throttle(previous)
+    assert throttle.get_throttle() is None
+    record, = recorder.records
+    assert record.phases['throttled'] == pytest.approx(limits.throttled)
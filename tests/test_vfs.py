@@ -0,0 +1,171 @@
+import nosh as no
+from nosh import vfs
+
+import hashlib
+from functools import wraps
+from os import path
+import errno
+import stat
+
+import pytest
+
+
+def memory_fs(func):
+    '''Decorator to carry out tests in a fresh MemoryFileSystem holding
+    /src/a.txt, /src/b.txt and /src/sub/c.txt.'''
+    @wraps(func)
+    def new_func(*args, **kwargs):
+        fs = vfs.MemoryFileSystem()
+        fs.makedirs('/src/sub')
+        for filen in ('/src/a.txt', '/src/b.txt', '/src/sub/c.txt'):
+            with fs.open(filen, 'w') as fileh:
+                fileh.write(filen)
+        with vfs.use_filesystem(fs):
+            return func(*args, **kwargs)
+    return new_func
+
+
+def read(fs, filen):
+    with fs.open(filen) as fileh:
+        return fileh.read()
+
+
+def tree(fs, root):
+    return sorted(entry.path for entry in no.find(root, long=True))
+
+
+def test_memory_files():
+    fs = vfs.MemoryFileSystem()
+    fs.mkdir('/dir')
+    with fs.open('/dir/file', 'wb') as fileh:
+        fileh.write(b'data')
+    with fs.open('/dir/file', 'a') as fileh:
+        fileh.write('more')
+    assert read(fs, '/dir/file') == 'datamore'
+    assert fs.stat('/dir/file').st_size == 8
+    assert stat.S_ISDIR(fs.stat('/dir').st_mode)
+    assert fs.listdir('/dir') == ['file']
+    assert fs.isfile('/dir/file') and not fs.isdir('/dir/file')
+
+    with pytest.raises(FileExistsError):
+        fs.open('/dir/file', 'x')
+    with pytest.raises(FileNotFoundError):
+        fs.open('/missing')
+    with pytest.raises(IsADirectoryError):
+        fs.open('/dir', 'w')
+    with pytest.raises(NotADirectoryError):
+        fs.stat('/dir/file/below')
+    with pytest.raises(OSError) as error:
+        fs.rmdir('/dir')
+    assert error.value.errno == errno.ENOTEMPTY
+
+    fs.rename('/dir', '/renamed')
+    assert fs.listdir('/') == ['renamed']
+    with pytest.raises(OSError):
+        fs.rename('/renamed', '/renamed/inside')
+    fs.copy('/renamed/file', '/copy')
+    fs.unlink('/renamed/file')
+    fs.rmdir('/renamed')
+    assert fs.listdir('/') == ['copy']
+    assert read(fs, '/copy') == 'datamore'
+
+
+def test_memory_stat_times():
+    fs = vfs.MemoryFileSystem()
+    with fs.open('/file', 'w'):
+        pass
+    fs.utime('/file', (10 ** 9, 2 * 10 ** 9))
+    fs.chmod('/file', 0o600)
+    file_stat = fs.stat('/file')
+    assert file_stat.st_mtime_ns == 2 * 10 ** 9
+    assert file_stat.st_mtime == 2
+    assert stat.S_IMODE(file_stat.st_mode) == 0o600
+    assert file_stat.st_dev == fs.device
+    assert vfs.MemoryFileSystem().device != fs.device
+
+
+@memory_fs
+def test_commands_in_memory():
+    fs = vfs.get_filesystem()
+    no.cp('/src', '/dst', recursive=True)
+    assert tree(fs, '/dst') == ['/dst', '/dst/a.txt', '/dst/b.txt',
+                                '/dst/sub', '/dst/sub/c.txt']
+    assert read(fs, '/dst/sub/c.txt') == '/src/sub/c.txt'
+
+    no.mkdir('/flat')
+    no.cp('/src/*.txt', '/flat')
+    assert sorted(no.ls('/flat')) == ['a.txt', 'b.txt']
+    no.mv('/flat/a.txt', '/flat/moved.txt')
+    no.touch('/flat/new.txt')
+    assert sorted(no.ls('/flat')) == ['b.txt', 'moved.txt', 'new.txt']
+    assert sorted(no.find('/', name='c.txt')) == ['/dst/sub/c.txt',
+                                                  '/src/sub/c.txt']
+
+    no.rm('/dst', recursive=True)
+    assert not fs.exists('/dst')
+    assert not path.exists('/src/a.txt')
+
+
+@memory_fs
+def test_workers_in_memory():
+    fs = vfs.get_filesystem()
+    no.cp('/src', '/dst', recursive=True, workers=4)
+    assert len(list(no.find('/dst', workers=4))) == 5
+    no.rm('/dst', recursive=True, workers=4)
+    assert not fs.exists('/dst')
+
+
+@memory_fs
+def test_sync_and_checksum_in_memory():
+    fs = vfs.get_filesystem()
+    summary = no.sync('/src', '/backup')
+    assert len(summary.copied) == 3
+    summary = no.sync('/src', '/backup')
+    assert summary.copied == [] and len(summary.skipped) == 3
+
+    digests = dict(no.checksum('/backup/src', recursive=True))
+    assert digests['/backup/src/a.txt'] == hashlib.sha256(
+        b'/src/a.txt').hexdigest()
+
+
+@memory_fs
+def test_plan_in_memory():
+    fs = vfs.get_filesystem()
+    with no.plan() as plan:
+        plan.mkdir('/out')
+        plan.cp('/src', '/out', recursive=True)
+        plan.rm('/src/a.txt')
+    assert fs.exists('/out/src/sub/c.txt')
+    assert not fs.exists('/src/a.txt')
+
+
+@memory_fs
+def test_dry_run_in_memory():
+    fs = vfs.get_filesystem()
+    report = no.cp('/src', '/dst', recursive=True, dry_run=True)
+    assert (report.files, report.directories) == (3, 2)
+    assert not report.cross_device
+
+
+@memory_fs
+def test_local_only():
+    fs = vfs.get_filesystem()
+    with pytest.raises(vfs.UnsupportedFileSystem):
+        no.tar('/src', '/src.tar.gz')
+    with pytest.raises(vfs.UnsupportedFileSystem):
+        no.dedupe('/src')
+    with pytest.raises(vfs.UnsupportedFileSystem):
+        no.cp('/src/a.txt', '/x', dedupe='hardlink')
+
+
+def test_default_filesystem():
+    assert vfs.get_filesystem() is vfs.LOCAL
+    fs = vfs.MemoryFileSystem()
+    previous = vfs.set_default_filesystem(fs)
+    try:
+        assert vfs.get_filesystem() is fs
+        with vfs.use_filesystem(vfs.LOCAL):
+            assert vfs.get_filesystem() is vfs.LOCAL
+    finally:
+        vfs.set_default_filesystem(previous)
+    assert vfs.get_filesystem() is vfs.LOCAL